@@ -1,6 +1,11 @@
 #If this package was installed only to use the low-level driver, the PyQt library is not necessarily installed. In this case, importing stuff from main.py would generate an error
+#interface and gui are imported only when they are accessed for the first time, so that the headless controller (controller.py) can be used without loading Qt
 import importlib.util
 package_name = 'PyQt5'
 spec = importlib.util.find_spec(package_name)
-if spec:
-    from .main import interface, gui
\ No newline at end of file
+
+def __getattr__(name):
+    if spec and name in ['interface', 'gui']:
+        from .main import interface, gui
+        return {'interface': interface, 'gui': gui}[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,122 @@
+'''
+Background acquisition worker. It periodically calls a function (typically driver.pyThorlabsKCubeKPC101.snapshot) on a dedicated thread,
+following a fixed schedule based on time.monotonic(), so that the sampling rate does not depend on the latency of each read nor on the load of the GUI thread.
+It does not depend on Qt: results are passed to a callback, which is called on the worker thread. The interface defined in main.py uses a callback
+that emits a Qt signal, which Qt automatically delivers to the GUI thread (queued connection).
+'''
+import time
+import threading
+
+class acquisition_worker():
+    '''
+    Attributes
+    ----------
+    func_acquire
+        Function which takes no input parameter and returns the acquired data
+    period : float
+        Sampling period, in s
+    lock
+        Lock (e.g. driver.pyThorlabsKCubeKPC101.lock) held while func_acquire is executed. Can be None
+    callback
+        Function called (on the worker thread) with the acquired data as only input parameter
+    on_error
+        Function called (on the worker thread) with the exception as only input parameter, whenever func_acquire raises an exception.
+        If None, exceptions are silently counted in self.numb_errors
+
+    Statistics (see also the property stats)
+    ----------
+    numb_samples : int
+        Number of successful acquisitions
+    numb_missed_deadlines : int
+        Number of scheduled acquisitions that were skipped because the previous acquisition took longer than one period
+    last_drift, max_drift : float
+        Delay (in s) between the scheduled time of an acquisition and the time when it actually started (last value and maximum value)
+    '''
+    def __init__(self, func_acquire, period, lock = None, callback = None, on_error = None):
+        self.func_acquire = func_acquire
+        self.period = float(period)
+        self.lock = lock
+        self.callback = callback
+        self.on_error = on_error
+        self._thread = None
+        self._stop_event = threading.Event()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.numb_samples = 0
+        self.numb_errors = 0
+        self.numb_missed_deadlines = 0
+        self.last_drift = 0.0
+        self.max_drift = 0.0
+        self._sum_drift = 0.0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+
+    @property
+    def stats(self):
+        return {'numb_samples': self.numb_samples,
+                'numb_errors': self.numb_errors,
+                'numb_missed_deadlines': self.numb_missed_deadlines,
+                'period': self.period,
+                'last_drift': self.last_drift,
+                'max_drift': self.max_drift,
+                'mean_drift': self._sum_drift / self.numb_samples if self.numb_samples else 0.0,
+                'last_duration': self.last_duration,
+                'max_duration': self.max_duration}
+
+    @property
+    def is_running(self):
+        return (self._thread is not None) and self._thread.is_alive()
+
+    def set_period(self, period):
+        # The new period is used starting from the next acquisition
+        self.period = float(period)
+
+    def start(self):
+        if self.is_running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target = self._run, name = 'acquisition_worker', daemon = True)
+        self._thread.start()
+
+    def stop(self, timeout = 2.0):
+        self._stop_event.set()
+        if self._thread and not (self._thread is threading.current_thread()):
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _acquire_once(self):
+        if self.lock:
+            with self.lock:
+                return self.func_acquire()
+        return self.func_acquire()
+
+    def _run(self):
+        next_deadline = time.monotonic()
+        while not self._stop_event.is_set():
+            start = time.monotonic()
+            drift = start - next_deadline
+            try:
+                data = self._acquire_once()
+            except Exception as e:
+                self.numb_errors += 1
+                if self.on_error:
+                    self.on_error(e)
+            else:
+                self.numb_samples += 1
+                self.last_drift = drift
+                self.max_drift = max(self.max_drift, drift)
+                self._sum_drift += drift
+                if self.callback:
+                    self.callback(data)
+            now = time.monotonic()
+            self.last_duration = now - start
+            self.max_duration = max(self.max_duration, self.last_duration)
+            # The deadlines are multiples of the period, so that the delays of each acquisition do not accumulate. If we are late by
+            # one period or more, the deadlines which have already passed are skipped and counted as missed
+            next_deadline = next_deadline + self.period
+            if (now - next_deadline) >= self.period:
+                numb_missed = int((now - next_deadline) // self.period)
+                self.numb_missed_deadlines += numb_missed
+                next_deadline = next_deadline + numb_missed * self.period
+            self._stop_event.wait(max(next_deadline - time.monotonic(), 0))
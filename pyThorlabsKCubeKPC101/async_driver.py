@@ -0,0 +1,168 @@
+'''
+asyncio API for the KPC101.
+
+AsyncKPC101 wraps a driver.pyThorlabsKCubeKPC101 object. Every call to the driver (and therefore every blocking .NET call) is executed on a
+dedicated single-thread executor, so that the event loop is never blocked and the device is never accessed by two calls at the same time.
+Waiting for a movement to settle is done on the event loop (with asyncio.sleep between polls, see settle.settle_detector), so that other
+coroutines (and other calls to the device) can run in the meanwhile.
+
+    async with AsyncKPC101() as piezo:
+        await piezo.connect('29000001')
+        await piezo.move_to(5)                  # resolves when the movement has settled
+        async for state in piezo.stream(rate = 50):
+            print(state.position)
+'''
+import asyncio
+import functools
+import concurrent.futures
+
+from pyThorlabsKCubeKPC101 import driver
+from pyThorlabsKCubeKPC101 import driver_virtual
+from pyThorlabsKCubeKPC101 import settle
+
+class AsyncKPC101():
+    '''
+    Parameters
+    ----------
+    instrument
+        Driver object. If None, a driver.pyThorlabsKCubeKPC101 (or a driver_virtual.pyThorlabsKCubeKPC101, if virtual = True) is created with the given backend
+    settle_kwargs
+        Default keyword arguments of the settle detection used by move_to, set_voltage and jog_by (see settle.settle_detector),
+        e.g. tolerance, numb_samples, initial_interval, max_interval, backoff, timeout
+    '''
+    def __init__(self, instrument = None, backend = None, virtual = False, **settle_kwargs):
+        if instrument:
+            self.instrument = instrument
+        elif virtual:
+            self.instrument = driver_virtual.pyThorlabsKCubeKPC101(backend = backend)
+        else:
+            self.instrument = driver.pyThorlabsKCubeKPC101(backend = backend)
+        self.settle_kwargs = settle_kwargs
+        self.last_settle_time = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'AsyncKPC101')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def run(self, func, *args, **kwargs):
+        '''
+        Execute func(*args, **kwargs) on the executor of the device, and return its result. Can be used to call any method of the driver, e.g.
+            await piezo.run(piezo.instrument.set_jog_steps, position = 0.1)
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    @property
+    def connected(self):
+        return self.instrument.connected
+
+    async def list_devices(self, max_age = None):
+        return await self.run(self.instrument.list_devices, max_age = max_age)
+
+    async def connect(self, device_sn = None, **kwargs):
+        '''
+        Connect to the device with serial number device_sn (if None, the first device found). The keyword arguments are passed to
+        driver.pyThorlabsKCubeKPC101.connect_device. Returns the description of the device, raises RuntimeError if the connection failed
+        '''
+        if device_sn is None:
+            list_valid_devices = await self.list_devices()
+            if not list_valid_devices:
+                raise RuntimeError("No device found.")
+            device_sn = list_valid_devices[0]
+        (Msg, ID) = await self.run(self.instrument.connect_device, device_sn, **kwargs)
+        if ID != 1:
+            raise RuntimeError(f"Connection to device {device_sn} failed: {Msg}")
+        return Msg
+
+    async def disconnect(self):
+        (Msg, ID) = await self.run(self.instrument.disconnect_device)
+        if ID != 1:
+            raise RuntimeError(f"Disconnection failed: {Msg}")
+        return Msg
+
+    async def close(self):
+        # Disconnect the device (if connected) and shut down the executor
+        if self.instrument.connected:
+            await self.disconnect()
+        self._executor.shutdown(wait = False)
+
+    async def snapshot(self):
+        return await self.run(self.instrument.snapshot)
+
+    async def position(self):
+        return await self.run(lambda: self.instrument.position_f)
+
+    async def voltage(self):
+        return await self.run(lambda: self.instrument.voltage_f)
+
+    async def mode(self):
+        return await self.run(lambda: self.instrument.mode)
+
+    async def set_mode(self, mode):
+        def set_mode():
+            self.instrument.mode = mode
+        await self.run(set_mode)
+
+    async def wait_until_settled(self, target = None, func_read_value = None, **kwargs):
+        '''
+        Wait (without blocking the event loop) until the current movement has ended, see settle.settle_detector. Each poll of the device runs on
+        the executor, and the event loop sleeps between polls. The keyword arguments override self.settle_kwargs.
+        Returns the time needed to settle (in s), raises TimeoutError if the timeout expired
+        '''
+        settings = dict(self.settle_kwargs)
+        settings.update(kwargs)
+        detector = settle.settle_detector(func_is_busy = lambda: self.instrument.is_busy, func_read_value = func_read_value, target = target, **settings)
+        while not (await self.run(detector.poll)):
+            await asyncio.sleep(detector.next_interval)
+        self.last_settle_time = detector.time_to_settle
+        if detector.timed_out:
+            raise TimeoutError(f"The movement did not end within {detector.timeout} s.")
+        return detector.time_to_settle
+
+    async def move_to(self, position, wait = True, **settle_kwargs):
+        '''
+        Move to position (close loop only). If wait = True, resolves when the movement has settled and returns the time needed to settle
+        '''
+        await self.run(self.instrument.set_position_f, float(position))
+        if wait:
+            return await self.wait_until_settled(target = float(position), func_read_value = lambda: self.instrument.position_f, **settle_kwargs)
+
+    async def set_voltage(self, voltage, wait = True, **settle_kwargs):
+        '''
+        Set the output voltage (open loop only). If wait = True, resolves when the output has settled and returns the time needed to settle
+        '''
+        await self.run(self.instrument.set_voltage_f, float(voltage))
+        if wait:
+            return await self.wait_until_settled(target = float(voltage), func_read_value = lambda: self.instrument.voltage_f, **settle_kwargs)
+
+    async def jog_by(self, step, wait = True, **settle_kwargs):
+        '''
+        Jog by step (a position in close loop, a voltage in open loop). If wait = True, resolves when the movement has settled and returns the time needed to settle
+        '''
+        await self.run(self.instrument.jog_by, step)
+        if wait:
+            return await self.wait_until_settled(**settle_kwargs)
+
+    async def stream(self, rate, max_samples = None):
+        '''
+        Asynchronous generator which reads the state of the device (driver.state_snapshot objects) rate times per second, e.g.
+            async for state in piezo.stream(rate = 50):
+                ...
+        Reads are scheduled at fixed times (multiples of 1/rate from the first read), so that delays do not accumulate. If a read is late by
+        more than one period, the missed reads are skipped. The generator stops after max_samples samples (if not None)
+        '''
+        loop = asyncio.get_running_loop()
+        period = 1 / rate
+        next_deadline = loop.time()
+        numb_samples = 0
+        while (max_samples is None) or (numb_samples < max_samples):
+            yield await self.snapshot()
+            numb_samples += 1
+            next_deadline += period
+            now = loop.time()
+            if now - next_deadline >= period:
+                next_deadline += ((now - next_deadline) // period) * period
+            await asyncio.sleep(max(next_deadline - now, 0))
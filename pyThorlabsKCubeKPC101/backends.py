@@ -0,0 +1,309 @@
+'''
+Device backends used by driver.pyThorlabsKCubeKPC101.
+
+A backend knows how to enumerate devices and how to create the object that represents a single KPC101. The driver only talks to
+this object via the methods of the Kinesis class KCubePiezoStrainGauge (GetPosition, SetOutputVoltage, IsSetPositionActive, GetJogSteps, ...),
+so any object which exposes the same methods can be used in place of a real device.
+
+kinesis_backend
+    Talks to real devices through the Thorlabs Kinesis .NET assemblies (via pythonnet). The assemblies are loaded only the first time
+    that devices are enumerated or a device is created, so importing this package does not require Kinesis to be installed.
+simulated_backend
+    Pure-python backend, which creates simulated_device objects. Useful for testing the driver and the interface on any machine.
+'''
+import os
+import time
+import enum
+import decimal
+
+KINESIS_FOLDER = "C:\\Program Files\\Thorlabs\\Kinesis"
+KINESIS_ASSEMBLIES = [  "Thorlabs.MotionControl.DeviceManagerCLI.dll",
+                        "Thorlabs.MotionControl.GenericMotorCLI.dll",
+                        "Thorlabs.MotionControl.GenericPiezoCLI.dll",
+                        "ThorLabs.MotionControl.KCube.PiezoStrainGaugeCLI.dll"]
+
+class kinesis_backend():
+    '''
+    Backend for real devices, based on the Thorlabs Kinesis .NET assemblies.
+
+    Attributes
+    ----------
+    kinesis_folder : str
+        Folder containing the Kinesis .dll files
+    loaded : bool
+        True if the .NET assemblies have already been loaded
+    Decimal
+        The System.Decimal .NET type (available only after the assemblies have been loaded)
+    to_float, from_float
+        Functions which convert a System.Decimal into a python float and viceversa, with the cheapest conversion allowed by pythonnet 
+        (available only after the assemblies have been loaded)
+    PiezoJogDirection
+        The .NET enum used to specify the jog direction (available only after the assemblies have been loaded)
+    '''
+    enumeration_key = ('kinesis',)  # The Kinesis device manager is global to the process, so all Kinesis backends share the same list of devices (see enumeration.py)
+
+    def __init__(self, kinesis_folder = KINESIS_FOLDER):
+        self.kinesis_folder = kinesis_folder
+        self.loaded = False
+
+    def load(self):
+        '''
+        Load the Kinesis .NET assemblies, if they were not loaded already. This is called automatically by list_devices() and create_device()
+        '''
+        if self.loaded:
+            return
+        import clr
+        for assembly in KINESIS_ASSEMBLIES:
+            clr.AddReference(os.path.join(self.kinesis_folder, assembly))
+        import Thorlabs.MotionControl.DeviceManagerCLI as DevManCLI
+        import Thorlabs.MotionControl.GenericPiezoCLI as GenPieCLI
+        import Thorlabs.MotionControl.KCube.PiezoStrainGaugeCLI as PieStrGauCLI
+        from System import Decimal  # necessary for real world units
+        self.DevManCLI = DevManCLI
+        self.GenPieCLI = GenPieCLI
+        self.PieStrGauCLI = PieStrGauCLI
+        self.Decimal = Decimal
+        self.to_float = Decimal.ToDouble    # Much faster than float(str(value)), which formats and parses a string
+        self.from_float = Decimal           # Uses the Decimal(Double) constructor
+        self.PiezoJogDirection = GenPieCLI.Settings.ControlSettings.PiezoJogDirection
+        self.loaded = True
+
+    def list_devices(self):
+        '''
+        Returns
+        -------
+        list
+            Serial numbers (as strings) of all the devices found
+        '''
+        self.load()
+        self.DevManCLI.DeviceManagerCLI.BuildDeviceList()
+        return [str(dev) for dev in self.DevManCLI.DeviceManagerCLI.GetDeviceList()]
+
+    def create_device(self, device_sn):
+        self.load()
+        return self.PieStrGauCLI.KCubePiezoStrainGauge.CreateKCubePiezoStrainGauge(device_sn)
+
+######################################
+### Pure-python (simulated) backend ##
+######################################
+
+class PiezoControlModeTypes(enum.Enum):
+    # Mimics the .NET enum returned by KCubePiezoStrainGauge.GetPositionControlMode()
+    Undefined = 0
+    OpenLoop = 1
+    CloseLoop = 2
+    OpenLoopSmooth = 3
+    CloseLoopSmooth = 4
+
+class PiezoJogDirection(enum.Enum):
+    # Mimics the .NET enum Thorlabs.MotionControl.GenericPiezoCLI.Settings.ControlSettings.PiezoJogDirection
+    Increase = 1
+    Decrease = 2
+
+class simulated_jog_steps():
+    # Mimics the object returned by KCubePiezoStrainGauge.GetJogSteps()
+    def __init__(self, PercentageStepSize, PositionStepSize, VoltageStepSize):
+        self.PercentageStepSize = PercentageStepSize
+        self.PositionStepSize = PositionStepSize
+        self.VoltageStepSize = VoltageStepSize
+
+class simulated_device_info():
+    # Mimics the object returned by KCubePiezoStrainGauge.GetDeviceInfo()
+    def __init__(self, serial_number, description):
+        self.SerialNumber = serial_number
+        self.Description = description
+
+class simulated_device():
+    '''
+    Pure-python object which mimics the methods of the Kinesis class KCubePiezoStrainGauge used by the driver.
+    All quantities are exchanged as decimal.Decimal, in the same way as the real device uses System.Decimal.
+
+    The piezo is modelled in the simplest possible way: in close loop the position reaches the set point after a time settle_time, while in
+    open loop the position is proportional to the output voltage (full travel at the maximum voltage), and the voltage reaches its set point after
+    a time settle_time. A more realistic model of the piezo is defined in driver_virtual.py
+    '''
+    def __init__(self, device_sn, max_travel = 20, max_voltage = 75, settle_time = 0.05):
+        self.device_sn = str(device_sn)
+        self.settle_time = settle_time
+        self._max_travel = float(max_travel)
+        self._max_voltage = float(max_voltage)
+        self._connected = False
+        self._enabled = False
+        self._polling_rate = 0
+        self._mode = PiezoControlModeTypes.CloseLoop
+        self._jog_steps = simulated_jog_steps(decimal.Decimal('0.1'), decimal.Decimal('0.1'), decimal.Decimal('0.5'))
+        self._position = 0.0
+        self._voltage = 0.0
+        self._move_ends_at = 0.0
+
+    # Connection
+    def Connect(self, device_sn):
+        if str(device_sn) != self.device_sn:
+            raise RuntimeError(f"Device {device_sn} not found.")
+        self._connected = True
+
+    def Disconnect(self):
+        self._connected = False
+        self._enabled = False
+
+    def IsConnected(self):
+        return self._connected
+
+    def GetDeviceInfo(self):
+        return simulated_device_info(self.device_sn, 'Simulated KPC101 Piezo Controller')
+
+    def StartPolling(self, rate):
+        self._polling_rate = rate
+
+    def StopPolling(self):
+        self._polling_rate = 0
+
+    def EnableDevice(self):
+        self._enabled = True
+
+    def DisableDevice(self):
+        self._enabled = False
+
+    @property
+    def IsEnabled(self):
+        return self._enabled
+
+    def IsSettingsInitialized(self):
+        return self._connected
+
+    def WaitForSettingsInitialized(self, timeout):
+        return self.IsSettingsInitialized()
+
+    def GetPiezoConfiguration(self, device_sn):
+        return self._connected
+
+    @property
+    def PiezoDeviceSettings(self):
+        return self._connected
+
+    def PersistSettings(self):
+        pass
+
+    # Control mode
+    def GetPositionControlMode(self):
+        return self._mode
+
+    def SetPositionControlMode(self, mode):
+        self._update_state()
+        self._mode = PiezoControlModeTypes(mode.value)
+
+    def _is_open_loop(self):
+        return self._mode in (PiezoControlModeTypes.OpenLoop, PiezoControlModeTypes.OpenLoopSmooth)
+
+    # Limits
+    def GetMaxTravel(self):
+        return decimal.Decimal(str(self._max_travel))
+
+    def GetMinimumTravel(self):
+        return decimal.Decimal(0)
+
+    def GetMaxOutputVoltage(self):
+        return decimal.Decimal(str(self._max_voltage))
+
+    def GetMinOutputVoltage(self):
+        return decimal.Decimal(0)
+
+    # Position and voltage
+    def _update_state(self):
+        # Called before any read, it updates the internal state of the piezo. This simple model has no dynamics, everything is done in the setters
+        return
+
+    def _start_move(self):
+        self._move_ends_at = time.monotonic() + self.settle_time
+
+    def _is_moving(self):
+        return time.monotonic() < self._move_ends_at
+
+    def GetPosition(self):
+        self._update_state()
+        return decimal.Decimal(repr(self._position))
+
+    def SetPosition(self, position):
+        self._position = min(max(float(position), 0.0), self._max_travel)
+        self._voltage = self._position / self._max_travel * self._max_voltage
+        self._start_move()
+
+    def GetOutputVoltage(self):
+        self._update_state()
+        return decimal.Decimal(repr(self._voltage))
+
+    def SetOutputVoltage(self, voltage):
+        self._voltage = min(max(float(voltage), 0.0), self._max_voltage)
+        self._position = self._voltage / self._max_voltage * self._max_travel
+        self._start_move()
+
+    def IsSetPositionActive(self):
+        return (not self._is_open_loop()) and self._is_moving()
+
+    def IsSetOutputVoltageActive(self):
+        return self._is_open_loop() and self._is_moving()
+
+    def SetZero(self):
+        self.SetOutputVoltage(0)
+        self._position = 0.0
+
+    # Jogging
+    def GetJogSteps(self):
+        return simulated_jog_steps(self._jog_steps.PercentageStepSize, self._jog_steps.PositionStepSize, self._jog_steps.VoltageStepSize)
+
+    def SetJogSteps(self, jog_steps):
+        self._jog_steps = simulated_jog_steps(jog_steps.PercentageStepSize, jog_steps.PositionStepSize, jog_steps.VoltageStepSize)
+
+    def Jog(self, *args):
+        # Can be called either as Jog(direction) or Jog(step_size, direction), as the .NET method
+        if len(args) == 1:
+            direction = args[0]
+            step_size = self._jog_steps.VoltageStepSize if self._is_open_loop() else self._jog_steps.PositionStepSize
+        else:
+            step_size, direction = args
+        step_size = float(step_size)
+        if direction == PiezoJogDirection.Decrease:
+            step_size = -step_size
+        self._update_state()
+        if self._is_open_loop():
+            self.SetOutputVoltage(self._voltage + step_size)
+        else:
+            self.SetPosition(self._position + step_size)
+
+class simulated_backend():
+    '''
+    Backend which creates simulated_device objects instead of talking to real devices.
+
+    Attributes
+    ----------
+    serial_numbers : list
+        Serial numbers of the simulated devices which will be "found" by list_devices()
+    device_class
+        Class used to create the simulated devices (default = simulated_device). It must accept the serial number as first parameter
+    device_kwargs : dict
+        Additional keyword arguments passed to device_class
+    '''
+    Decimal = decimal.Decimal
+    PiezoJogDirection = PiezoJogDirection
+    to_float = float
+    from_float = decimal.Decimal
+
+    def __init__(self, serial_numbers = ['29000001'], device_class = simulated_device, **device_kwargs):
+        self.serial_numbers = [str(sn) for sn in serial_numbers]
+        self.device_class = device_class
+        self.device_kwargs = device_kwargs
+        self.devices = dict()  # keep the same object for each serial number, so that its state survives a disconnection
+
+    def load(self):
+        return
+
+    def list_devices(self):
+        return list(self.serial_numbers)
+
+    def create_device(self, device_sn):
+        device_sn = str(device_sn)
+        if not (device_sn in self.serial_numbers):
+            raise ValueError("The specified serial number is not valid.")
+        if not (device_sn in self.devices):
+            self.devices[device_sn] = self.device_class(device_sn, **self.device_kwargs)
+        return self.devices[device_sn]
@@ -0,0 +1,898 @@
+'''
+Headless (Qt-free) high-level controller of a KPC101.
+
+The controller provides the same services of the Qt interface defined in main.py (periodic reading of the device, settle detection, ramps,
+persistence of the settings in the config.json file) using only plain callbacks and threads, so that it can be used in scripts and on
+machines without a display, without starting a QApplication. The Qt interface (main.interface) is a thin adapter built on top of it.
+
+Notifications are delivered to callbacks registered with subscribe(event, function). The events, and the parameters passed to the callbacks, are
+
+    'list_devices_updated'      list of devices
+    'list_devices_changed'      serial numbers added, serial numbers removed
+    'connected'                 SIG_CONNECTED, SIG_CONNECTING, SIG_DISCONNECTED or SIG_DISCONNECTING
+    'update_state'              driver.state_snapshot object
+    'update_position'           position (float)
+    'update_voltage'            voltage (float)
+    'step_size_changed'         'position' or 'voltage', step size (float)
+    'mode_changed'              'CloseLoop' or 'OpenLoop'
+    'moving_status'             SIG_MOVEMENT_STARTED or SIG_MOVEMENT_ENDED
+    'refresh_time'              refresh time (float)
+    'device_zeroed'             (no parameter)
+    'ramp'                      SIG_RAMP_STARTED or SIG_RAMP_ENDED
+    'trigger'                   (no parameter) new data has been acquired, e.g. to trigger other instruments
+
+Two hooks define where the work is executed. By default, delayed calls (used to poll the device while a movement settles) run on
+threading.Timer threads, and the results produced by background threads (periodic acquisition, device watcher) are processed directly on those
+threads. An application with an event loop can pass its own functions, e.g. the Qt interface runs everything in the GUI thread.
+
+    call_later(delay, function)
+        Call function() after delay seconds
+    run_in_main_thread(function, *args)
+        Call function(*args) in the thread which owns the controller
+'''
+import os
+import copy
+import json
+import time
+import logging
+import threading
+import collections
+
+from pyThorlabsKCubeKPC101 import driver
+from pyThorlabsKCubeKPC101 import driver_virtual
+from pyThorlabsKCubeKPC101 import acquisition
+from pyThorlabsKCubeKPC101 import history
+from pyThorlabsKCubeKPC101 import recorder
+from pyThorlabsKCubeKPC101 import ramp
+from pyThorlabsKCubeKPC101 import settle
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+
+### Default values of settings (might be overlapped by settings saved in .json files later)
+DEFAULT_SETTINGS = {    'step_size': {
+                                        'position':0.1,
+                                        'voltage':0.5
+                                    },
+                        'mode': 'CloseLoop',
+                        'refresh_time': 0.2,
+                        'history_capacity': 100000,         #Maximum number of samples stored in self.history
+                        'device_list_refresh_time': 5,      #While no device is connected, the list of devices is refreshed every 'device_list_refresh_time' s in background (0 = never)
+                        'polling_rate': 250,                #Interval (in ms) used by Kinesis to poll the device (while idle, if 'adaptive_polling' is True)
+                        'adaptive_polling': False,          #If True, the device is polled every 'polling_rate_moving' ms during movements and ramps
+                        'polling_rate_moving': 20,
+                        'polling_idle_delay': 1.0,          #With adaptive polling, the interval goes back to 'polling_rate' when the device has been idle for this time (in s)
+                        'settle' : {                        #Parameters of the settle detection, see self.watch_settle() and settle.settle_detector
+                                    'initial_interval': 0.005,      #Interval (in s) between the first polls after a movement is started
+                                    'max_interval': 0.1,            #Maximum interval (in s) between polls
+                                    'backoff': 1.5,                 #Factor by which the interval is increased after each poll
+                                    'tolerance': 0,                 #If > 0, the movement ends when |value - target| < tolerance for 'numb_samples' polls (instead of using the busy flag of the device)
+                                    'numb_samples': 3,
+                                    'timeout': 30                   #Maximum time (in s) to wait for a movement to end (0 = no timeout)
+                                    },
+                        'ramp' : {
+                                    'ramp_step_size': 1,            #Increment value of each ramp step
+                                    'ramp_wait_1': 1,               #Wait time (in s) after each ramp step
+                                    'ramp_send_trigger' : True,     #If true, the function self.func_trigger is called after each 'movement'
+                                    'ramp_wait_2': 1,               #Wait time (in s) after each (potential) call to trigger, before doing the new ramp step
+                                    'ramp_numb_steps': 10,          #Number of steps in the ramp
+                                    'ramp_repeat': 1,               #How many times the ramp is repeated
+                                    'ramp_reverse': 1,              #If True (or 1), it repeates the ramp in reverse
+                                    'ramp_send_initial_trigger': 1, #If True (or 1), it calls self.func_trigger before starting the ramp
+                                    'ramp_reset' : 1                #If True (or 1), it resets the value of the instrument to the initial one after the ramp is done
+                                    }
+                        }
+
+def _call_later_with_timer(delay, function):
+    timer = threading.Timer(delay, function)
+    timer.daemon = True
+    timer.start()
+
+def _run_directly(function, *args):
+    function(*args)
+
+class controller():
+    '''
+    Parameters
+    ----------
+    instrument
+        Driver object. If None, a driver.pyThorlabsKCubeKPC101 (or a driver_virtual.pyThorlabsKCubeKPC101, if virtual = True) is created with the given backend
+    settings : dict
+        If specified, this dictionary is used (and modified in place) as settings, and config_file and config_dict are ignored
+    config_file : str
+        JSON file from which settings are loaded, and where they are saved by save_settings() (default = config.json in the package folder). None = do not use any file
+    config_dict : dict
+        If specified, settings are loaded from this dictionary instead of config_file
+    logger
+        logging.Logger object (default = logging.getLogger('pyThorlabsKCubeKPC101'))
+    call_later, run_in_main_thread
+        See module docstring
+
+    Attributes
+    ----------
+    instrument
+        Driver object
+    output : dict
+        Last position and voltage read from the device
+    history
+        Instance of history.history_buffer, it stores the last self.settings['history_capacity'] states read from the device
+    acquisition
+        Instance of acquisition.acquisition_worker, which periodically reads the device (see update())
+    device_watcher
+        Instance of acquisition.acquisition_worker, which periodically enumerates the devices while no device is connected
+    '''
+    # Identifier codes passed to the callbacks. Same values as the codes used by abstract_instrument_interface
+    SIG_CONNECTED = 1
+    SIG_CONNECTING = 2
+    SIG_DISCONNECTED = 3
+    SIG_DISCONNECTING = 4
+    SIG_MOVEMENT_STARTED = 1
+    SIG_MOVEMENT_ENDED = 2
+    SIG_RAMP_STARTED = 1
+    SIG_RAMP_ENDED = 2
+
+    def __init__(self, instrument = None, backend = None, virtual = False, settings = None, config_file = CONFIG_FILE, config_dict = None,
+                 logger = None, call_later = None, run_in_main_thread = None):
+        self.logger = logger if logger else logging.getLogger(__package__)
+        self.call_later = call_later if call_later else _call_later_with_timer
+        self.run_in_main_thread = run_in_main_thread if run_in_main_thread else _run_directly
+        self.callbacks = collections.defaultdict(list)
+        self.config_file = config_file
+        if settings is not None:
+            self.settings = settings
+        else:
+            self.settings = copy.deepcopy(DEFAULT_SETTINGS)
+            if not config_dict and config_file:
+                try:
+                    with open(config_file) as jsonfile:
+                        config_dict = json.load(jsonfile)
+                except Exception:
+                    self.logger.info(f"Error when loading file \'{config_file}\'.")
+            if config_dict:
+                self.load_settings(config_dict)
+        self.output = {'Position':0,'Voltage':0}
+        self.list_devices = []              #list of devices found
+        self.last_settle_time = None        #Time (in s) needed by the last movement to settle
+        self.connected_device_name = ''
+        self.continuous_read = True
+        self._units = {'position':'um','voltage':'V'}
+        self._possible_quantities_to_control = ['position', 'voltage']
+        self._movement_ended = threading.Event()
+        self._movement_ended.set()
+        self._polling_generation = 0   # Incremented at every change of movement state, used to cancel pending switches to the idle polling rate
+        self._settle_generation = 0    # Incremented when the device is disconnected, used to cancel the pending polls of the settle detection
+        self._command_queue = collections.deque()   # Pending commands (see self.submit_command), each one is a list [kind, value]
+        self._command_lock = threading.Lock()
+        self._command_in_flight = False             # True while a command is being executed (i.e. until its movement has settled)
+        self.reset_command_stats()
+
+        if instrument:
+            self.instrument = instrument
+        elif virtual:
+            self.instrument = driver_virtual.pyThorlabsKCubeKPC101(backend=backend)
+        else:
+            self.instrument = driver.pyThorlabsKCubeKPC101(backend=backend)
+
+        # Background acquisition worker, which periodically reads the state of the device on a separate thread (see self.update)
+        self._acquisition_sends_trigger = False
+        self.acquisition = acquisition.acquisition_worker(func_acquire = self.instrument.snapshot,
+                                                          period = self.settings['refresh_time'],
+                                                          lock = self.instrument.lock,
+                                                          callback = lambda state: self.run_in_main_thread(self.on_state_acquired, state),
+                                                          on_error = lambda e: self.logger.error(f"Error while reading the device: {e}"))
+        self.history = history.history_buffer(capacity = self.settings['history_capacity'])
+        self.recorder = None    # Streaming recorder (see self.start_recording), which stores every state read from the device in a file
+
+        # Ramp engine (see self.start_ramp), which sends the absolute set points of the ramp on a separate thread
+        self.ramp_engine = ramp.ramp_engine(func_set_value = self.set_ramp_value,
+                                            func_read_value = self.read_ramp_value,
+                                            func_wait_step_ended = self.wait_ramp_step_ended,
+                                            func_trigger = lambda: self.update(do_not_repeat = True),
+                                            func_step_ended = lambda: self.end_movement(send_signal = False),
+                                            on_started = self._on_ramp_started,
+                                            on_ended = self._on_ramp_ended,
+                                            logger = self.logger)
+
+        # Device watcher, which periodically enumerates the devices on a separate thread (only while no device is connected),
+        # to detect devices which are plugged in or unplugged
+        self.device_watcher = acquisition.acquisition_worker(func_acquire = self._refresh_device_list_in_background,
+                                                             period = self.settings['device_list_refresh_time'] or 1,
+                                                             callback = lambda result: self.run_in_main_thread(self.on_device_list_refreshed, result),
+                                                             on_error = lambda e: self.logger.error(f"Error while looking for devices: {e}"))
+
+    ## Callbacks
+    def subscribe(self, event, function):
+        self.callbacks[event].append(function)
+
+    def unsubscribe(self, event, function):
+        if function in self.callbacks[event]:
+            self.callbacks[event].remove(function)
+
+    def emit(self, event, *args):
+        for function in list(self.callbacks[event]):
+            try:
+                function(*args)
+            except Exception as e:
+                self.logger.error(f"Error in a callback of the event '{event}': {e}")
+
+    ## Settings
+    def load_settings(self, dictionary):
+        self.settings.update(dictionary)
+
+    def save_settings(self):
+        if self.config_file:
+            self.logger.info(f"Storing current settings for this device into the file \'{self.config_file}\'...")
+            try:
+                with open(self.config_file, 'w') as fp:
+                    json.dump(self.settings, fp, indent=4, sort_keys=True)
+            except Exception as e:
+                self.logger.error(f"An error occurred while saving settings in the config.json file: {e}")
+
+    ## Devices and connection
+    def refresh_list_devices(self, force = False):
+        '''
+        Get a list of all devices connected, by using the method list_devices() of the driver. For each device obtain its identity and its address.
+        If force = False, the list found by a recent enumeration (see driver.pyThorlabsKCubeKPC101.enumeration_ttl) is reused, if available.
+        '''
+        self.logger.info(f"Looking for devices...")
+        list_valid_devices = self.instrument.list_devices(max_age = 0 if force else None)
+        self.logger.info(f"Found {len(list_valid_devices)} devices.")
+        self.list_devices = list_valid_devices
+        self.send_list_devices()
+        return self.list_devices
+
+    def send_list_devices(self):
+        self.emit('list_devices_updated', self.list_devices)
+
+    def start_device_watcher(self):
+        if self.settings['device_list_refresh_time'] and not (self.instrument.connected):
+            self.device_watcher.set_period(self.settings['device_list_refresh_time'])
+            self.device_watcher.start()
+
+    def stop_device_watcher(self):
+        self.device_watcher.stop()
+
+    def _refresh_device_list_in_background(self):
+        # Called by the device watcher (on its thread). The cache is shared with other interfaces, so the devices are enumerated only if no one
+        # else has done it during the last period
+        return self.instrument.device_list_cache.refresh(max_age = 0.9 * self.device_watcher.period)
+
+    def on_device_list_refreshed(self, result):
+        # Called every time that the device watcher has enumerated the devices
+        list_valid_devices = result[0]
+        added = [sn for sn in list_valid_devices if not (sn in self.list_devices)]
+        removed = [sn for sn in self.list_devices if not (sn in list_valid_devices)]
+        self.instrument.list_valid_devices = list_valid_devices
+        if added or removed:
+            if added:
+                self.logger.info(f"Device(s) plugged in: {', '.join(added)}.")
+            if removed:
+                self.logger.info(f"Device(s) unplugged: {', '.join(removed)}.")
+            self.list_devices = list_valid_devices
+            self.emit('list_devices_changed', added, removed)
+            self.send_list_devices()
+
+    def connect_device(self, device_full_name):
+        '''
+        device_full_name
+            Serial number of device to connect to
+
+        Returns True if the connection was successful
+        '''
+        if(device_full_name==''): # Check  that the name is not empty
+            self.logger.error("No valid device has been selected")
+            return False
+        self.stop_device_watcher()
+        self.set_connecting_state()
+        device_sn = device_full_name
+        self.logger.info(f"Connecting to device {device_sn}...")
+        try:
+            (Msg,ID) = self.instrument.connect_device(device_sn, polling_rate = int(self.settings['polling_rate']))
+            if(ID==1):  #If connection was successful
+                self.logger.info(f"Connected to device {device_sn}.")
+                self.connected_device_name = device_sn
+                self.set_connected_state()
+                return True
+            else: #If connection was not successful
+                self.logger.error(f"Error: {Msg}")
+                self.set_disconnected_state()
+        except Exception as e:
+            self.logger.error(f"Error: {e}")
+            self.set_disconnected_state()
+        return False
+
+    def disconnect_device(self):
+        self.logger.info(f"Disconnecting from device {self.connected_device_name}...")
+        self._settle_generation += 1    # The pending settle polls (if any) are cancelled
+        self._abort_commands()
+        self.stop_ramp()
+        self.stop_acquisition()
+        self.set_disconnecting_state()
+        self.log_polling_report()
+        (Msg,ID) = self.instrument.disconnect_device()
+        if(ID==1): # If disconnection was successful
+            self.logger.info(f"Disconnected from device {self.connected_device_name}.")
+        else: #If disconnection was not successful
+            self.logger.error(f"Error: {Msg}")
+        self.set_disconnected_state()   #When disconnection is not succeful, it is typically because the device alredy lost connection
+                                        #for some reason. In this case, it is still useful to reset to disconnected state
+        return ID == 1
+
+    def close(self, save_settings = True):
+        '''
+        Stop any background activity, disconnect the device (if connected) and save the settings in the config file (if save_settings = True)
+        '''
+        self.stop_ramp()
+        self.stop_acquisition()
+        if self.instrument.connected:
+            self.disconnect_device()
+        self.stop_recording()
+        if save_settings:
+            self.save_settings()
+        self.stop_device_watcher() # Stopped at the end, since disconnecting the device would start it again
+
+    def set_disconnecting_state(self):
+        self.emit('connected', self.SIG_DISCONNECTING)
+
+    def set_connecting_state(self):
+        self.emit('connected', self.SIG_CONNECTING)
+
+    def set_disconnected_state(self):
+        self.emit('connected', self.SIG_DISCONNECTED)
+        self.start_device_watcher()
+
+    def set_connected_state(self):
+        self.emit('connected', self.SIG_CONNECTED)
+        time_start = time.perf_counter()
+        self.logger.info(f"Setting parameters (based on values in config.json file)... ")
+        self.logger.info(f"{self.settings['step_size']}")
+        # NOTE: the driver does not write step sizes or mode to the device when they already have the requested values. Changes are saved
+        # to the device memory only once, at the end of the transaction
+        with self.instrument.settings_transaction():
+            self.set_step_size('position',self.settings['step_size']['position'])
+            self.set_step_size('voltage',self.settings['step_size']['voltage'])
+            self.get_step_size() #we re-read them again from the device
+            self.set_mode(self.settings['mode'])
+        # NOTE: the call to self_set_mode also calls read_state() (if the change of mode was succesful)
+
+        self.update(send_trigger = False)
+        # Time (in s) spent in each phase of the connection, see also driver.pyThorlabsKCubeKPC101.connect_device
+        self.connection_timings = dict(self.instrument.connection_timings)
+        self.connection_timings['interface_settings'] = time.perf_counter() - time_start
+        self.logger.info("Connection timings: " + ", ".join([f"{key} = {value*1e3:.1f} ms" for key, value in self.connection_timings.items()]))
+
+    ## Movements
+    def set_moving_state(self):
+        self._movement_ended.clear()
+        self._update_polling_rate(moving = True)
+        self.emit('moving_status', self.SIG_MOVEMENT_STARTED)
+
+    def set_non_moving_state(self):
+        self._movement_ended.set()
+        self._update_polling_rate(moving = False)
+        self.emit('moving_status', self.SIG_MOVEMENT_ENDED)
+
+    def wait_for_movement(self, timeout = None):
+        '''
+        Block until the current movement (started by set_position, set_voltage or jog) has ended. Returns False if the timeout (in s) expires.
+        Do not call this from the thread which executes the calls scheduled by call_later (e.g. the GUI thread), since it would never return
+        '''
+        return self._movement_ended.wait(timeout)
+
+    def is_device_moving(self):
+        return self.instrument.is_busy
+
+    def is_device_not_moving(self):
+         return not(self.is_device_moving())
+
+    def jog(self, direction:int):
+        # The quantity being jogged (voltage, position or percentage) is automatically decided by the device depending on the piezo mode (CloseLoop vs OpenLoop) and other settings
+        if not ( direction in [-1,1]):
+            self.logger.error(f"Possible value of input parameter 'direction' are +1 (Move Forward) and -1 (Move Backward).")
+            return False
+        return self.submit_command('jog', direction)
+
+    def jog_by(self, step:float):
+        # Move by step (a position in close loop, a voltage in open loop)
+        try:
+            step = float(step)
+        except:
+            self.logger.error(f"Step value must be a valid float number.")
+            return False
+        return self.submit_command('jog_by', step)
+
+    def _create_settle_detector(self, target = None):
+        settings = self.settings['settle']
+        func_read_value = (lambda: self.instrument.position_f) if self.settings['mode'] == 'CloseLoop' else (lambda: self.instrument.voltage_f)
+        return settle.settle_detector(func_is_busy = self.is_device_moving,
+                                      func_read_value = func_read_value,
+                                      target = target,
+                                      tolerance = settings['tolerance'],
+                                      numb_samples = settings['numb_samples'],
+                                      initial_interval = settings['initial_interval'],
+                                      max_interval = settings['max_interval'],
+                                      backoff = settings['backoff'],
+                                      timeout = settings['timeout'] if settings['timeout'] > 0 else None)
+
+    def watch_settle(self, target = None):
+        '''
+        Check periodically, without blocking, whether the current movement has ended (see settle.settle_detector). The device is polled
+        frequently right after the movement has started, and less and less frequently afterwards (see self.settings['settle']).
+        When the movement has ended, self.end_movement() is called, and the time needed to settle is stored in self.last_settle_time.
+
+        target
+            Target position (in close loop) or voltage (in open loop) of the movement. It is used only if self.settings['settle']['tolerance'] > 0
+        '''
+        self._poll_settle(self._create_settle_detector(target))
+
+    def _poll_settle(self, detector, on_settled = None, on_error = None, generation = None):
+        # on_settled is called when the movement has ended. If None, self.end_movement is called. If polling the device fails (e.g. it was
+        # disconnected), on_error is called (if None, the movement is considered ended). The poll is cancelled if the device has been disconnected in the meanwhile
+        if generation is None:
+            generation = self._settle_generation
+        elif generation != self._settle_generation:
+            return
+        try:
+            settled = detector.poll()
+            if settled:
+                self._log_settle(detector)
+                (on_settled if on_settled else self.end_movement)()
+        except Exception as e:
+            self.logger.error(f"Error while waiting for the movement to end: {e}")
+            (on_error if on_error else self.set_non_moving_state)()
+            return
+        if not settled:
+            self.call_later(detector.next_interval, lambda: self._poll_settle(detector, on_settled, on_error, generation))
+
+    def _log_settle(self, detector):
+        self.last_settle_time = detector.time_to_settle
+        if detector.timed_out:
+            self.logger.error(f"The movement did not end within {detector.timeout} s.")
+        else:
+            self.logger.info(f"Movement settled in {detector.time_to_settle:.3f} s.")
+
+    def end_movement(self,send_signal = True):
+        # When send_signal = False, the method self.set_non_moving_state() is NOT called, which means the event 'moving_status' is not emitted
+        # This is useful, e.g., when doing a ramp, when at each step of the ramp we want to read the position but we do not want to notify that the movement has ended
+        self.read_state()
+        self.logger.info(f"Movement ended. New position = {self.output['Position']}. New voltage = {self.output['Voltage']}")
+        if send_signal:
+            self.set_non_moving_state()
+
+    def set_position(self,position):
+        try:
+            position = float(position)
+        except:
+            self.logger.error(f"Position value must be a valid float number.")
+            return False
+        return self.submit_command('position', position)
+
+    def set_voltage(self,voltage):
+        try:
+            voltage = float(voltage)
+        except:
+            self.logger.error(f"Voltage value must be a valid float number.")
+            return False
+        return self.submit_command('voltage', voltage)
+
+    ## Command queue. Movements (set_position, set_voltage, jog, jog_by) are executed one at a time: a command is sent to the device only when the
+    ## movement of the previous one has settled, and a single settle watcher is active at any time. While a movement is in progress, new commands
+    ## are queued and coalesced: an absolute set point replaces all pending commands, and consecutive jog_by steps are merged into a single step
+    ## (a jog_by following a pending absolute set point is added to it). Commands can be submitted from any thread.
+    def reset_command_stats(self):
+        self._command_stats = {'numb_submitted': 0, 'numb_executed': 0, 'numb_dropped': 0, 'max_depth': 0}
+
+    @property
+    def command_queue_stats(self):
+        '''
+        Dictionary with the keys 'depth' (number of pending commands), 'in_flight' (True if a movement is in progress), 'numb_submitted', 'numb_executed',
+        'numb_dropped' (commands which were replaced by, or merged into, a later command) and 'max_depth'
+        '''
+        with self._command_lock:
+            stats = dict(self._command_stats)
+            stats['depth'] = len(self._command_queue)
+            stats['in_flight'] = self._command_in_flight
+        return stats
+
+    def clear_command_queue(self):
+        # Discard all pending commands (the movement in progress, if any, is not affected). Returns the number of discarded commands
+        with self._command_lock:
+            numb_discarded = len(self._command_queue)
+            self._command_stats['numb_dropped'] += numb_discarded
+            self._command_queue.clear()
+        return numb_discarded
+
+    def submit_command(self, kind, value):
+        '''
+        kind
+            Either 'position', 'voltage' (absolute set points), 'jog_by' (value = step) or 'jog' (value = direction, +1 or -1)
+        '''
+        with self._command_lock:
+            queue = self._command_queue
+            self._command_stats['numb_submitted'] += 1
+            if kind in ['position', 'voltage']:
+                self._command_stats['numb_dropped'] += len(queue)
+                queue.clear()
+                queue.append([kind, value])
+            elif (kind == 'jog_by') and queue and (queue[-1][0] in ['jog_by', 'position', 'voltage']):
+                queue[-1][1] += value
+                self._command_stats['numb_dropped'] += 1
+            else:
+                queue.append([kind, value])
+            self._command_stats['max_depth'] = max(self._command_stats['max_depth'], len(queue))
+            start_consumer = not (self._command_in_flight)
+            self._command_in_flight = True
+        if start_consumer:
+            self.set_moving_state()
+            self._execute_next_command()
+        return True
+
+    def _execute_next_command(self):
+        with self._command_lock:
+            if not self._command_queue:
+                self._command_in_flight = False
+                command = None
+            else:
+                command = self._command_queue.popleft()
+                self._command_stats['numb_executed'] += 1
+        if command is None:
+            self.set_non_moving_state()
+            return
+        (kind, value) = command
+        target = None
+        try:
+            if kind == 'position':
+                self.logger.info(f"Moving to {value}...")
+                self.instrument.set_position_f(value)
+                target = value
+            elif kind == 'voltage':
+                self.logger.info(f"Changing voltage to {value}...")
+                self.instrument.set_voltage_f(value)
+                target = value
+            elif kind == 'jog_by':
+                self.logger.info(f"Moving by {value}...")
+                self.instrument.jog_by(value)
+            elif kind == 'jog':
+                self.logger.info(f"Jogging...")
+                self.instrument.jog(value)
+        except Exception as e:
+            self.logger.error(f"Error: {e}")
+            try:
+                self.end_movement(send_signal = False)
+            except Exception as e:
+                self.logger.error(f"Error: {e}")
+                self._abort_commands()
+                return
+            self._execute_next_command()
+            return
+        #Start checking periodically whether the movement has ended. When it has, the next command (if any) is executed
+        self._poll_settle(self._create_settle_detector(target), on_settled = self._on_command_settled, on_error = self._abort_commands)
+
+    def _on_command_settled(self):
+        self.end_movement(send_signal = False)
+        self._execute_next_command()
+
+    def _abort_commands(self):
+        # Discard all pending commands and end the movement in progress (if any), e.g. after an error or when the device is disconnected
+        with self._command_lock:
+            was_in_flight = self._command_in_flight
+            self._command_stats['numb_dropped'] += len(self._command_queue)
+            self._command_queue.clear()
+            self._command_in_flight = False
+        if was_in_flight:
+            self.set_non_moving_state()
+
+    ## Reading
+    def read_state(self):
+        '''
+        Read position, voltage, mode and busy state of the device with a single call to the driver (see driver.pyThorlabsKCubeKPC101.snapshot),
+        store position and voltage in self.output and emit a single 'update_state' event.
+        '''
+        state = self.instrument.snapshot()
+        self.store_state(state)
+        self.output['Position'] = state.position
+        self.output['Voltage'] = state.voltage
+        self.emit('update_state', state)
+        return state
+
+    def read_position(self):
+        self.output['Position'] = self.instrument.position_f
+        self.emit('update_position', self.output['Position'])
+        return self.output['Position']
+
+    def read_voltage(self):
+        self.output['Voltage'] = self.instrument.voltage_f
+        self.emit('update_voltage', self.output['Voltage'])
+        return self.output['Voltage']
+
+    ## Settings of the device
+    def set_refresh_time(self, refresh_time):
+        try:
+            refresh_time = float(refresh_time)
+            if self.settings['refresh_time'] == refresh_time: #in this case the number in the refresh time edit box is the same as the refresh time currently stored
+                return True
+        except ValueError:
+            self.logger.error(f"The refresh time must be a valid number.")
+            self.emit('refresh_time', self.settings['refresh_time'])
+            return False
+        if refresh_time < 0.1:
+            self.logger.error(f"The refresh time must be positive and >= 0.1s.")
+            self.emit('refresh_time', self.settings['refresh_time'])
+            return False
+        self.logger.info(f"The refresh time is now {refresh_time} s.")
+        self.settings['refresh_time'] = refresh_time
+        self.acquisition.set_period(refresh_time)
+        self.emit('refresh_time', self.settings['refresh_time'])
+        return True
+
+    ## Polling of the device (see driver.pyThorlabsKCubeKPC101.set_polling_rate)
+    def set_polling_rate(self, polling_rate):
+        '''
+        Set the interval (in ms) used by Kinesis to poll the device (while idle, if self.settings['adaptive_polling'] is True)
+        '''
+        try:
+            polling_rate = int(polling_rate)
+            if polling_rate <= 0:
+                raise ValueError
+        except ValueError:
+            self.logger.error(f"The polling rate must be a positive integer (in ms).")
+            return False
+        self.settings['polling_rate'] = polling_rate
+        self.logger.info(f"The polling rate is now {polling_rate} ms.")
+        if self.instrument.connected and self._movement_ended.is_set():
+            self._apply_polling_rate(polling_rate)
+        return True
+
+    def set_adaptive_polling(self, adaptive):
+        self.settings['adaptive_polling'] = bool(adaptive)
+        if self.instrument.connected:
+            moving = not self._movement_ended.is_set()
+            self._apply_polling_rate(self.settings['polling_rate_moving'] if (moving and self.settings['adaptive_polling']) else self.settings['polling_rate'])
+
+    def _apply_polling_rate(self, polling_rate):
+        try:
+            if self.instrument.set_polling_rate(polling_rate):
+                self.logger.debug(f"Polling the device every {polling_rate} ms.")
+        except Exception as e:
+            self.logger.error(f"Error while changing the polling rate: {e}")
+
+    def _update_polling_rate(self, moving):
+        # With adaptive polling, the device is polled faster as soon as a movement (or a ramp) starts, and slower once it has been idle for 'polling_idle_delay' s
+        if not (self.settings['adaptive_polling'] and self.instrument.connected):
+            return
+        self._polling_generation += 1
+        if moving:
+            self._apply_polling_rate(self.settings['polling_rate_moving'])
+        else:
+            generation = self._polling_generation
+            self.call_later(self.settings['polling_idle_delay'], lambda: self._on_polling_idle(generation))
+
+    def _on_polling_idle(self, generation):
+        if (generation == self._polling_generation) and self._movement_ended.is_set() and self.instrument.connected:
+            self._apply_polling_rate(self.settings['polling_rate'])
+
+    @property
+    def polling_stats(self):
+        # Time, CPU load and read latency measured with each polling interval, see driver.pyThorlabsKCubeKPC101.polling_report
+        return self.instrument.polling_report() if self.instrument.connected else dict()
+
+    def log_polling_report(self):
+        for polling_rate, stats in self.polling_stats.items():
+            self.logger.info(f"Polling every {polling_rate} ms: time = {stats['time']:.1f} s, CPU load = {100*stats['cpu_load']:.1f} %, "
+                             f"reads = {stats['numb_reads']}, mean read latency = {1e3*stats['mean_read_latency']:.3f} ms")
+
+    def get_step_size(self):
+        step_size = self.instrument.jog_steps_f
+        for key, value in step_size.items():
+            self.settings['step_size'][key] = value
+        for key, value in self.settings['step_size'].items():
+            self.emit('step_size_changed', key, value)
+        return self.settings['step_size']
+
+    def set_step_size(self, type:str, step_size:float):
+        '''
+        :param type: Identify the property for which the step size is being changed. Possible values = 'position', 'voltage'
+        :param step_size: Numerical Value of step size
+        '''
+        if not ( type in self._possible_quantities_to_control):
+            self.logger.error(f"Possible value of input parameter 'type' are {self._possible_quantities_to_control}.")
+            return False
+        try:
+            step_size = float(step_size)
+        except ValueError:
+            self.logger.error(f"The step size must be a valid float number.")
+            self.emit('step_size_changed', type, self.settings['step_size'][type])
+            return False
+        try:
+            self.logger.info(f"Changing step size for {type} to {step_size} {self._units[type]}...")
+            self.instrument.set_jog_steps(**{type: step_size})
+            self.logger.info(f"The step size for {type} has been set to {step_size} {self._units[type]}.")
+            self.settings['step_size'][type] = step_size
+            self.emit('step_size_changed', type, self.settings['step_size'][type])
+            return True
+        except Exception as e:
+            self.logger.error(f"Error: {e}")
+            return False
+
+    def get_mode(self):
+        self.settings['mode'] = self.instrument.mode
+        self.emit('mode_changed', self.settings['mode'])
+        return self.settings['mode']
+
+    def set_mode(self,mode:str):
+        # Possible values for variable mode are 'OpenLoop' and 'CloseLoop'
+        self.logger.info(f"Setting mode to {mode}...")
+        try:
+            self.instrument.mode = mode
+            self.logger.info(f"Mode changed correctly to {mode}.")
+            self.settings['mode'] = mode
+            self.emit('mode_changed', self.settings['mode'])
+            self.read_state()
+            return mode
+        except:
+            self.logger.error(f"Some error occurred when changing the device mode (see logs).")
+            return None
+
+    def set_zero(self):
+        self.logger.info(f"Zeroing device...")
+        try:
+            self.instrument.set_zero()
+            self.emit('device_zeroed')
+            self.logger.info(f"Device has been zeroed correctly")
+            self.set_mode('OpenLoop')
+            self.set_mode('CloseLoop')
+            return True
+        except:
+            self.logger.error(f"Some error occurred when zeroing the device.")
+            return None
+
+    ## Periodic reading
+    def send_trigger(self):
+        self.emit('trigger')
+
+    def update(self, send_trigger = True, do_not_repeat = False):
+        '''
+        Reads the position and voltage from the piezo and stores them in self.output (this also emits the event 'update_state'). If send_trigger == True
+        the event 'trigger' is emitted. If self.continuous_read == True and do_not_repeat == False, starts the acquisition worker (self.acquisition),
+        which samples the device on a separate thread, every self.settings['refresh_time'] seconds, and passes each state to self.on_state_acquired
+        '''
+        self.read_state()
+        if send_trigger == True:
+            self.send_trigger()
+        if (self.continuous_read == True and do_not_repeat==False):
+            self.start_acquisition(send_trigger = send_trigger)
+
+    def start_acquisition(self, send_trigger = True):
+        self._acquisition_sends_trigger = send_trigger
+        self.acquisition.set_period(self.settings['refresh_time'])
+        self.acquisition.start()
+
+    def stop_acquisition(self):
+        self.acquisition.stop()
+
+    @property
+    def acquisition_stats(self):
+        # Statistics of the acquisition worker (number of samples, drift and missed deadlines, see acquisition.acquisition_worker)
+        return self.acquisition.stats
+
+    def on_state_acquired(self, state):
+        '''
+        Called (via run_in_main_thread) with each state read by the acquisition worker
+        '''
+        if not (self.instrument.connected):  # The state might have been acquired right before the device was disconnected
+            return
+        self.store_state(state)
+        self.output['Position'] = state.position
+        self.output['Voltage'] = state.voltage
+        self.emit('update_state', state)
+        if self._acquisition_sends_trigger == True:
+            self.send_trigger()
+
+    ## Recording
+    def store_state(self, state):
+        # Store a state read from the device in self.history and (if a recording is active) in self.recorder
+        self.history.append_snapshot(state)
+        recorder_object = self.recorder
+        if recorder_object:
+            try:
+                recorder_object.append_snapshot(state)
+            except Exception:
+                # Writing to the file failed (the error has already been logged by the recorder)
+                self.stop_recording()
+
+    def start_recording(self, path, **kwargs):
+        '''
+        Start recording every state read from the device (both by self.read_state and by the acquisition worker) in the file path, see recorder.open_recorder.
+        The keyword arguments (e.g. chunk_size, flush_interval) are passed to the recorder. A recording already in progress is stopped
+        '''
+        self.stop_recording()
+        kwargs.setdefault('logger', self.logger)
+        self.recorder = recorder.open_recorder(path, **kwargs)
+        self.logger.info(f"Recording to {path}.")
+        return self.recorder
+
+    def stop_recording(self):
+        if self.recorder:
+            recorder_object = self.recorder
+            self.recorder = None
+            try:
+                recorder_object.close()
+            except Exception as e:
+                self.logger.error(f"Recording to {recorder_object.path} stopped after an error ({recorder_object.numb_samples_written} samples written): {e}")
+                return
+            self.logger.info(f"Recording to {recorder_object.path} stopped ({recorder_object.numb_samples} samples).")
+
+    @property
+    def is_recording(self):
+        return self.recorder is not None
+
+    ## Ramps
+    def start_ramp(self, blocking = False):
+        '''
+        Do a ramp, as defined by self.settings['ramp'] (same settings used by abstract_instrument_interface.ramp), see ramp.ramp_engine.
+        Each step sends an absolute set point (position or voltage, depending on the mode) and waits until the movement has settled.
+        The ramp runs on a separate thread, unless blocking = True
+        '''
+        if self.doing_ramp:
+            self.logger.error(f"A ramp is already running.")
+            return False
+        return self.ramp_engine.start(self.settings['ramp'], blocking = blocking)
+
+    def stop_ramp(self, timeout = 5):
+        self.ramp_engine.stop(timeout = timeout)
+
+    @property
+    def doing_ramp(self):
+        return self.ramp_engine.doing_ramp
+
+    @property
+    def numb_steps_done(self):
+        return self.ramp_engine.numb_steps_done
+
+    @property
+    def numb_steps_total(self):
+        return self.ramp_engine.numb_steps_total
+
+    @property
+    def ramp_stats(self):
+        # Requested and achieved step rate of the current (or last) ramp, see ramp.ramp_engine.stats
+        return self.ramp_engine.stats
+
+    def is_doing_ramp(self):
+        return self.doing_ramp
+
+    def is_not_doing_ramp(self):
+        return not(self.is_doing_ramp())
+
+    def set_ramp_value(self, value):
+        # Absolute set point of a ramp step: position in close loop, voltage in open loop. The value is clipped to the limits of the device, since
+        # set points computed from a noisy initial reading (e.g. a position slightly below 0) could otherwise fall out of range
+        if self.settings['mode'] == 'CloseLoop':
+            (min_value, max_value) = self.instrument.position_limits_f
+            self.instrument.set_position_f(min(max(value, min_value), max_value))
+        else:
+            (min_value, max_value) = self.instrument.voltage_limits_f
+            self.instrument.set_voltage_f(min(max(value, min_value), max_value))
+
+    def read_ramp_value(self):
+        return self.instrument.position_f if self.settings['mode'] == 'CloseLoop' else self.instrument.voltage_f
+
+    def wait_ramp_step_ended(self, target = None, stop_event = None):
+        '''
+        Block until the movement towards target has settled (see self._create_settle_detector), or until stop_event is set
+        '''
+        stop_event = stop_event or threading.Event()
+        detector = self._create_settle_detector(target)
+        while not (detector.poll() or stop_event.is_set()):
+            stop_event.wait(detector.next_interval)
+        if detector.settled:
+            self.last_settle_time = detector.time_to_settle
+            if detector.timed_out:
+                self.logger.error(f"The movement did not end within {detector.timeout} s.")
+
+    def _on_ramp_started(self):
+        self.set_moving_state()
+        self.emit('ramp', self.SIG_RAMP_STARTED)
+
+    def _on_ramp_ended(self):
+        self.emit('ramp', self.SIG_RAMP_ENDED)
+        self.set_non_moving_state()
@@ -1,30 +1,85 @@
 import os
 import time
 import sys
-import clr
 import warnings
+import collections
+import threading
+import functools
+import contextlib
+import numpy as np
 
-clr.AddReference("C:\\Program Files\\Thorlabs\\Kinesis\\Thorlabs.MotionControl.DeviceManagerCLI.dll")
-clr.AddReference("C:\\Program Files\\Thorlabs\\Kinesis\\Thorlabs.MotionControl.GenericMotorCLI.dll")
-clr.AddReference("C:\\Program Files\\Thorlabs\\Kinesis\\Thorlabs.MotionControl.GenericPiezoCLI.dll")
-clr.AddReference("C:\\Program Files\\Thorlabs\\Kinesis\\ThorLabs.MotionControl.KCube.PiezoStrainGaugeCLI.dll")
+from pyThorlabsKCubeKPC101 import backends
+from pyThorlabsKCubeKPC101 import settle
+from pyThorlabsKCubeKPC101 import instrumentation
+from pyThorlabsKCubeKPC101 import enumeration
+from pyThorlabsKCubeKPC101 import hysteresis
+from pyThorlabsKCubeKPC101 import feedback
+from pyThorlabsKCubeKPC101 import trajectory
 
-import Thorlabs.MotionControl.DeviceManagerCLI as DevManCLI
-#from Thorlabs.MotionControl.GenericMotorCLI import *
-import Thorlabs.MotionControl.GenericPiezoCLI as GenPieCLI
-import Thorlabs.MotionControl.KCube.PiezoStrainGaugeCLI as PieStrGauCLI
-from System import Decimal  # necessary for real world units
+# Record returned by pyThorlabsKCubeKPC101.snapshot(). timestamp is given by time.time(), position (um) and voltage (V) are floats, 
+# mode is either 'OpenLoop' or 'CloseLoop', busy is True if the device is moving
+state_snapshot = collections.namedtuple('state_snapshot', ['timestamp', 'position', 'voltage', 'mode', 'busy'])
+
+# dtype of the structured array returned by pyThorlabsKCubeKPC101.run_trajectory(). 'commanded' is the set point (position in close loop, voltage in open loop),
+# 'position' and 'voltage' are measured at the end of the dwell time, 't_command' and 't_measured' are in s from the start of the trajectory
+trajectory_dtype = np.dtype([('commanded', 'f8'), ('position', 'f8'), ('voltage', 'f8'), ('t_command', 'f8'), ('t_measured', 'f8')])
+
+def sleep_until(deadline, spin_time = 0.002):
+    # Wait until time.perf_counter() >= deadline. The last spin_time seconds are spent busy-waiting, since time.sleep() alone is not precise enough
+    remaining = deadline - time.perf_counter()
+    if remaining > spin_time:
+        time.sleep(remaining - spin_time)
+    while time.perf_counter() < deadline:
+        pass
+
+def locked(func):
+    # Decorator for methods of pyThorlabsKCubeKPC101 which access the device. The method is executed while holding the lock self.lock, so that
+    # the device is never accessed by two threads at the same time (e.g. the GUI thread and a background acquisition thread)
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+    return wrapper
 
 class pyThorlabsKCubeKPC101():
 
-    def __init__(self,model=None):
+    def __init__(self,model=None,backend=None):
+        '''
+        backend
+            Object used to enumerate and create devices (see backends.py). If None, a backends.kinesis_backend is created, which 
+            loads the Kinesis .NET assemblies only when devices are enumerated or connected for the first time
+        '''
+        self.backend = backend if backend else backends.kinesis_backend()
         self.connected = False
+        self.lock = threading.RLock()  # Held while the device is being accessed (see the decorator locked). Re-entrant, so it can also be held by external code around several calls
+        self.enumeration_ttl = 5.0  # Maximum age (in s) of the cached list of devices used by list_devices() (see enumeration.py)
+        self.use_cache = True   # If False, the settings cache is bypassed and every setting is read from the device each time it is needed
+        self._cache = dict()    # Settings cache (limits, mode, jog steps), filled by read_settings_from_device() and invalidated by invalidate_cache()
+        self.last_settle_time = None  # Time (in s) needed by the last movement to settle, see wait_until_settled()
+        self.instrumentation = None   # instrumentation.call_statistics object when instrumentation is enabled, see enable_instrumentation()
+        self.persist_delay = 1.0      # Settings changes are saved to the device memory after this idle time (in s). None = save after every change, see persist_settings()
+        self.settings_pending = False # True if some settings have been changed but not yet saved to the device memory
+        self.numb_persists = 0        # Number of times the settings have been saved to the device memory
+        self._persist_timer = None
+        self._transaction_depth = 0
+        self.default_polling_rate = 250  # Interval (in ms) used by Kinesis to poll the device, when connect_device() is called without polling_rate
+        self.polling_rate = None      # Interval (in ms) currently used by Kinesis to poll the device, see set_polling_rate()
+        self.polling_stats = dict()   # For each polling interval used, time spent, CPU time of the process and reads done, see polling_report()
+        self._polling_period_start = None
+        self.hysteresis_model = None  # hysteresis.hysteresis_model used by set_position_open_loop(), see calibrate_open_loop()
+        self.feedback = None          # feedback.feedback_loop started by start_feedback()
         self.units_position = 'um'
         self.units_voltage = 'V'
 
-    def list_devices(self):
+    @property
+    def device_list_cache(self):
+        # enumeration.device_list_cache shared by all drivers using the same backend
+        return enumeration.get_cache(self.backend, ttl = self.enumeration_ttl)
+
+    def list_devices(self, max_age = None):
         '''
-        Look for any compatible device connectected to the computer
+        Look for any compatible device connectected to the computer. Enumerating the devices is slow, so the list found by the last enumeration
+        is reused if it is not older than max_age seconds (default = self.enumeration_ttl). Use max_age = 0 to force a new enumeration.
 
         Returns
         -------
@@ -32,28 +87,62 @@ class pyThorlabsKCubeKPC101():
             A list of all found valid devices. Each element of the list is the serial number of the device
 
         '''
-        DevManCLI.DeviceManagerCLI.BuildDeviceList()
-        list_valid_devices = list(DevManCLI.DeviceManagerCLI.GetDeviceList())
+        list_valid_devices = self.device_list_cache.get(max_age = self.enumeration_ttl if max_age is None else max_age)
         self.list_valid_devices = list_valid_devices
         return self.list_valid_devices
     
-    def connect_device(self,device_sn):
-        #self.list_devices()
-        device_addresses = [str(dev) for dev in self.list_valid_devices] #This line is not necessary, keep it for consistency / future edits
+    @locked
+    def connect_device(self,device_sn,polling_rate=None,timeout=5,check_serial=True):
+        '''
+        Connect to the device with serial number device_sn. Instead of waiting fixed amounts of time, the device is polled (with a short, increasing interval)
+        until it is enabled and its settings are initialized. The time spent in each phase of the connection is stored in the dictionary self.connection_timings
+
+        polling_rate : int
+            Interval (in ms) used by Kinesis to poll the device (default = self.default_polling_rate). The values returned by the device (position, 
+            voltage, busy flags) are updated only at each poll, so they can be up to polling_rate ms old. See also set_polling_rate()
+        timeout : float
+            Maximum time (in s) to wait for the device to be enabled and for its settings to be initialized
+        check_serial : bool
+            If True, device_sn must be in the list of devices found (if it is not, the devices are enumerated once more before raising an error).
+            If False, the device is connected directly, without enumerating the devices again (they are enumerated only if this was never done before)
+        '''
+        if check_serial:
+            if not hasattr(self, 'list_valid_devices'):
+                self.list_devices()
+            if not (str(device_sn) in [str(dev) for dev in self.list_valid_devices]):
+                self.list_devices(max_age = 0)  # The device might have been plugged in after the last enumeration
+            device_addresses = [str(dev) for dev in self.list_valid_devices]
+        else:
+            self.device_list_cache.get(max_age = float('inf'))
+            device_addresses = [str(device_sn)]
         if (str(device_sn) in device_addresses):     
+            self.invalidate_cache()
+            self.connection_timings = dict()
+            time_start = time.perf_counter()
+            time_last = [time_start]
+            def end_phase(name):
+                now = time.perf_counter()
+                self.connection_timings[name] = now - time_last[0]
+                time_last[0] = now
             try:
-                self.device = PieStrGauCLI.KCubePiezoStrainGauge.CreateKCubePiezoStrainGauge(device_sn)
+                self.device = self.backend.create_device(device_sn)
+                if self.instrumentation:
+                    self.device = instrumentation.instrumented_device(self.device, self.instrumentation)
+                end_phase('create_device')
                 self.device.Connect(device_sn)
                 self.device_sn = device_sn
                 self.device_info = self.device.GetDeviceInfo().Description
-                self.device.StartPolling(250)  #250ms polling rate
-                time.sleep(0.25)
+                end_phase('connect')
+                self.polling_rate = int(polling_rate if polling_rate else self.default_polling_rate)
+                self.device.StartPolling(self.polling_rate)
+                self._start_polling_period()
                 self.device.EnableDevice()
-                time.sleep(0.25)  # Wait for device to enable
-                if not self.device.IsSettingsInitialized():
-                    warnings.warn("Device connected but not yet initialized, will wait 5 more seconds...", UserWarning)
-                    self.device.WaitForSettingsInitialized(5000)  # 10 second timeout
-                    assert self.device.IsSettingsInitialized() is True               
+                if not self.wait_for(lambda: getattr(self.device, 'IsEnabled', True), timeout):
+                    raise RuntimeError(f"Device was not enabled within {timeout} s.")
+                end_phase('enable')
+                if not self.wait_for(self.device.IsSettingsInitialized, timeout):
+                    raise RuntimeError(f"Device settings were not initialized within {timeout} s.")
+                end_phase('settings_initialized')
                 Msg = self.device_sn + ' (' + self.device_info + ')'
                 ID = 1
             except Exception as e:
@@ -64,11 +153,28 @@ class pyThorlabsKCubeKPC101():
         if(ID==1):
             self.connected = True
             self.read_settings_from_device() #Read all settings. Also make sure this is is ran at least once, to initialize the variable self._mode
+            end_phase('read_settings')
+            self.connection_timings['total'] = time.perf_counter() - time_start
         return (Msg,ID)
 
+    @staticmethod
+    def wait_for(condition, timeout, initial_interval = 0.005, max_interval = 0.05, backoff = 1.5):
+        '''
+        Wait until the function condition() returns True, checking it with a short (but increasing) interval. Returns False if the timeout (in s) expires
+        '''
+        detector = settle.settle_detector(func_is_busy = lambda: not condition(), initial_interval = initial_interval, max_interval = max_interval,
+                                          backoff = backoff, timeout = timeout)
+        detector.wait()
+        return not detector.timed_out
+
+    @locked
     def disconnect_device(self):
         if(self.connected == True):
             try:   
+                if self.feedback:
+                    self.feedback.stop(wait = False)    # The loop cannot be awaited here, since it needs self.lock
+                self.persist_settings()
+                self._end_polling_period()
                 self.device.StopPolling()
                 self.device.Disconnect()
                 ID = 1
@@ -78,6 +184,8 @@ class pyThorlabsKCubeKPC101():
                 Msg = e
             if(ID==1):
                 self.connected = False
+                self.polling_rate = None
+                self.invalidate_cache()
             return (Msg,ID)
         else:
             raise RuntimeError("No device currently connected.")
@@ -86,50 +194,263 @@ class pyThorlabsKCubeKPC101():
         if not(self.connected):
             raise RuntimeError("No device is currently connected.")
 
+    ## Polling. Kinesis polls the device every polling_rate ms on a background thread, and the getters (GetPosition, IsSetPositionActive, ...) return 
+    ## the values read by the last poll. A short interval gives fresher values (and faster settle detection), at the cost of more USB traffic 
+    ## and CPU load. The time spent with each interval, the CPU time used by the process and the latency of the reads are stored in self.polling_stats
+    @locked
+    def set_polling_rate(self, polling_rate):
+        '''
+        Change the interval (in ms) used by Kinesis to poll the device. Returns False if the device was already polled with this interval
+        '''
+        self.check_valid_connection()
+        polling_rate = int(polling_rate)
+        if polling_rate <= 0:
+            raise ValueError("The polling rate must be a positive number of ms.")
+        if polling_rate == self.polling_rate:
+            return False
+        self._end_polling_period()
+        self.device.StopPolling()
+        self.device.StartPolling(polling_rate)
+        self.polling_rate = polling_rate
+        self._start_polling_period()
+        return True
+
+    def _start_polling_period(self):
+        self._polling_period_start = (time.perf_counter(), time.process_time())
+        stats = self.polling_stats.setdefault(self.polling_rate, {'time': 0.0, 'cpu_time': 0.0, 'numb_reads': 0, 'read_time': 0.0, 'numb_periods': 0})
+        stats['numb_periods'] += 1
+
+    def _end_polling_period(self):
+        # Add the time (and the CPU time of the process) spent with the current polling interval to self.polling_stats
+        if self._polling_period_start is None:
+            return
+        (wall_start, cpu_start) = self._polling_period_start
+        stats = self.polling_stats[self.polling_rate]
+        stats['time'] += time.perf_counter() - wall_start
+        stats['cpu_time'] += time.process_time() - cpu_start
+        self._polling_period_start = None
+
+    def _record_read(self, duration):
+        stats = self.polling_stats.get(self.polling_rate)
+        if stats:
+            stats['numb_reads'] += 1
+            stats['read_time'] += duration
+
+    @locked
+    def polling_report(self):
+        '''
+        Returns
+        -------
+        dict
+            For each polling interval (in ms) used so far: time spent with this interval (in s), CPU load of the process (CPU time / time, which 
+            includes the polling thread of Kinesis), number of snapshot() reads and their mean latency (in s)
+        '''
+        if self._polling_period_start is not None:  # Include the current period
+            self._end_polling_period()
+            self._start_polling_period()
+            self.polling_stats[self.polling_rate]['numb_periods'] -= 1
+        return {polling_rate: {'time': stats['time'],
+                               'cpu_load': stats['cpu_time'] / stats['time'] if stats['time'] > 0 else float('nan'),
+                               'numb_reads': stats['numb_reads'],
+                               'mean_read_latency': stats['read_time'] / stats['numb_reads'] if stats['numb_reads'] else float('nan'),
+                               'numb_periods': stats['numb_periods']}
+                for polling_rate, stats in sorted(self.polling_stats.items())}
+
+    def measure_polling_overhead(self, polling_rates = (250, 100, 50, 20, 10), duration = 2.0, read_period = 0.01):
+        '''
+        Poll the device with each interval (in ms) in polling_rates for duration s, while reading its state every read_period s, and return
+        the overhead measured with each interval (same format as polling_report()). The original interval is restored at the end, and the
+        measured statistics are added to self.polling_stats
+        '''
+        self.check_valid_connection()
+        original_polling_rate = self.polling_rate
+        with self.lock:
+            self._end_polling_period()
+            original_stats = self.polling_stats
+            self.polling_stats = dict()
+        try:
+            for polling_rate in polling_rates:
+                with self.lock:
+                    if not self.set_polling_rate(polling_rate):  # Same interval used so far
+                        self._start_polling_period()
+                end = time.perf_counter() + duration
+                while time.perf_counter() < end:
+                    self.snapshot()
+                    time.sleep(read_period)
+                with self.lock:
+                    self._end_polling_period()
+            report = self.polling_report()
+        finally:
+            with self.lock:
+                measured_stats = self.polling_stats
+                self.polling_stats = original_stats
+                for polling_rate, stats in measured_stats.items():
+                    target = self.polling_stats.setdefault(polling_rate, {key: 0 for key in stats})
+                    for key, value in stats.items():
+                        target[key] += value
+                if not self.set_polling_rate(original_polling_rate):
+                    self._start_polling_period()
+        return report
+
+    @locked
+    def enable_instrumentation(self, reset = True):
+        '''
+        Start timing every call made to the device (see instrumentation.py). If reset = True, previously collected statistics are discarded.
+        When instrumentation is disabled (default) the device is accessed directly, with no overhead.
+        '''
+        if (self.instrumentation is None) or reset:
+            self.instrumentation = instrumentation.call_statistics()
+        if self.connected:
+            device = self.device.device if isinstance(self.device, instrumentation.instrumented_device) else self.device
+            self.device = instrumentation.instrumented_device(device, self.instrumentation)
+
+    @locked
+    def disable_instrumentation(self):
+        # Stop timing the calls to the device. The statistics collected so far are still available via instrumentation_report()
+        if self.connected and isinstance(self.device, instrumentation.instrumented_device):
+            self.device = self.device.device
+        self._instrumentation_report = self.instrumentation
+        self.instrumentation = None
+
+    def instrumentation_report(self, as_json = False):
+        '''
+        Returns
+        -------
+        dict or str
+            For each method of the device that has been called, number of calls, total/mean/min/max latency (in s), approximate percentiles and latency 
+            histogram (list of [lower_edge, upper_edge, counts]). If as_json = True, the same data is returned as a json string
+        '''
+        statistics = self.instrumentation if self.instrumentation else getattr(self, '_instrumentation_report', None)
+        if statistics is None:
+            return '{}' if as_json else dict()
+        return statistics.to_json() if as_json else statistics.to_dict()
+
+    def _cached(self, key, read_from_device):
+        # Return the value stored in the cache under the key 'key'. If the value is not available (or if self.use_cache = False), the value
+        # is read by calling the function read_from_device and stored in the cache
+        if self.use_cache and (key in self._cache):
+            return self._cache[key]
+        value = read_from_device()
+        self._cache[key] = value
+        return value
+
+    def invalidate_cache(self):
+        # Empty the settings cache, so that each setting will be read again from the device the next time it is needed
+        self._cache.clear()
+
+    @locked
+    def refresh(self):
+        # Discard all cached settings and read them again from the device
+        self.invalidate_cache()
+        self.read_settings_from_device()
+
     @property
+    @locked
     def is_busy(self):
-        # Return true if the device is busy
+        # Return true if the device is busy. The mode is read from the settings cache, so this requires a single call to the device
         self.check_valid_connection()
-        self._mode = self.device.GetPositionControlMode()
-        if (self._mode== self._mode.OpenLoop):
+        mode = self.mode
+        if mode == 'OpenLoop':
             return self.device.IsSetOutputVoltageActive()
-        if (self._mode== self._mode.CloseLoop):
+        if mode == 'CloseLoop':
             return self.device.IsSetPositionActive()
         return False
 
+    def wait_until_settled(self, target = None, tolerance = None, numb_samples = 3, timeout = None, **kwargs):
+        '''
+        Block until the current movement has ended (see settle.settle_detector). The device is polled adaptively, quickly right after the command and
+        then less and less frequently. The lock self.lock is not held while waiting, so other threads can access the device in the meanwhile.
+
+        target, tolerance, numb_samples
+            If target and tolerance are specified, the movement is considered ended when the position (in close loop) or the voltage (in open loop) 
+            stays within tolerance from target for numb_samples consecutive polls. Otherwise, the busy flag of the device is used.
+        timeout
+            Maximum waiting time, in s (None = no timeout)
+        kwargs
+            Additional parameters of settle.settle_detector (initial_interval, max_interval, backoff)
+
+        Returns
+        -------
+        float
+            Time needed by the movement to settle (in s), also stored in self.last_settle_time
+        '''
+        func_read_value = (lambda: self.position_f) if self.mode == 'CloseLoop' else (lambda: self.voltage_f)
+        detector = settle.settle_detector(func_is_busy = lambda: self.is_busy, func_read_value = func_read_value, target = target, tolerance = tolerance,
+                                          numb_samples = numb_samples, timeout = timeout, **kwargs)
+        self.last_settle_time = detector.wait()
+        if detector.timed_out:
+            warnings.warn(f"The movement did not settle within {timeout} s.", UserWarning)
+        return self.last_settle_time
+
+    @locked
+    def snapshot(self):
+        '''
+        Read position, voltage, mode and busy state of the device in a single call
+
+        Returns
+        -------
+        state_snapshot
+            namedtuple with fields (timestamp, position, voltage, mode, busy)
+        '''
+        self.check_valid_connection()
+        timestamp = time.time()
+        start = time.perf_counter()
+        mode = self.mode
+        position = self.backend.to_float(self.device.GetPosition())
+        voltage = self.backend.to_float(self.device.GetOutputVoltage())
+        if mode == 'OpenLoop':
+            busy = self.device.IsSetOutputVoltageActive()
+        elif mode == 'CloseLoop':
+            busy = self.device.IsSetPositionActive()
+        else:
+            busy = False
+        self._record_read(time.perf_counter() - start)
+        return state_snapshot(timestamp, position, voltage, mode, bool(busy))
+
     @property
+    @locked
     def mode(self):
         if not(self.connected):
             return None
-        self._mode = self.device.GetPositionControlMode()
+        self._mode = self._cached('mode', self.device.GetPositionControlMode)
         if (self._mode== self._mode.OpenLoop):
             return "OpenLoop"
         if (self._mode== self._mode.CloseLoop):
             return "CloseLoop"
 
     @mode.setter
+    @locked
     def mode(self, new_mode):
         #Input variable new_mode is a string, we can be either "CloseLoop" or "OpenLoop"
         self.check_valid_connection()
         if new_mode in ['OpenLoop','CloseLoop']:
+            if new_mode == self.mode:  # Nothing to write, the device is already in the requested mode
+                return self._mode
             if new_mode == 'OpenLoop':
                 self.device.SetPositionControlMode(self._mode.OpenLoop)
             if new_mode == 'CloseLoop':
                 self.device.SetPositionControlMode(self._mode.CloseLoop)
-            self._mode = self.device.GetPositionControlMode()
+            self.invalidate_cache()
+            self._mode = self._cached('mode', self.device.GetPositionControlMode)
+            if self.hysteresis_model:
+                self.hysteresis_model.reset()   # The open loop set point now depends on the position reached in the previous mode
+            self._settings_changed()
         else: 
             raise ValueError(f"Input parameter must be equal to either CloseLoop or OpenLoop")
         return self._mode
 
     @property
+    @locked
     def position(self):
         self.check_valid_connection()
         self._position = self.device.GetPosition()
         return self._position
     
     @position.setter
+    @locked
     def position(self,pos):
         self.check_valid_connection()
+        Decimal = self.backend.Decimal
         current_mode = self.mode
         if current_mode == 'CloseLoop':
             try:
@@ -146,14 +467,17 @@ class pyThorlabsKCubeKPC101():
         return self.position
     
     @property
+    @locked
     def voltage(self):
         self.check_valid_connection()
         self._voltage = self.device.GetOutputVoltage()
         return self._voltage
     
     @voltage.setter
+    @locked
     def voltage(self,volt):
         self.check_valid_connection()
+        Decimal = self.backend.Decimal
         current_mode = self.mode
         if current_mode == 'OpenLoop':
             try:
@@ -169,47 +493,188 @@ class pyThorlabsKCubeKPC101():
             raise RuntimeError("Cannot set a voltage value when the device is in close loop. Set a position instead.")
         return self.voltage
     
+    ## Native-float versions of the getters and setters defined above. They avoid the float -> str -> float round trip and the Decimal type checks,
+    ## and use the cheapest conversion between Decimal and float allowed by the backend (see backends.py). Limits are compared as (cached) floats.
     @property
+    @locked
+    def position_f(self):
+        self.check_valid_connection()
+        return self.backend.to_float(self.device.GetPosition())
+
+    @locked
+    def set_position_f(self, pos:float):
+        self.check_valid_connection()
+        if not (self.mode == 'CloseLoop'):
+            raise RuntimeError("Cannot set a position value when the device is in open loop. Set a voltage instead.")
+        (min_position, max_position) = self.position_limits_f
+        if (pos < min_position) or (pos > max_position):
+            raise ValueError(f"Position must be between {min_position} and {max_position} (units: {self.units_position})")
+        self.device.SetPosition(self.backend.from_float(pos))
+
+    @property
+    @locked
+    def voltage_f(self):
+        self.check_valid_connection()
+        return self.backend.to_float(self.device.GetOutputVoltage())
+
+    @locked
+    def set_voltage_f(self, volt:float):
+        self.check_valid_connection()
+        if not (self.mode == 'OpenLoop'):
+            raise RuntimeError("Cannot set a voltage value when the device is in close loop. Set a position instead.")
+        (min_voltage, max_voltage) = self.voltage_limits_f
+        if (volt < min_voltage) or (volt > max_voltage):
+            raise ValueError(f"Voltage must be between {min_voltage} and {max_voltage} (units: {self.units_voltage})")
+        self.device.SetOutputVoltage(self.backend.from_float(volt))
+
+    ## Open loop positioning with hysteresis compensation (see hysteresis.py)
+    def calibrate_open_loop(self, **kwargs):
+        '''
+        Measure the hysteresis loop of the piezo and store the fitted model in self.hysteresis_model, which is then used by set_position_open_loop().
+        The keyword arguments are passed to hysteresis.calibrate(). Returns the model (its attribute rms_error is the error of the fit, in um)
+        '''
+        self.hysteresis_model = hysteresis.calibrate(self, **kwargs)
+        return self.hysteresis_model
+
+    @locked
+    def set_position_open_loop(self, pos:float):
+        '''
+        Move to the position pos (in um) in open loop, by setting the output voltage given by self.hysteresis_model (which takes into account
+        the direction of the movement). Returns the voltage set
+        '''
+        self.check_valid_connection()
+        if not (self.mode == 'OpenLoop'):
+            raise RuntimeError("The device must be in open loop. Use set_position_f() in close loop.")
+        if self.hysteresis_model is None:
+            raise RuntimeError("The hysteresis model is not available, call calibrate_open_loop() first.")
+        model = self.hysteresis_model
+        if (pos < model.min_position) or (pos > model.max_position):
+            raise ValueError(f"Position must be between {model.min_position} and {model.max_position} (calibrated range, units: {self.units_position})")
+        if model.last_position is None:
+            # The state of the piezo is not known (e.g. the mode was changed): the movement starts from the current position and voltage
+            model.reset(position = self.position_f, voltage = self.voltage_f)
+        voltage = model.voltage_for(pos)
+        self.set_voltage_f(voltage)
+        return voltage
+
+    ## Software feedback loop (see feedback.py)
+    def start_feedback(self, **kwargs):
+        '''
+        Start a software feedback loop, which drives the output voltage in open loop at a fixed rate, on a dedicated thread. The keyword arguments
+        (rate, kp, ki, kd, setpoint, func_error, slew_rate, ...) are passed to feedback.feedback_loop. Returns the loop, also stored in self.feedback
+        '''
+        self.check_valid_connection()
+        self.stop_feedback()
+        self.feedback = feedback.feedback_loop(self, **kwargs)
+        self.feedback.start()
+        return self.feedback
+
+    def stop_feedback(self):
+        # The loop object (and its statistics) remains available in self.feedback
+        if self.feedback:
+            self.feedback.stop()
+
+    @property
+    def position_limits_f(self):
+        # Tuple (min_position, max_position), as floats
+        return self._cached('position_limits_f', lambda: (self.backend.to_float(self.min_position), self.backend.to_float(self.max_position)))
+
+    @property
+    def voltage_limits_f(self):
+        # Tuple (min_voltage, max_voltage), as floats
+        return self._cached('voltage_limits_f', lambda: (self.backend.to_float(self.min_voltage), self.backend.to_float(self.max_voltage)))
+
+    @property
+    def jog_steps_f(self):
+        # Same as jog_steps, but the values are floats
+        return {key: self.backend.to_float(value) for key, value in self.jog_steps.items()}
+
+    @property
+    @locked
     def jog_steps(self):
         self.check_valid_connection()
-        self._jog_steps  = self.device.GetJogSteps()
+        self._jog_steps  = self._cached('jog_steps', self.device.GetJogSteps)
         self._jog_steps_dict = dict()
         self._jog_steps_dict['percentage'] = self._jog_steps.PercentageStepSize
         self._jog_steps_dict['position'] = self._jog_steps.PositionStepSize
         self._jog_steps_dict['voltage'] = self._jog_steps.VoltageStepSize
         return self._jog_steps_dict 
     
+    @locked
     def set_jog_steps(self,percentage = None, position = None, voltage = None ):
         self.check_valid_connection()
-        PercentageStepSize = percentage
-        PositionStepSize = position
-        VoltageStepSize = voltage 
-        current_values = self._jog_steps
-        if PercentageStepSize:
-            try:
-                if not(type(PercentageStepSize) == Decimal):
-                    PercentageStepSize = Decimal(PercentageStepSize)
-                current_values.PercentageStepSize = PercentageStepSize
-            except:
-                raise TypeError("Input parameter 'percentage' must either be a Decimal or be convertible to a Decimal")    
-        if PositionStepSize:
-            try:
-                if not(type(PositionStepSize) == Decimal):
-                    PositionStepSize = Decimal(PositionStepSize)
-                current_values.PositionStepSize = PositionStepSize
-            except:
-                raise TypeError("Input parameter 'position' must either be a Decimal or be convertible to a Decimal")    
-        if VoltageStepSize:
-            try:
-                if not(type(VoltageStepSize) == Decimal):
-                    VoltageStepSize = Decimal(VoltageStepSize)
-                current_values.VoltageStepSize = VoltageStepSize
-            except:
-                raise TypeError("Input parameter 'voltage' must either be a Decimal or be convertible to a Decimal")   
-        self.device.SetJogSteps(current_values)
-        self.device.PersistSettings()
+        Decimal = self.backend.Decimal
+        # All values are converted before anything is changed, so that an invalid value leaves both the device and the settings cache untouched
+        new_steps = dict()
+        for name, attribute, value in [('percentage', 'PercentageStepSize', percentage), ('position', 'PositionStepSize', position), ('voltage', 'VoltageStepSize', voltage)]:
+            if value:
+                try:
+                    new_steps[attribute] = value if type(value) == Decimal else Decimal(value)
+                except:
+                    raise TypeError(f"Input parameter '{name}' must either be a Decimal or be convertible to a Decimal")
+        current_values = self._cached('jog_steps', self.device.GetJogSteps)
+        if all(self.backend.to_float(getattr(current_values, attribute)) == self.backend.to_float(value) for attribute, value in new_steps.items()):
+            return self.jog_steps  # The device already has these values, skip the (slow) write to the device memory
+        # The new values are written into a fresh object, the cached one is only replaced once the device has accepted them
+        jog_steps = self.device.GetJogSteps()
+        for attribute, value in new_steps.items():
+            setattr(jog_steps, attribute, value)
+        self.device.SetJogSteps(jog_steps)
+        self._cache.pop('jog_steps', None)
+        self._settings_changed()
         return self.jog_steps
     
+    ## Settings persistence. Writing the settings to the device memory (PersistSettings) is slow and wears the flash memory, so changes of
+    ## settings (jog steps, mode) are not saved immediately. They are saved once, either when a transaction ends (see settings_transaction), or
+    ## after the settings have not been changed for persist_delay seconds, or when the device is disconnected, or when persist_settings() is called.
+    def _settings_changed(self):
+        self.settings_pending = True
+        if self._transaction_depth > 0:
+            return
+        if self.persist_delay is None:
+            self.persist_settings()
+            return
+        if self._persist_timer:
+            self._persist_timer.cancel()
+        self._persist_timer = threading.Timer(self.persist_delay, self.persist_settings)
+        self._persist_timer.daemon = True
+        self._persist_timer.start()
+
+    @locked
+    def persist_settings(self):
+        '''
+        Save the pending changes of settings to the device memory. Returns True if the settings were saved, False if there was nothing to save
+        '''
+        if self._persist_timer:
+            self._persist_timer.cancel()
+            self._persist_timer = None
+        if not (self.settings_pending and self.connected):
+            return False
+        self.device.PersistSettings()
+        self.settings_pending = False
+        self.numb_persists += 1
+        return True
+
+    @contextlib.contextmanager
+    def settings_transaction(self):
+        '''
+        Context manager which groups several changes of settings, and saves them to the device memory only once, at the end of the block. E.g.
+            with device.settings_transaction():
+                device.set_jog_steps(position = 0.1)
+                device.set_jog_steps(voltage = 0.5)
+                device.mode = 'CloseLoop'
+        Transactions can be nested, the settings are saved when the outermost one ends
+        '''
+        with self.lock:
+            self._transaction_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self._transaction_depth -= 1
+                if self._transaction_depth == 0:
+                    self.persist_settings()
+
     # @property
     # def jog_params(self):
     #     self.check_valid_connection()
@@ -219,29 +684,31 @@ class pyThorlabsKCubeKPC101():
     @property
     def max_position(self):
         self.check_valid_connection()
-        self._max_position = self.device.GetMaxTravel()
+        self._max_position = self._cached('max_position', self.device.GetMaxTravel)
         return self._max_position
     
     @property
     def max_voltage(self):
         self.check_valid_connection()
-        self._max_voltage = self.device.GetMaxOutputVoltage()
+        self._max_voltage = self._cached('max_voltage', self.device.GetMaxOutputVoltage)
         return self._max_voltage
     
     @property
     def min_position(self):
         self.check_valid_connection()
-        self._min_position = self.device.GetMinimumTravel()
+        self._min_position = self._cached('min_position', self.device.GetMinimumTravel)
         return self._min_position
     
     @property
     def min_voltage(self):
         self.check_valid_connection()
-        self._min_voltage = self.device.GetMinOutputVoltage()
+        self._min_voltage = self._cached('min_voltage', self.device.GetMinOutputVoltage)
         return self._min_voltage
     
+    @locked
     def read_settings_from_device(self):
-        #Typically called right after a device is connected. Call several functions to read and store current settings
+        #Typically called right after a device is connected. Call several functions to read and store current settings. 
+        #The values read are stored in the settings cache, and they are re-used until the cache is invalidated (see invalidate_cache() and refresh())
         self.check_valid_connection()
         Conf = self.device.GetPiezoConfiguration(self.device_sn)
         if Conf:
@@ -259,32 +726,118 @@ class pyThorlabsKCubeKPC101():
         else:
             raise RuntimeError("Cannot access piezo configuration via method GetPiezoConfiguration")
         
+    def run_trajectory(self, points, dwell_s, on_point = None, t0 = None):
+        '''
+        Move through a sequence of set points, waiting dwell_s seconds at each of them. The set points are positions (in close loop) or voltages (in open loop).
+        The whole array is validated against the (cached) limits before the first movement, and all set points are converted to Decimals beforehand. 
+        Set points are then sent on a fixed schedule based on time.perf_counter(): the i-th set point is sent at t = sum(dwell_s[:i]) from the start, 
+        so that the time spent reading the device does not accumulate. Position and voltage are measured at the end of each dwell time.
+        The lock self.lock is held only while each set point is sent and while each measurement is done, so other threads (e.g. the acquisition
+        worker) can access the device during the dwell times.
+
+        points : array-like
+            1D array of set points
+        dwell_s : float or array-like
+            Dwell time (in s) at each point. Either a single value or an array with the same length of points
+        on_point : function
+            Optional function called after each point with parameters (index, record), where record is the corresponding row of the 
+            returned array. If it returns False, the trajectory is interrupted
+        t0 : float
+            Start time of the schedule (a value of time.perf_counter()), to which all the times of the returned array refer. If None, the current time is used
+
+        Returns
+        -------
+        numpy.ndarray
+            Structured array with dtype trajectory_dtype, with one row for each point that was executed
+        '''
+        self.check_valid_connection()
+        points = np.asarray(points, dtype = float).ravel()
+        dwell_s = np.broadcast_to(np.asarray(dwell_s, dtype = float), points.shape)
+        mode = self.mode
+        if mode == 'CloseLoop':
+            (min_value, max_value), func_set, units = self.position_limits_f, self.device.SetPosition, self.units_position
+        elif mode == 'OpenLoop':
+            (min_value, max_value), func_set, units = self.voltage_limits_f, self.device.SetOutputVoltage, self.units_voltage
+        else:
+            raise RuntimeError("The device must be either in CloseLoop or OpenLoop mode.")
+        invalid = ~np.isfinite(points) | (points < min_value) | (points > max_value)
+        if invalid.any():
+            index = int(np.argmax(invalid))
+            raise ValueError(f"Set point #{index} ({points[index]}) is not between {min_value} and {max_value} (units: {units})")
+        if (dwell_s < 0).any():
+            raise ValueError("Dwell times must be non-negative.")
+        set_points = [self.backend.from_float(x) for x in points.tolist()]
+        t_starts = np.concatenate(([0.0], np.cumsum(dwell_s)))
+        to_float = self.backend.to_float
+        results = np.zeros(len(points), dtype = trajectory_dtype)
+        results['commanded'] = points
+        if t0 is None:
+            t0 = time.perf_counter()
+        for i, set_point in enumerate(set_points):
+            sleep_until(t0 + t_starts[i])
+            with self.lock:
+                t_command = time.perf_counter()
+                func_set(set_point)
+            sleep_until(t0 + t_starts[i + 1])
+            with self.lock:
+                t_measured = time.perf_counter()
+                position = to_float(self.device.GetPosition())
+                voltage = to_float(self.device.GetOutputVoltage())
+            results[i] = (points[i], position, voltage, t_command - t0, t_measured - t0)
+            if on_point and (on_point(i, results[i]) == False):
+                return results[:i + 1]
+        return results
+
+    ## Jerk-limited trajectories (see trajectory.py)
+    def plan_trajectory(self, waypoints, **kwargs):
+        '''
+        Plan a jerk-limited trajectory from the current position through the waypoints (a single target or a list of targets, in um). The keyword
+        arguments (rate, max_velocity, max_acceleration, max_jerk, dwell) are passed to trajectory.plan(). Returns a trajectory.motion_profile
+        '''
+        waypoints = np.atleast_1d(np.asarray(waypoints, dtype = float))
+        (min_position, max_position) = self.position_limits_f
+        if ((waypoints < min_position) | (waypoints > max_position)).any():
+            raise ValueError(f"Waypoints must be between {min_position} and {max_position} (units: {self.units_position})")
+        return trajectory.plan(self.position_f, waypoints, **kwargs)
+
+    def execute_trajectory(self, profile, **kwargs):
+        '''
+        Send the set points of profile (see plan_trajectory()) to the device, and measure the settle time of each move. The keyword arguments
+        (tolerance, numb_samples, timeout, on_point) are passed to trajectory.execute(). Returns a dictionary with the measured samples, and the
+        predicted and measured settle time of each move
+        '''
+        return trajectory.execute(self, profile, **kwargs)
+
+    @locked
     def jog(self,direction):
         #Direction can be equal to +1 or -1. This jogs the device by the jog step size. The quantity being jogged (position, voltage, percentage) is 
         # automatically set by the device depending on the mode of the device (CloseLoop vs OpenLoop), and whether the device has a defined MaxTravel
         self.check_valid_connection()
         if direction == +1:
-            self.device.Jog(GenPieCLI.Settings.ControlSettings.PiezoJogDirection.Increase)
+            self.device.Jog(self.backend.PiezoJogDirection.Increase)
         if direction == -1:
-            self.device.Jog(GenPieCLI.Settings.ControlSettings.PiezoJogDirection.Decrease)
+            self.device.Jog(self.backend.PiezoJogDirection.Decrease)
         return
     
+    @locked
     def jog_by(self,step_size:float):
         #This jogs the device by an amount specified in the input variable step_size. The quantity being jogged (position, voltage, percentage) is 
         # automatically set by the device depending on the mode of the device (CloseLoop vs OpenLoop), and whether the device has a defined MaxTravel.
         # The value of step_size does not overwrite the values in the dictionary self._jog_steps
         try:
             step_size_abs = abs(step_size)
-            step_size_abs_decimal = Decimal(step_size_abs)
+            step_size_abs_decimal = self.backend.from_float(float(step_size_abs))
         except:
             raise TypeError("Input parameter 'step_size' must either be a float and convertible to a Decimal") 
-        direction = GenPieCLI.Settings.ControlSettings.PiezoJogDirection.Increase if step_size >=0 else GenPieCLI.Settings.ControlSettings.PiezoJogDirection.Decrease
+        direction = self.backend.PiezoJogDirection.Increase if step_size >=0 else self.backend.PiezoJogDirection.Decrease
         
         self.device.Jog(step_size_abs_decimal,direction)
 
+    @locked
     def set_zero(self):
         self.check_valid_connection()
         self.device.SetZero()
+        self.invalidate_cache()
         return
 
 
@@ -0,0 +1,209 @@
+'''
+Virtual version of the driver, which simulates a KPC101 connected to a piezo stage. It is used by the interface when the GUI is started with
+the -virtual flag, and it can be used to test/benchmark scripts (ramps, settle detection, GUI refresh load...) without a real device.
+
+The piezo is modelled as follows
+- Close loop: the strain gauge reading approaches the set point with a first-order response (time constant tau_close_loop). The output voltage is
+    whatever voltage is needed to hold the current position, according to the open loop model below.
+- Open loop: the output voltage approaches the set point with a first-order response (time constant tau_open_loop). The displacement is obtained
+    from the voltage via a Bouc-Wen hysteresis model (the maximum width of the hysteresis loop is a fraction 'hysteresis' of the full travel), plus
+    a creep term which relaxes towards a fraction 'creep' of the static displacement with time constant tau_creep.
+- Every position reading is affected by a gaussian noise with standard deviation 'noise' (in um), emulating the strain gauge noise.
+- Set points are clipped to the travel and voltage limits, as done by the real device.
+
+The time used by the simulation is given by a clock object. real_clock follows the real time, while simulated_clock only advances when
+its methods sleep() or advance() are called, or by a fixed amount (call_latency) every time the device is accessed. A simulated clock allows to run
+long simulations (e.g. benchmarks) much faster than real time, as long as the code being tested uses the same clock for waiting.
+'''
+import math
+import time
+import random
+
+from pyThorlabsKCubeKPC101 import backends
+from pyThorlabsKCubeKPC101 import driver
+
+class real_clock():
+    def time(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+class simulated_clock():
+    '''
+    Clock which advances only when sleep() or advance() are called. If call_latency > 0, the clock also advances by call_latency every time
+    that time() is called, i.e. every time that the virtual device is accessed, which emulates the latency of the USB communication.
+    '''
+    def __init__(self, start = 0.0, call_latency = 0.0):
+        self._time = float(start)
+        self.call_latency = call_latency
+
+    def time(self):
+        self._time += self.call_latency
+        return self._time
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self._time += seconds
+
+    def advance(self, seconds):
+        self.sleep(seconds)
+
+class virtual_piezo(backends.simulated_device):
+    '''
+    Simulated KCubePiezoStrainGauge with piezo dynamics, hysteresis, creep and strain gauge noise (see module docstring).
+
+    Parameters
+    ----------
+    device_sn : str
+    clock
+        real_clock() (default) or simulated_clock()
+    max_travel : float
+        Maximum travel, in um
+    max_voltage : float
+        Maximum output voltage, in V
+    tau_close_loop : float
+        Time constant (in s) of the close loop response
+    tau_open_loop : float
+        Time constant (in s) of the output voltage
+    position_tolerance : float
+        In close loop, the device is busy until the position is closer than position_tolerance (in um) to the set point
+    voltage_tolerance : float
+        In open loop, the device is busy until the voltage is closer than voltage_tolerance (in V) to the set point
+    hysteresis : float
+        Maximum width of the hysteresis loop, as a fraction of the full travel
+    creep : float
+        Creep amplitude, as a fraction of the static displacement
+    tau_creep : float
+        Time constant (in s) of the creep
+    noise : float
+        Standard deviation (in um) of the noise of the strain gauge reading
+    seed
+        Seed of the random generator used for the noise
+    '''
+    integration_step = 1e-3     # Maximum duration (in s) of each integration step of the model
+    max_integration_steps = 200 # Maximum number of integration steps performed for each state update (keeps the cost of each read bounded)
+    _bouc_wen_saturation = 6.0  # Sum of the Bouc-Wen parameters beta + gamma (in normalized units). Larger values give a sharper hysteresis loop
+    _bouc_wen_step = 1e-3       # Maximum change of the normalized voltage in each update of the Bouc-Wen state (larger changes are subdivided)
+
+    def __init__(self, device_sn, clock = None, max_travel = 20, max_voltage = 75, tau_close_loop = 0.02, tau_open_loop = 0.002,
+                 position_tolerance = 0.005, voltage_tolerance = 0.01, hysteresis = 0.12, creep = 0.02, tau_creep = 5.0, noise = 0.002, seed = None):
+        super().__init__(device_sn, max_travel = max_travel, max_voltage = max_voltage)
+        self.clock = clock if clock else real_clock()
+        self.tau_close_loop = tau_close_loop
+        self.tau_open_loop = tau_open_loop
+        self.position_tolerance = position_tolerance
+        self.voltage_tolerance = voltage_tolerance
+        self.hysteresis = hysteresis
+        self.creep = creep
+        self.tau_creep = tau_creep
+        self.noise = noise
+        self._random = random.Random(seed)
+        self._last_update = self.clock.time()
+        self._u = 0.0           # Normalized output voltage (0 = min voltage, 1 = max voltage)
+        self._h = 0.0           # Bouc-Wen hysteresis state (normalized units)
+        self._creep = 0.0       # Creep displacement (um)
+        self._x = 0.0           # Actual displacement (um)
+
+    def _static_displacement(self):
+        return self._max_travel * (self._u - self._h)
+
+    def _move_voltage(self, u_new):
+        # Update the normalized voltage and the Bouc-Wen hysteresis state. The Bouc-Wen model is rate-independent, so the change of voltage is
+        # subdivided in small increments (independently of the time elapsed): the state then does not depend on how often the device is read
+        total_du = u_new - self._u
+        numb_steps = max(int(math.ceil(abs(total_du) / self._bouc_wen_step)), 1)
+        du = total_du / numb_steps
+        A = self._bouc_wen_saturation * self.hysteresis / 2
+        beta = gamma = self._bouc_wen_saturation / 2
+        h = self._h
+        for _ in range(numb_steps):
+            h = h + A * du - beta * abs(du) * h - gamma * du * abs(h)
+        self._h = h
+        self._u = u_new
+
+    def _update_state(self):
+        now = self.clock.time()
+        elapsed = now - self._last_update
+        if elapsed <= 0:
+            return
+        self._last_update = now
+        numb_steps = min(max(int(math.ceil(elapsed / self.integration_step)), 1), self.max_integration_steps)
+        dt = elapsed / numb_steps
+        for _ in range(numb_steps):
+            if self._is_open_loop():
+                u_target = self._voltage / self._max_voltage
+                self._move_voltage(self._u + (u_target - self._u) * (1 - math.exp(-dt / self.tau_open_loop)))
+                x_static = self._static_displacement()
+                self._creep = self._creep + (self.creep * x_static - self._creep) * (1 - math.exp(-dt / self.tau_creep))
+                self._x = x_static + self._creep
+            else:
+                # The controller compensates hysteresis and creep, the voltage is the one needed to hold the current position
+                self._x = self._x + (self._position - self._x) * (1 - math.exp(-dt / self.tau_close_loop))
+                self._creep = 0.0
+                self._move_voltage(min(max(self._x / self._max_travel + self._h, 0.0), 1.0))
+
+    def _is_moving(self):
+        self._update_state()
+        if self._is_open_loop():
+            return abs(self._voltage - self._u * self._max_voltage) > self.voltage_tolerance
+        return abs(self._position - self._x) > self.position_tolerance
+
+    def _start_move(self):
+        return
+
+    def SetPositionControlMode(self, mode):
+        self._update_state()
+        super().SetPositionControlMode(mode)
+        # When switching mode, the new set point is the current state, so that the piezo does not move
+        self._position = min(max(self._x, 0.0), self._max_travel)
+        self._voltage = self._u * self._max_voltage
+
+    def GetPosition(self):
+        self._update_state()
+        return self.Decimal(self._x + self._random.gauss(0.0, self.noise) if self.noise else self._x)
+
+    def SetPosition(self, position):
+        self._update_state()
+        self._position = min(max(float(position), 0.0), self._max_travel)
+
+    def GetOutputVoltage(self):
+        self._update_state()
+        return self.Decimal(self._u * self._max_voltage)
+
+    def SetOutputVoltage(self, voltage):
+        self._update_state()
+        self._voltage = min(max(float(voltage), 0.0), self._max_voltage)
+
+    def SetZero(self):
+        # Zeroing sets the output voltage to zero and redefines the zero of the strain gauge
+        self._update_state()
+        self._voltage = 0.0
+        self._u = 0.0
+        self._h = 0.0
+        self._creep = 0.0
+        self._x = 0.0
+        self._position = 0.0
+
+    @staticmethod
+    def Decimal(value):
+        return backends.simulated_backend.Decimal(repr(float(value)))
+
+class virtual_backend(backends.simulated_backend):
+    '''
+    Backend which creates virtual_piezo objects. All the keyword arguments (e.g. clock, noise, hysteresis...) are passed to virtual_piezo.
+    '''
+    def __init__(self, serial_numbers = ['29999999'], **device_kwargs):
+        super().__init__(serial_numbers = serial_numbers, device_class = virtual_piezo, **device_kwargs)
+
+class pyThorlabsKCubeKPC101(driver.pyThorlabsKCubeKPC101):
+    '''
+    Same as driver.pyThorlabsKCubeKPC101, but connected by default to a virtual_backend. All keyword arguments are passed to virtual_backend
+    (and hence to virtual_piezo), e.g.
+        pyThorlabsKCubeKPC101(clock = simulated_clock(call_latency = 1e-3), noise = 0)
+    '''
+    def __init__(self, model = None, backend = None, **kwargs):
+        if not backend:
+            backend = virtual_backend(**kwargs)
+        super().__init__(model = model, backend = backend)
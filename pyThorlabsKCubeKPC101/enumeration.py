@@ -0,0 +1,117 @@
+'''
+Cache of the list of devices found by a backend.
+
+Enumerating the devices (DeviceManagerCLI.BuildDeviceList() with Kinesis) is slow, and it used to be repeated by every driver and every interface.
+A device_list_cache stores the result of the last enumeration together with its time, and a new enumeration is done only when the stored
+list is older than the requested maximum age. Caches are shared by all drivers which use the same backend, and by all Kinesis backends
+(the Kinesis device manager is global to the process), see get_cache().
+
+The method refresh() enumerates the devices again and returns which serial numbers were added and removed with respect to the previous
+enumeration. It can be called periodically (e.g. by an acquisition.acquisition_worker) to detect devices which are plugged in or unplugged.
+'''
+import time
+import threading
+import weakref
+
+class device_list_cache():
+    '''
+    Attributes
+    ----------
+    func_list_devices
+        Function with no input parameter, returns the list of serial numbers of the devices found (e.g. backend.list_devices)
+    ttl : float
+        Default maximum age (in s) of the cached list, see get()
+    devices : list
+        Serial numbers found by the last enumeration (None if no enumeration has been done yet)
+    timestamp : float
+        Time (given by time.monotonic()) of the last enumeration
+    numb_enumerations : int
+        Number of enumerations done so far
+    '''
+    def __init__(self, func_list_devices, ttl = 5.0):
+        self.func_list_devices = func_list_devices
+        self.ttl = ttl
+        self.devices = None
+        self.timestamp = None
+        self.numb_enumerations = 0
+        self._lock = threading.Lock()
+
+    @property
+    def age(self):
+        # Age (in s) of the cached list, infinite if no enumeration has been done yet
+        if self.timestamp is None:
+            return float('inf')
+        return time.monotonic() - self.timestamp
+
+    def get(self, max_age = None):
+        '''
+        Returns the list of serial numbers found. The devices are enumerated again only if the cached list is older than max_age seconds.
+        max_age = None uses self.ttl, max_age = 0 forces a new enumeration, max_age = float('inf') enumerates only if this was never done before
+        '''
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            if (self.devices is None) or (self.age > max_age):
+                self._enumerate()
+            return list(self.devices)
+
+    def refresh(self, max_age = 0):
+        '''
+        Enumerate the devices again (only if the cached list is older than max_age seconds, by default always).
+
+        Returns
+        -------
+        (devices, added, removed) : tuple of lists
+            Serial numbers currently found, serial numbers found now but not in the previous enumeration, serial numbers found in the previous
+            enumeration but not now. If no enumeration had been done before, all devices are reported as added
+        '''
+        with self._lock:
+            old_devices = self.devices if self.devices is not None else []
+            if (self.devices is None) or (self.age > max_age):
+                self._enumerate()
+            added = [sn for sn in self.devices if not (sn in old_devices)]
+            removed = [sn for sn in old_devices if not (sn in self.devices)]
+            return (list(self.devices), added, removed)
+
+    def invalidate(self):
+        with self._lock:
+            self.timestamp = None
+
+    def _enumerate(self):
+        self.devices = [str(sn) for sn in self.func_list_devices()]
+        self.timestamp = time.monotonic()
+        self.numb_enumerations += 1
+
+_shared_caches = weakref.WeakValueDictionary()
+_caches_lock = threading.Lock()
+
+def _weak_list_devices(backend):
+    # backend.list_devices without a reference to backend, so that a cache does not keep its backend alive
+    ref = weakref.ref(backend)
+    def list_devices():
+        backend = ref()
+        if backend is None:
+            raise RuntimeError('The backend of this device_list_cache does not exist anymore')
+        return backend.list_devices()
+    list_devices.backend_ref = ref
+    return list_devices
+
+def get_cache(backend, ttl = 5.0):
+    '''
+    Returns the device_list_cache associated to backend (it is created the first time and stored in backend._device_list_cache). Backends which
+    define the attribute enumeration_key share the same cache if their keys are equal (e.g. all Kinesis backends), otherwise each backend object
+    has its own cache. Caches do not keep their backends alive, and a shared cache is discarded when all the backends using it are deleted.
+    '''
+    key = getattr(backend, 'enumeration_key', None)
+    with _caches_lock:
+        cache = getattr(backend, '_device_list_cache', None)
+        if (cache is None) and not (key is None):
+            cache = _shared_caches.get(key)
+        if cache is None:
+            cache = device_list_cache(_weak_list_devices(backend), ttl = ttl)
+            if not (key is None):
+                _shared_caches[key] = cache
+        elif cache.func_list_devices.backend_ref() is None:
+            # The backend which created the shared cache was deleted, enumerate with this one
+            cache.func_list_devices = _weak_list_devices(backend)
+        backend._device_list_cache = cache
+        return cache
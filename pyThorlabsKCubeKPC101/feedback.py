@@ -0,0 +1,252 @@
+'''
+Software feedback loop, which drives the output voltage of the device (in open loop) from the strain gauge reading, or from an external error signal
+(e.g. the signal of a photodiode, to lock a cavity), at a fixed rate on a dedicated thread.
+
+At each iteration the loop reads the error, computes the new output voltage
+
+    voltage = feed_forward + kp*error + integral + derivative
+
+and sends it to the device with a single call to SetOutputVoltage. The loop runs on a fixed schedule based on time.perf_counter() (iteration k
+starts at t0 + k/rate, the last spin_time s before each deadline are spent busy-waiting, see driver.sleep_until), so that the sampling time does
+not depend on the latency of each iteration. If an iteration is late by one period or more, the missed iterations are skipped and counted.
+
+- feed_forward: if the error is computed from the position (func_error = None) and the driver has a hysteresis model (see hysteresis.py), the
+    voltage which corresponds to the set point is used as feed forward, so that the PID only needs to correct the residual error. The loop uses
+    its own copy of the model, so the state of instrument.hysteresis_model (used by set_position_open_loop) is not changed
+- anti-windup: the integral is not updated when the output is saturated and the error would push it further into saturation
+- derivative: computed on the measurement (not on the error, so that changes of the set point do not cause kicks) and low-pass filtered
+- the output is clipped to the voltage limits of the device, and its change per iteration is limited by slew_rate (V/s)
+- polling: the position returned by the device is only updated at each poll of Kinesis (see driver.pyThorlabsKCubeKPC101.set_polling_rate). When
+    the loop reads the position and the polling interval is longer than the period of the loop, the polling interval is shortened while the
+    loop runs (to one period), and restored when it ends
+'''
+import copy
+import time
+import threading
+import numpy as np
+
+from pyThorlabsKCubeKPC101 import driver
+
+class feedback_loop():
+    '''
+    Parameters
+    ----------
+    instrument
+        driver.pyThorlabsKCubeKPC101 object (connected). The device is set in open loop when the loop starts
+    rate : float
+        Number of iterations per second
+    kp, ki, kd : float
+        Gains, in V per unit of error (kp), V per unit of error per s (ki), V s per unit of error (kd). With func_error = None the error is in um
+    setpoint : float
+        Target position (in um), used when func_error is None. If None, the current position is used
+    func_error
+        Function, takes no input parameter. If not None, it is called at each iteration and its value is used as the error signal (external error)
+    feed_forward : bool
+        If True (and func_error is None), use the hysteresis model of the driver (if available) to compute the feed forward voltage
+    slew_rate : float
+        Maximum change of the output voltage per second (in V/s). None = no limit
+    derivative_filter : float
+        Time constant (in s) of the low-pass filter applied to the derivative term. 0 = no filter
+    spin_time : float
+        See driver.sleep_until
+    history_length : int
+        Number of iterations stored in self.history (time, error, output and lateness of each iteration)
+    on_error
+        Function called (on the thread of the loop) with the exception as only input parameter, if an iteration fails. The loop is then stopped
+
+    Statistics (see also the property stats)
+    ----------
+    numb_iterations, numb_missed_deadlines, numb_saturated : int
+    jitter : float
+        Delay (in s) between the scheduled start of an iteration and its actual start (mean, std, max and percentiles in self.stats)
+    '''
+    def __init__(self, instrument, rate = 500, kp = 0.0, ki = 0.0, kd = 0.0, setpoint = None, func_error = None, feed_forward = True,
+                 slew_rate = None, derivative_filter = 0.0, spin_time = 0.0005, history_length = 10000, on_error = None):
+        self.instrument = instrument
+        self.rate = float(rate)
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.setpoint = setpoint
+        self.func_error = func_error
+        self.feed_forward = feed_forward
+        self.slew_rate = slew_rate
+        self.derivative_filter = derivative_filter
+        self.spin_time = spin_time
+        self.on_error = on_error
+        self.history = np.zeros(int(history_length), dtype = [('time', 'f8'), ('error', 'f8'), ('output', 'f8'), ('jitter', 'f8')])
+        self.last_exception = None
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._model = None
+        self._original_polling_rate = None  # Polling interval (in ms) of the device before the loop started, if the loop has changed it
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.numb_iterations = 0
+        self.numb_missed_deadlines = 0
+        self.numb_saturated = 0
+        self.max_jitter = 0.0
+        self._sum_jitter = 0.0
+        self._sum_jitter2 = 0.0
+        self.max_duration = 0.0
+        self._sum_duration = 0.0
+
+    @property
+    def is_running(self):
+        return (self._thread is not None) and self._thread.is_alive()
+
+    @property
+    def stats(self):
+        n = self.numb_iterations
+        recent = self.history[:min(n, len(self.history))]
+        mean_jitter = self._sum_jitter / n if n else 0.0
+        return {'rate': self.rate,
+                'numb_iterations': n,
+                'numb_missed_deadlines': self.numb_missed_deadlines,
+                'numb_saturated': self.numb_saturated,
+                'mean_jitter': mean_jitter,
+                'std_jitter': float(np.sqrt(max(self._sum_jitter2 / n - mean_jitter**2, 0))) if n else 0.0,
+                'max_jitter': self.max_jitter,
+                'p99_jitter': float(np.percentile(recent['jitter'], 99)) if len(recent) else 0.0,
+                'mean_duration': self._sum_duration / n if n else 0.0,
+                'max_duration': self.max_duration,
+                'rms_error': float(np.sqrt(np.mean(recent['error']**2))) if len(recent) else 0.0}
+
+    def set_setpoint(self, setpoint):
+        # The new set point (and the corresponding feed forward voltage) is used starting from the next iteration
+        self.setpoint = float(setpoint)
+
+    def start(self):
+        if self.is_running:
+            return
+        self.instrument.mode = 'OpenLoop'
+        if (self.func_error is None) and (self.setpoint is None):
+            self.setpoint = self.instrument.position_f
+        self._match_polling_rate()
+        self.reset_stats()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target = self._run, name = 'feedback_loop', daemon = True)
+        self._thread.start()
+
+    def stop(self, wait = True, timeout = 2.0):
+        self._stop_event.set()
+        if wait and self._thread and not (self._thread is threading.current_thread()):
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _match_polling_rate(self):
+        # If the loop reads the position, the device must be polled at least once per iteration, otherwise most iterations would use a stale position
+        polling_rate = max(int(1000 / self.rate), 1)
+        with self.instrument.lock:
+            if (self.func_error is None) and self.instrument.polling_rate and (self.instrument.polling_rate > polling_rate):
+                self._original_polling_rate = self.instrument.polling_rate
+                self.instrument.set_polling_rate(polling_rate)
+
+    def _restore_polling_rate(self):
+        with self.instrument.lock:
+            if self._original_polling_rate and self.instrument.connected:
+                self.instrument.set_polling_rate(self._original_polling_rate)
+            self._original_polling_rate = None
+
+    def _copy_model(self):
+        # Private copy of the hysteresis model of the driver (the lookup table is shared, only the state of the piezo is copied), which starts
+        # from the current state of the device
+        model = self.instrument.hysteresis_model
+        if not (self.feed_forward and (self.func_error is None) and model):
+            return None
+        model = copy.copy(model)
+        if model.last_position is None:
+            model.reset(position = self.instrument.position_f, voltage = self.instrument.voltage_f)
+        return model
+
+    def _feed_forward_voltage(self, setpoint):
+        if self._model is None:
+            return None
+        model = self._model
+        return model.voltage_for(min(max(setpoint, model.min_position), model.max_position))
+
+    def _run(self):
+        instrument = self.instrument
+        (min_voltage, max_voltage) = instrument.voltage_limits_f
+        period = 1 / self.rate
+        try:
+            self._model = self._copy_model()
+            output = instrument.voltage_f
+            previous_measurement = None
+            derivative = 0.0
+            feed_forward_setpoint = None
+            feed_forward = 0.0
+            integral = None
+            next_deadline = time.perf_counter()
+            while not self._stop_event.is_set():
+                start = time.perf_counter()
+                jitter = start - next_deadline
+                setpoint = self.setpoint
+                # The lock of the device is held only while the device is read and written, the external error (which might be slow, e.g. a
+                # read of another instrument) and the computation of the output do not block the other threads using the device
+                if self.func_error is None:
+                    with instrument.lock:
+                        if self._stop_event.is_set():   # The loop might have been stopped while waiting for the lock (e.g. by disconnect_device)
+                            break
+                        measurement = instrument.position_f
+                    error = setpoint - measurement
+                else:
+                    error = self.func_error()
+                    measurement = -error
+                if setpoint != feed_forward_setpoint:
+                    feed_forward_setpoint = setpoint
+                    voltage = self._feed_forward_voltage(setpoint) if setpoint is not None else None
+                    if voltage is not None:
+                        feed_forward = voltage
+                if integral is None:
+                    # Bumpless start, from the current output voltage: the integral absorbs (once) the offset between the output and the
+                    # feed forward. Later changes of the feed forward (i.e. of the set point) are applied to the output
+                    integral = output - feed_forward - self.kp * error
+                if previous_measurement is not None:
+                    raw_derivative = -(measurement - previous_measurement) / period
+                    alpha = period / (self.derivative_filter + period)
+                    derivative = derivative + alpha * (raw_derivative - derivative)
+                previous_measurement = measurement
+                new_output = feed_forward + self.kp * error + integral + self.kd * derivative
+                # Anti-windup: the error is integrated only if it does not push the output further into saturation. The direction of the
+                # push is given by the sign of ki*error, so that negative gains (e.g. an inverted external error signal) are handled as well
+                push = self.ki * error
+                saturated = (new_output > max_voltage and push > 0) or (new_output < min_voltage and push < 0)
+                if saturated:
+                    self.numb_saturated += 1
+                else:
+                    integral += self.ki * error * period
+                if self.slew_rate:
+                    max_step = self.slew_rate * period
+                    new_output = min(max(new_output, output - max_step), output + max_step)
+                output = min(max(new_output, min_voltage), max_voltage)
+                with instrument.lock:
+                    if self._stop_event.is_set():
+                        break
+                    instrument.set_voltage_f(output)
+                now = time.perf_counter()
+                duration = now - start
+                index = self.numb_iterations % len(self.history)
+                self.history[index] = (start, error, output, jitter)
+                self.numb_iterations += 1
+                self.max_jitter = max(self.max_jitter, jitter)
+                self._sum_jitter += jitter
+                self._sum_jitter2 += jitter**2
+                self.max_duration = max(self.max_duration, duration)
+                self._sum_duration += duration
+                next_deadline = next_deadline + period
+                if (now - next_deadline) >= period:
+                    numb_missed = int((now - next_deadline) // period)
+                    self.numb_missed_deadlines += numb_missed
+                    next_deadline = next_deadline + numb_missed * period
+                driver.sleep_until(next_deadline, spin_time = self.spin_time)
+        except Exception as e:
+            self.last_exception = e
+            if self.on_error:
+                self.on_error(e)
+        finally:
+            try:
+                self._restore_polling_rate()
+            except Exception as e:
+                self.last_exception = self.last_exception or e
@@ -0,0 +1,137 @@
+'''
+Manager of several KPC101 controllers used together (e.g. three cubes driving the X, Y and Z axes of a stage).
+
+Devices are enumerated only once for the whole group, all axes are connected concurrently on a thread pool, and multi-axis movements are
+issued to all axes together and then awaited in parallel, so that a coordinated movement takes as long as the slowest axis.
+'''
+import time
+import concurrent.futures
+
+from pyThorlabsKCubeKPC101 import driver
+
+class KPC101Group():
+    '''
+    Parameters
+    ----------
+    serial_numbers : list
+        Serial numbers of the devices in the group
+    axes : list
+        Names of the axes (e.g. ['x', 'y', 'z']), one for each serial number. If None, the serial numbers are used as names
+    backend
+        Backend shared by all devices (see backends.py). If None, a backends.kinesis_backend is used
+    driver_class
+        Driver class used for each axis (default = driver.pyThorlabsKCubeKPC101)
+
+    Attributes
+    ----------
+    devices : dict
+        Driver object of each axis, indexed by axis name. Also accessible as group[axis]
+    '''
+    def __init__(self, serial_numbers, axes = None, backend = None, driver_class = driver.pyThorlabsKCubeKPC101):
+        self.serial_numbers = [str(sn) for sn in serial_numbers]
+        self.axes = list(axes) if axes else list(self.serial_numbers)
+        if len(self.axes) != len(self.serial_numbers):
+            raise ValueError("The number of axes must be equal to the number of serial numbers.")
+        self.backend = backend if backend else driver.backends.kinesis_backend()
+        self.devices = {axis: driver_class(backend = self.backend) for axis in self.axes}
+        self._serial_number = dict(zip(self.axes, self.serial_numbers))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = len(self.axes), thread_name_prefix = 'KPC101Group')
+
+    def __getitem__(self, axis):
+        return self.devices[axis]
+
+    def _run_on_all_axes(self, func, axes = None):
+        # Execute func(axis) for each axis concurrently, and return a dictionary {axis: result}. Exceptions are re-raised
+        axes = self.axes if axes is None else list(axes)
+        futures = {axis: self._executor.submit(func, axis) for axis in axes}
+        return {axis: future.result() for axis, future in futures.items()}
+
+    def list_devices(self):
+        # Enumerate the devices only once (this is slow with Kinesis), and share the result with all drivers
+        list_valid_devices = self.devices[self.axes[0]].list_devices()
+        for device in self.devices.values():
+            device.list_valid_devices = list_valid_devices
+        return list_valid_devices
+
+    def connect(self, **kwargs):
+        '''
+        Connect all axes concurrently. The keyword arguments are passed to driver.pyThorlabsKCubeKPC101.connect_device (e.g. polling_rate, timeout)
+
+        Returns
+        -------
+        dict
+            {axis: (Msg, ID)}, as returned by connect_device for each axis. The time needed by each axis is available in self[axis].connection_timings
+        '''
+        if not hasattr(self.devices[self.axes[0]], 'list_valid_devices'):
+            self.list_devices()
+        return self._run_on_all_axes(lambda axis: self.devices[axis].connect_device(self._serial_number[axis], **kwargs))
+
+    def disconnect(self):
+        return self._run_on_all_axes(lambda axis: self.devices[axis].disconnect_device(),
+                                     axes = [axis for axis in self.axes if self.devices[axis].connected])
+
+    def close(self):
+        self.disconnect()
+        self._executor.shutdown(wait = True)
+
+    @property
+    def connected(self):
+        return all(device.connected for device in self.devices.values())
+
+    def snapshot(self):
+        # Returns {axis: driver.state_snapshot}, the states of all axes are read concurrently
+        return self._run_on_all_axes(lambda axis: self.devices[axis].snapshot())
+
+    def set_mode(self, mode):
+        def set_mode_axis(axis):
+            self.devices[axis].mode = mode
+        self._run_on_all_axes(set_mode_axis)
+
+    def move_to(self, targets, wait = True, **settle_kwargs):
+        '''
+        Send a set point to several axes together and (optionally) wait, in parallel, until all of them have settled.
+        Each set point is a position (for axes in close loop) or a voltage (for axes in open loop).
+
+        targets : dict or sequence
+            Either a dictionary {axis: set point} (only the specified axes are moved), or a sequence with one set point for each axis of the group
+        wait : bool
+            If True, wait until all axes have settled
+        settle_kwargs
+            Keyword arguments passed to driver.pyThorlabsKCubeKPC101.wait_until_settled (e.g. tolerance, timeout). If tolerance is specified, the
+            set point of each axis is used as target
+
+        Returns
+        -------
+        dict
+            {axis: {'command': time needed to send the set point, 'settle': time needed to settle, 'total': total time}}, all times in s
+        '''
+        if not isinstance(targets, dict):
+            targets = dict(zip(self.axes, targets))
+        for axis in targets:
+            if not (axis in self.devices):
+                raise ValueError(f"Axis {axis} is not part of this group.")
+        # All set points are checked before any command is sent, so that an invalid set point does not leave the group partially moved
+        for axis, target in targets.items():
+            device = self.devices[axis]
+            if device.mode == 'CloseLoop':
+                (min_value, max_value), units = device.position_limits_f, device.units_position
+            else:
+                (min_value, max_value), units = device.voltage_limits_f, device.units_voltage
+            if not (min_value <= target <= max_value):
+                raise ValueError(f"Set point of axis {axis} ({target}) is not between {min_value} and {max_value} (units: {units})")
+        time_start = time.perf_counter()
+        def move_axis(axis):
+            device = self.devices[axis]
+            if device.mode == 'CloseLoop':
+                device.set_position_f(targets[axis])
+            else:
+                device.set_voltage_f(targets[axis])
+            timings = {'command': time.perf_counter() - time_start, 'settle': None}
+            if wait:
+                kwargs = dict(settle_kwargs)
+                if kwargs.get('tolerance'):
+                    kwargs['target'] = targets[axis]
+                timings['settle'] = device.wait_until_settled(**kwargs)
+            timings['total'] = time.perf_counter() - time_start
+            return timings
+        return self._run_on_all_axes(move_axis, axes = targets.keys())
@@ -0,0 +1,100 @@
+'''
+Fixed-capacity ring buffer storing the history of the states read from the device, i.e. samples of (timestamp, position, voltage, mode, busy).
+
+The buffer is preallocated when it is created, and appending a sample is O(1) and does not allocate any python object. Each sample is written
+twice, at index i and i + capacity of an array of length 2*capacity. In this way the most recent n samples (for any n <= capacity) always occupy a
+contiguous region of the array, and they can be returned as a view (no copy), also right after the buffer has wrapped around.
+'''
+import numpy as np
+
+# Modes are stored as small integers
+MODE_CODES = {None: 0, 'OpenLoop': 1, 'CloseLoop': 2}
+MODE_NAMES = {code: name for name, code in MODE_CODES.items()}
+
+sample_dtype = np.dtype([('timestamp', 'f8'), ('position', 'f8'), ('voltage', 'f8'), ('mode', 'i1'), ('busy', '?')])
+
+class history_buffer():
+    '''
+    Attributes
+    ----------
+    capacity : int
+        Maximum number of samples stored. When the buffer is full, each new sample overwrites the oldest one
+    '''
+    def __init__(self, capacity = 100000):
+        self.capacity = int(capacity)
+        if self.capacity <= 0:
+            raise ValueError("The capacity of the buffer must be a positive integer.")
+        self._data = np.zeros(2 * self.capacity, dtype = sample_dtype)
+        self._index = 0     # Position (between 0 and capacity-1) where the next sample will be written
+        self._length = 0    # Number of valid samples
+
+    def __len__(self):
+        return self._length
+
+    def clear(self):
+        self._index = 0
+        self._length = 0
+
+    def append(self, timestamp, position, voltage, mode = None, busy = False):
+        row = (timestamp, position, voltage, MODE_CODES.get(mode, 0), busy)
+        self._data[self._index] = row
+        self._data[self._index + self.capacity] = row
+        self._index = (self._index + 1) % self.capacity
+        if self._length < self.capacity:
+            self._length += 1
+
+    def append_snapshot(self, state):
+        # state is a driver.state_snapshot object
+        self.append(state.timestamp, state.position, state.voltage, state.mode, state.busy)
+
+    def last(self, n = None):
+        '''
+        Returns a view (no copy) of the last n samples (all samples if n is None), ordered from the oldest to the most recent.
+        The view is a numpy structured array with fields 'timestamp', 'position', 'voltage', 'mode', 'busy'.
+        Note: the content of the view changes when new samples are appended and the buffer wraps around; use .copy() to keep the data.
+        '''
+        n = self._length if n is None else min(int(n), self._length)
+        end = self._index + self.capacity
+        return self._data[end - n : end]
+
+    def last_seconds(self, seconds):
+        '''
+        Returns a view (no copy) of all samples acquired in the last 'seconds' seconds (with respect to the most recent sample)
+        '''
+        samples = self.last()
+        if len(samples) == 0:
+            return samples
+        timestamps = samples['timestamp']
+        start = np.searchsorted(timestamps, timestamps[-1] - seconds, side = 'left')
+        return samples[start:]
+
+    def stats(self, seconds = None, n = None):
+        '''
+        Computes statistics of position and voltage over the last 'seconds' seconds, or over the last n samples (if seconds is None),
+        or over all samples (if both are None)
+
+        Returns
+        -------
+        dict
+            Dictionary with keys 'numb_samples', 'duration', and, for each quantity q in ['position', 'voltage'], the keys 'q_mean', 'q_std',
+            'q_min', 'q_max', 'q_drift' (slope of a linear fit vs time, in units of q per second)
+        '''
+        samples = self.last_seconds(seconds) if seconds is not None else self.last(n)
+        result = {'numb_samples': len(samples), 'duration': 0.0}
+        if len(samples) == 0:
+            for quantity in ['position', 'voltage']:
+                for key in ['mean', 'std', 'min', 'max', 'drift']:
+                    result[f"{quantity}_{key}"] = float('nan')
+            return result
+        t = samples['timestamp'] - samples['timestamp'][0]
+        result['duration'] = float(t[-1])
+        t_centered = t - t.mean()
+        t_var = float(np.dot(t_centered, t_centered))
+        for quantity in ['position', 'voltage']:
+            values = samples[quantity]
+            result[f"{quantity}_mean"] = float(values.mean())
+            result[f"{quantity}_std"] = float(values.std())
+            result[f"{quantity}_min"] = float(values.min())
+            result[f"{quantity}_max"] = float(values.max())
+            result[f"{quantity}_drift"] = float(np.dot(t_centered, values) / t_var) if t_var > 0 else float('nan')
+        return result
@@ -0,0 +1,188 @@
+'''
+Compensation of the hysteresis of the piezo in open loop.
+
+In open loop the device only sets the output voltage, and the displacement of the piezo depends on the voltage and on its history (hysteresis):
+for the same voltage the displacement is larger when the voltage is decreasing than when it is increasing. Open loop movements settle much faster
+than close loop ones, so an accurate open loop positioning allows faster scans.
+
+calibrate() sweeps the output voltage up and down over the whole range (major hysteresis loop), reading the strain gauge at each voltage, and fits
+the inverse model voltage(position) separately on the ascending and on the descending branch (polynomial fits). The two inverse branches are
+then stored as a dense lookup table (hysteresis_model.table) on a uniform grid of positions, so that resolving the voltage of any number of
+positions only requires vectorized linear interpolation (the index in the table is computed directly, no search is needed).
+
+The model keeps track of the direction of the last movement. When the direction is reversed inside the loop (minor loop), the major branch
+of the new direction is scaled (in position and in voltage) so that it starts from the reversal point and ends at the end of the major loop
+(congruent minor loops, as in a Preisach model with the Madelung rules), so that the voltage is continuous at the reversal point. Only the last
+reversal point is remembered. Creep is not modelled: after a large movement the position keeps drifting slowly (by a few % of the step).
+
+    device.mode = 'OpenLoop'
+    device.calibrate_open_loop()                # see calibrate() for the parameters
+    device.set_position_open_loop(5.0)
+'''
+import time
+import numpy as np
+
+class hysteresis_model():
+    '''
+    Parameters
+    ----------
+    positions : numpy.ndarray
+        Uniform grid of positions (in um) of the lookup table
+    table : numpy.ndarray
+        Array with shape (2, len(positions)): voltages (in V) needed to reach each position along the ascending (table[0]) and descending (table[1]) branch
+
+    Attributes
+    ----------
+    last_position, last_voltage : float
+        Last position resolved by the model, and the corresponding voltage. None if unknown (see reset())
+    direction : int
+        +1 if the last movement was towards larger positions, -1 otherwise
+    turning_position, turning_voltage : float
+        Position and voltage where the direction was last reversed (None = the piezo is on the major loop)
+    '''
+    ASCENDING = 0
+    DESCENDING = 1
+
+    def __init__(self, positions, table):
+        self.positions = np.asarray(positions, dtype = float)
+        self.table = np.asarray(table, dtype = float)
+        self.min_position = self.positions[0]
+        self.max_position = self.positions[-1]
+        self._step = (self.max_position - self.min_position) / (len(self.positions) - 1)
+        self.reset()
+
+    def reset(self, position = None, voltage = None, direction = -1):
+        '''
+        Set the state of the piezo (e.g. after the voltage has been changed without using this model). If position and voltage are given, the next
+        movement starts from this point, otherwise the next movement starts on the major loop
+        '''
+        self.last_position = position
+        self.last_voltage = voltage
+        self.direction = direction
+        self.turning_position = position
+        self.turning_voltage = voltage
+
+    def lookup(self, branch, positions):
+        # Vectorized linear interpolation of the lookup table of the given branch. Positions outside the calibrated range are clipped
+        index = (np.clip(positions, self.min_position, self.max_position) - self.min_position) / self._step
+        i = np.minimum(index.astype(int), len(self.positions) - 2)
+        fraction = index - i
+        return self.table[branch, i] * (1 - fraction) + self.table[branch, i + 1] * fraction
+
+    def _branch_voltages(self, positions, direction, turning_position, turning_voltage):
+        # After a reversal at (turning_position, turning_voltage), the movement follows the major branch of the new direction, scaled so that it
+        # starts from the reversal point and ends at the end of the major loop (congruent minor loops)
+        if direction > 0:
+            if turning_position is None or turning_position <= self.min_position:
+                return self.lookup(self.ASCENDING, positions)
+            (start_voltage, end_voltage) = (self.table[self.ASCENDING, 0], self.table[self.ASCENDING, -1])
+            scaled_positions = self.max_position - (self.max_position - positions) * (self.max_position - self.min_position) / max(self.max_position - turning_position, 1e-12)
+            return end_voltage - (end_voltage - self.lookup(self.ASCENDING, scaled_positions)) * (end_voltage - turning_voltage) / (end_voltage - start_voltage)
+        else:
+            if turning_position is None or turning_position >= self.max_position:
+                return self.lookup(self.DESCENDING, positions)
+            (start_voltage, end_voltage) = (self.table[self.DESCENDING, 0], self.table[self.DESCENDING, -1])
+            scaled_positions = self.min_position + (positions - self.min_position) * (self.max_position - self.min_position) / max(turning_position - self.min_position, 1e-12)
+            return start_voltage + (self.lookup(self.DESCENDING, scaled_positions) - start_voltage) * (turning_voltage - start_voltage) / (end_voltage - start_voltage)
+
+    def voltages_for(self, positions):
+        '''
+        Returns the voltages needed to reach, one after the other, the positions in the array positions, and updates the state of the model.
+        The array is split in monotonic segments; the voltages of each segment are computed in a single vectorized operation
+        '''
+        positions = np.atleast_1d(np.asarray(positions, dtype = float))
+        voltages = np.empty_like(positions)
+        if len(positions) == 0:
+            return voltages
+        previous = np.concatenate([[positions[0] if self.last_position is None else self.last_position], positions[:-1]])
+        sign = np.sign(positions - previous)
+        # Direction of each movement (a movement of zero length keeps the previous direction)
+        last_nonzero = np.maximum.accumulate(np.where(sign != 0, np.arange(len(sign)), -1))
+        directions = np.where(last_nonzero >= 0, sign[np.maximum(last_nonzero, 0)], self.direction).astype(int)
+        reversals = np.flatnonzero(np.diff(np.concatenate([[self.direction], directions])) != 0)
+        boundaries = np.concatenate([[0], reversals[reversals > 0], [len(positions)]])
+        for (start, end) in zip(boundaries[:-1], boundaries[1:]):
+            if directions[start] != self.direction:
+                # Reversal: the new branch starts from the current state of the piezo
+                self.turning_position = previous[start]
+                self.turning_voltage = voltages[start - 1] if start > 0 else self.last_voltage
+                if self.turning_voltage is None:
+                    self.turning_position = None
+                self.direction = directions[start]
+            voltages[start:end] = self._branch_voltages(positions[start:end], self.direction, self.turning_position, self.turning_voltage)
+        self.last_position = positions[-1]
+        self.last_voltage = voltages[-1]
+        return voltages
+
+    def voltage_for(self, position):
+        return float(self.voltages_for([position])[0])
+
+    def save(self, path):
+        np.savez(path, positions = self.positions, table = self.table)
+
+def load_model(path):
+    data = np.load(path)
+    return hysteresis_model(data['positions'], data['table'])
+
+def fit_model(voltages_up, positions_up, voltages_down, positions_down, degree = 7, table_size = 4096):
+    '''
+    Fit the inverse model voltage(position) of the ascending (voltages_up, positions_up) and descending (voltages_down, positions_down) branch with
+    polynomials of the given degree, and tabulate them on a uniform grid of table_size positions. Returns a hysteresis_model
+    '''
+    min_position = max(np.min(positions_up), np.min(positions_down))
+    max_position = min(np.max(positions_up), np.max(positions_down))
+    min_voltage = min(np.min(voltages_up), np.min(voltages_down))
+    max_voltage = max(np.max(voltages_up), np.max(voltages_down))
+    positions = np.linspace(min_position, max_position, table_size)
+    table = np.empty((2, table_size))
+    for branch, (voltages, measured_positions) in enumerate([(voltages_up, positions_up), (voltages_down, positions_down)]):
+        fit = np.polynomial.Polynomial.fit(measured_positions, voltages, degree)
+        # The voltage must be a non-decreasing function of the position, and within the range used during the calibration
+        table[branch] = np.maximum.accumulate(np.clip(fit(positions), min_voltage, max_voltage))
+    return hysteresis_model(positions, table)
+
+def calibrate(instrument, numb_points = 101, numb_cycles = 2, dwell = 0.05, numb_reads = 3, voltage_range = None, degree = 7, table_size = 4096,
+              sleep = time.sleep):
+    '''
+    Measure the major hysteresis loop of the piezo connected to instrument (a driver.pyThorlabsKCubeKPC101 object) and return the fitted hysteresis_model.
+
+    The output voltage is swept numb_cycles times from the minimum to the maximum voltage and back, in numb_points steps per direction. At each
+    step, after waiting dwell s, the position is read numb_reads times and averaged. Only the last cycle is used for the fit, the previous ones
+    bring the piezo onto the major loop. The device is set in open loop during the calibration, and its original mode is restored at the end.
+
+    voltage_range
+        Tuple (min_voltage, max_voltage). If None, the voltage limits of the device are used
+    degree, table_size
+        See fit_model()
+    sleep
+        Function used to wait (e.g. the sleep method of the clock of a driver_virtual.virtual_piezo)
+    '''
+    instrument.check_valid_connection()
+    (min_voltage, max_voltage) = voltage_range if voltage_range else instrument.voltage_limits_f
+    sweep = np.linspace(min_voltage, max_voltage, numb_points)
+    original_mode = instrument.mode
+    instrument.mode = 'OpenLoop'
+    def measure(voltages):
+        positions = np.empty(len(voltages))
+        for index, voltage in enumerate(voltages):
+            instrument.set_voltage_f(float(voltage))
+            sleep(dwell)
+            positions[index] = np.mean([instrument.position_f for _ in range(numb_reads)])
+        return positions
+    try:
+        instrument.set_voltage_f(float(min_voltage))
+        sleep(10 * dwell)
+        for cycle in range(numb_cycles):
+            positions_up = measure(sweep)
+            positions_down = measure(sweep[::-1])
+    finally:
+        instrument.mode = original_mode
+    model = fit_model(sweep, positions_up, sweep[::-1], positions_down, degree = degree, table_size = table_size)
+    # Error of the fit, in um: difference between the measured positions and the positions predicted by the (inverted) table
+    residuals = np.concatenate([np.interp(sweep, model.table[model.ASCENDING], model.positions) - positions_up,
+                                np.interp(sweep[::-1], model.table[model.DESCENDING], model.positions) - positions_down])
+    inside = np.concatenate([(positions_up >= model.min_position) & (positions_up <= model.max_position),
+                             (positions_down >= model.min_position) & (positions_down <= model.max_position)])
+    model.rms_error = float(np.sqrt(np.mean(residuals[inside]**2)))
+    model.calibration_data = {'voltages': sweep, 'positions_up': positions_up, 'positions_down': positions_down}
+    return model
@@ -0,0 +1,118 @@
+'''
+Opt-in instrumentation of the calls made by the driver to the device object (e.g. GetPosition, SetPosition, IsSetPositionActive, Jog, ...).
+
+When instrumentation is enabled (see driver.pyThorlabsKCubeKPC101.enable_instrumentation), the device object is wrapped by an instrumented_device
+proxy, which times every method call (and every property access) and stores count and latency histogram of each method in a call_statistics object.
+When instrumentation is disabled the driver uses the bare device object, so there is no overhead at all.
+The proxy only relies on attribute access, so it works in the same way with the Kinesis .NET objects and with any stand-in device (see backends.py).
+'''
+import time
+import json
+import bisect
+import threading
+
+# Edges (in s) of the latency histogram: 4 bins per decade, from 1 us to 10 s. Two additional bins collect latencies below/above this range
+HISTOGRAM_EDGES = [1e-6 * 10**(k / 4) for k in range(0, 29)]
+
+class method_statistics():
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.histogram = [0] * (len(HISTOGRAM_EDGES) + 1)
+
+    def record(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration < self.min:
+            self.min = duration
+        if duration > self.max:
+            self.max = duration
+        self.histogram[bisect.bisect_right(HISTOGRAM_EDGES, duration)] += 1
+
+    def percentile(self, q):
+        # Approximate q-th percentile (0 <= q <= 100), estimated from the histogram (upper edge of the bin containing the percentile)
+        if self.count == 0:
+            return float('nan')
+        threshold = q / 100 * self.count
+        cumulative = 0
+        for index, counts in enumerate(self.histogram):
+            cumulative += counts
+            if cumulative >= threshold:
+                return HISTOGRAM_EDGES[index] if index < len(HISTOGRAM_EDGES) else self.max
+        return self.max
+
+    def to_dict(self):
+        edges = [0.0] + HISTOGRAM_EDGES + [float('inf')]
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count else float('nan'),
+                'min': self.min if self.count else float('nan'),
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'histogram': [[edges[i], edges[i + 1], counts] for i, counts in enumerate(self.histogram) if counts > 0]}
+
+class call_statistics():
+    '''
+    Collects the statistics of the calls made to the device, grouped by method name
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.methods = dict()
+
+    def record(self, name, duration):
+        with self._lock:
+            if not (name in self.methods):
+                self.methods[name] = method_statistics()
+            self.methods[name].record(duration)
+
+    def reset(self):
+        with self._lock:
+            self.methods = dict()
+
+    def to_dict(self):
+        with self._lock:
+            return {name: stats.to_dict() for name, stats in sorted(self.methods.items())}
+
+    def to_json(self, **kwargs):
+        # Infinite values (e.g. the upper edge of the last histogram bin) are exported as null
+        data = self.to_dict()
+        for stats in data.values():
+            for row in stats['histogram']:
+                if row[1] == float('inf'):
+                    row[1] = None
+            for key in ['mean', 'min', 'p50', 'p99']:
+                if stats[key] != stats[key]:
+                    stats[key] = None
+        return json.dumps(data, **kwargs)
+
+class instrumented_device():
+    '''
+    Proxy of a device object. Every method call (and every property access) is forwarded to the wrapped device and timed.
+    The wrapped device is available as instrumented_device.device
+    '''
+    def __init__(self, device, statistics):
+        object.__setattr__(self, 'device', device)
+        object.__setattr__(self, 'statistics', statistics)
+
+    def __getattr__(self, name):
+        # Called only for attributes which are not found on the proxy itself, i.e. the first time a method is used, or for properties
+        start = time.perf_counter()
+        attribute = getattr(self.device, name)
+        if not callable(attribute):
+            self.statistics.record(name, time.perf_counter() - start)
+            return attribute
+        record = self.statistics.record
+        def timed_method(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        object.__setattr__(self, name, timed_method)  # Cache the wrapper, so that the next calls do not go through __getattr__
+        return timed_method
+
+    def __setattr__(self, name, value):
+        setattr(self.device, name, value)
@@ -10,9 +10,12 @@ import logging
 import sys
 import argparse
 import time
+import copy
+import threading
 
 import abstract_instrument_interface
-import pyThorlabsKCubeKPC101.driver
+import pyThorlabsKCubeKPC101.controller
+import pyThorlabsKCubeKPC101.ramp
 
 graphics_dir = os.path.join(os.path.dirname(__file__), 'graphics')
 
@@ -24,12 +27,17 @@ class interface(abstract_instrument_interface.abstract_interface):
     Create a high-level interface with the device, validates input data and perform high-level tasks such as periodically reading data from the instrument.
     It uses signals (i.e. QtCore.pyqtSignal objects) to notify whenever relevant data has changes or event has happened. These signals are typically received by the GUI
     Several general-purpose attributes and methods are defined in the class abstract_interface defined in abstract_instrument_interface
+
+    This class is a thin Qt adapter of controller.controller, which implements all the logic without depending on Qt. The events of the controller 
+    are re-emitted as Qt signals, and the controller is set up so that all its work (settle polling, processing of the acquired data) is done in the GUI thread.
     ...
 
     Attributes specific for this class (see the abstract class abstract_instrument_interface.abstract_interface for general attributes)
     ----------
+    controller
+        Instance of controller.controller
     instrument
-        Instance of driver.pyThorlabsKCubeKPC101
+        Instance of driver.pyThorlabsKCubeKPC101 (same as controller.instrument)
     connected_device_name : str
         Name of the physical device currently connected to this interface 
     settings = {    'step_size': 1,
@@ -37,8 +45,11 @@ class interface(abstract_instrument_interface.abstract_interface):
                                 ....
                                 }
                     }
+        The same dictionary is used by the controller, see controller.DEFAULT_SETTINGS
     ramp 
-        Instance of abstract_instrument_interface.ramp class 
+        Instance of native_ramp, a subclass of abstract_instrument_interface.ramp whose sequence is executed by ramp.ramp_engine
+    history
+        Instance of history.history_buffer, it stores the last self.settings['history_capacity'] states read from the device
 
     Methods defined in this class (see the abstract class abstract_instrument_interface.abstract_interface for general methods)
     -------
@@ -50,9 +61,6 @@ class interface(abstract_instrument_interface.abstract_interface):
         Disconnect the currently connected device
     close()
         Closes this interface, close plot window (if any was open), and calls the close() method of the parent class, which typically calls the disconnect_device method
-   
-    set_connected_state()
-        This method also calls the set_connected_state() method defined in abstract_instrument_interface.abstract_interface
 
     TO FINISH
 
@@ -64,8 +72,10 @@ class interface(abstract_instrument_interface.abstract_interface):
     #                                                           | Triggered when ...                                            | Sends as parameter    
     #                                                       #   -----------------------------------------------------------------------------------------------------------------------         
     sig_list_devices_updated = QtCore.pyqtSignal(list)      #   | List of devices is updated                                    | List of devices   
+    sig_list_devices_changed = QtCore.pyqtSignal(list,list) #   | The device watcher found devices plugged in or unplugged      | Serial numbers added, serial numbers removed
     sig_update_position = QtCore.pyqtSignal(object)         #   | Position has changed/been read                                | New position
     sig_update_voltage = QtCore.pyqtSignal(object)          #   | Voltage has changed/been read                                 | New voltage
+    sig_update_state = QtCore.pyqtSignal(object)            #   | Position, voltage and mode have been read together            | driver.state_snapshot object
     sig_step_size_changed = QtCore.pyqtSignal(str,float)      #   | Step size of position or voltage has been changed             | Type (='position' or 'voltage), Step size must be a string
     sig_mode_changed = QtCore.pyqtSignal(str)               #   | The mode of the piezo (Open Loop or Close Loop) has changed   | string equal to either 'CloseLoop' or 'OpenLoop'
     sig_change_moving_status = QtCore.pyqtSignal(int)       #   | A movement has started or has ended                           | 1 = movement has started,  2 = movement has ended
@@ -73,6 +83,7 @@ class interface(abstract_instrument_interface.abstract_interface):
     #sig_change_homing_status = QtCore.pyqtSignal(int)       #   | Homing has started or has ended                               | 1 = homing has started,  2 = homing has ended
     #sig_stage_info = QtCore.pyqtSignal(list)                #   | Stage parameters have been written/read                       | List containing the stage parameters
     sig_device_zeroed = QtCore.pyqtSignal()                 #   | Device has been zeroed
+    sig_call_in_gui_thread = QtCore.pyqtSignal(object)      #   | A background thread of the controller produced some data      | Tuple (function, args), the slot calls function(*args) in the GUI thread
     ##
     # Identifier codes used for view-model communication. Other general-purpose codes are specified in abstract_instrument_interface
     SIG_MOVEMENT_STARTED = 1
@@ -81,116 +92,163 @@ class interface(abstract_instrument_interface.abstract_interface):
     SIG_HOMING_ENDED = 2
 
     def __init__(self, **kwargs):
-        self.output = {'Position':0,'Voltage':0} 
-        ### Default values of settings (might be overlapped by settings saved in .json files later)
-        self.settings = {   'step_size': {
-                                            'position':0.1,
-                                            'voltage':0.5
-                                        },
-                            'mode': 'CloseLoop',
-                            'refresh_time': 0.2,
-                            'ramp' : {  
-                                        'ramp_step_size': 1,            #Increment value of each ramp step
-                                        'ramp_wait_1': 1,               #Wait time (in s) after each ramp step
-                                        'ramp_send_trigger' : True,     #If true, the function self.func_trigger is called after each 'movement'
-                                        'ramp_wait_2': 1,               #Wait time (in s) after each (potential) call to trigger, before doing the new ramp step
-                                        'ramp_numb_steps': 10,          #Number of steps in the ramp
-                                        'ramp_repeat': 1,               #How many times the ramp is repeated
-                                        'ramp_reverse': 1,              #If True (or 1), it repeates the ramp in reverse
-                                        'ramp_send_initial_trigger': 1, #If True (or 1), it calls self.func_trigger before starting the ramp
-                                        'ramp_reset' : 1                #If True (or 1), it resets the value of the instrument to the initial one after the ramp is done
-                                        }
-                            }
-        self.list_devices = []              #list of devices found 
-        self.connected_device_name = ''
-        self.continuous_read = True
-        self._units = {'position':'um','voltage':'V'}
-        self._possible_quantities_to_control = ['position', 'voltage']
-        
-        
-        ###
-        # if ('virtual' in kwargs.keys()) and (kwargs['virtual'] == True):
-        #     #self.instrument =  pyThorlabsKCube.driver_virtual.pyThorlabsKCube() 
-        #     self.instrument = none
-        # else:    
-        #     
-        ###
-        self.instrument =  pyThorlabsKCubeKPC101.driver.pyThorlabsKCubeKPC101() 
+        ### Default values of settings (might be overlapped by settings saved in .json files later). The same dictionary is shared with the controller
+        self.settings = copy.deepcopy(pyThorlabsKCubeKPC101.controller.DEFAULT_SETTINGS)
         super().__init__(**kwargs)
 
-        # Setting up the ramp object, which is defined in the package abstract_instrument_interface
-        self.ramp = abstract_instrument_interface.ramp(interface=self)  
+        # The optional keyword argument 'backend' allows to specify the backend used by the driver (see backends.py), e.g. a backends.simulated_backend()
+        backend = kwargs['backend'] if ('backend' in kwargs.keys()) else None
+        virtual = ('virtual' in kwargs.keys()) and (kwargs['virtual'] == True)
+        self.sig_call_in_gui_thread.connect(lambda call: call[0](*call[1]))
+        self.controller = pyThorlabsKCubeKPC101.controller.controller(backend = backend, virtual = virtual, settings = self.settings, config_file = None,
+                                                                      logger = self.logger, 
+                                                                      call_later = lambda delay, function: self._run_in_gui_thread(QtCore.QTimer.singleShot, int(delay*1e3), function),
+                                                                      run_in_main_thread = self._run_in_gui_thread)
+        self.instrument = self.controller.instrument
+        self.output = self.controller.output
+        self.emit_separate_signals = False   # If True, each state read periodically is also emitted with sig_update_position and sig_update_voltage (see _emit_update_state)
+
+        # Events of the controller are re-emitted as Qt signals
+        events_to_signals = {   'list_devices_updated': self.sig_list_devices_updated,
+                                'list_devices_changed': self.sig_list_devices_changed,
+                                'connected': self.sig_connected,
+                                'update_position': self.sig_update_position,
+                                'update_voltage': self.sig_update_voltage,
+                                'step_size_changed': self.sig_step_size_changed,
+                                'mode_changed': self.sig_mode_changed,
+                                'moving_status': self.sig_change_moving_status,
+                                'refresh_time': self.sig_refreshtime,
+                                'device_zeroed': self.sig_device_zeroed}
+        for event, signal in events_to_signals.items():
+            self.controller.subscribe(event, signal.emit)
+        self.controller.subscribe('update_state', self._emit_update_state)
+        self.controller.subscribe('trigger', lambda: abstract_instrument_interface.abstract_interface.update(self))
+
+        # Setting up the ramp object. It has the same settings, signals and GUI (abstract_instrument_interface.ramp_gui) of the ramp defined in the package 
+        # abstract_instrument_interface, but the ramp is executed by the native engine (see ramp.py and the class native_ramp below)
+        self.ramp = native_ramp(interface=self)  
         self.ramp.set_ramp_settings(self.settings['ramp'])
-        self.ramp.set_ramp_functions(func_move = self.instrument.jog_by,
+        self.ramp.set_ramp_functions(func_move = self.jog_by,
                                      func_check_step_has_ended = self.is_device_not_moving, 
                                      func_trigger = lambda: self.update(do_not_repeat=True), 
                                      func_trigger_continue_ramp = None,
-                                     func_set_value = self.set_position, 
-                                     func_read_current_value = self.read_position, 
+                                     func_set_value = self.controller.set_ramp_value, 
+                                     func_read_current_value = self.controller.read_ramp_value, 
                                      list_functions_step_not_ended = [],  
                                      list_functions_step_has_ended = [lambda:self.end_movement(send_signal=False)],  
                                      list_functions_ramp_ended = [])
         self.ramp.sig_ramp.connect(self.on_ramp_state_changed)
+
         self.refresh_list_devices()
+        self.start_device_watcher()
+
+    def _run_in_gui_thread(self, function, *args):
+        # The signal is delivered to the GUI thread (queued connection) when emitted from another thread, and directly otherwise
+        self.sig_call_in_gui_thread.emit((function, args))
+
+    def _run_in_gui_thread_and_wait(self, function, stop_event = None):
+        # Same as self._run_in_gui_thread, but blocks until function() has been executed (or until stop_event is set)
+        done = threading.Event()
+        def call():
+            try:
+                function()
+            finally:
+                done.set()
+        self._run_in_gui_thread(call)
+        while not done.wait(0.05):
+            if stop_event and stop_event.is_set():
+                return
+
+    ## Attributes of the controller
+    @property
+    def list_devices(self):
+        return self.controller.list_devices
 
-    def refresh_list_devices(self):
-        '''
-        Get a list of all devices connected, by using the method list_devices() of the driver. For each device obtain its identity and its address.
-        '''            
-        self.logger.info(f"Looking for devices...") 
-        list_valid_devices = self.instrument.list_devices()
-        self.logger.info(f"Found {len(list_valid_devices)} devices.") 
-        self.list_devices = list_valid_devices
-        self.send_list_devices()
+    @property
+    def connected_device_name(self):
+        return self.controller.connected_device_name
+
+    @property
+    def last_settle_time(self):
+        return self.controller.last_settle_time
+
+    @property
+    def connection_timings(self):
+        return self.controller.connection_timings
+
+    @property
+    def continuous_read(self):
+        return self.controller.continuous_read
+
+    @continuous_read.setter
+    def continuous_read(self, value):
+        self.controller.continuous_read = value
+
+    @property
+    def history(self):
+        return self.controller.history
+
+    @property
+    def acquisition(self):
+        return self.controller.acquisition
+
+    @property
+    def command_queue_stats(self):
+        # Depth of the command queue and number of submitted, executed and dropped (coalesced) commands, see controller.controller.submit_command
+        return self.controller.command_queue_stats
+
+    @property
+    def device_watcher(self):
+        return self.controller.device_watcher
+
+    def _emit_update_state(self, state):
+        # Each state read from the device is emitted once, with sig_update_state. sig_update_position and sig_update_voltage are emitted by explicit
+        # reads (read_position, read_voltage) and, if self.emit_separate_signals is True, also for each state (for code connected only to these two signals)
+        self.sig_update_state.emit(state)
+        if self.emit_separate_signals:
+            self.sig_update_position.emit(state.position)
+            self.sig_update_voltage.emit(state.voltage)
+
+    @property
+    def recorder(self):
+        return self.controller.recorder
+
+    @property
+    def acquisition_stats(self):
+        # Statistics of the acquisition worker (number of samples, drift and missed deadlines, see acquisition.acquisition_worker)
+        return self.controller.acquisition_stats
+
+    @property
+    def _units(self):
+        return self.controller._units
+
+    ## Methods of the controller
+    def refresh_list_devices(self, force = False):
+        return self.controller.refresh_list_devices(force = force)
 
     def send_list_devices(self):
-        '''
-        Fire the signal sig_list_devices_updated, passing self.list_devices as parameter. This signal will be caught by the GUI
-        This method is typically called by the GUI after it is initialized, to let the interface know that it is ready
-        '''     
-        self.sig_list_devices_updated.emit(self.list_devices)
+        self.controller.send_list_devices()
+
+    def start_device_watcher(self):
+        self.controller.start_device_watcher()
+
+    def stop_device_watcher(self):
+        self.controller.stop_device_watcher()
 
     def connect_device(self,device_full_name):
-        '''
-        device_full_name
-            Serial number of device to connect to
-        ''' 
-        if(device_full_name==''): # Check  that the name is not empty
-            self.logger.error("No valid device has been selected")
-            return
-        self.set_connecting_state()
-        device_sn = device_full_name
-        self.logger.info(f"Connecting to device {device_sn}...")
-
-        try:
-            (Msg,ID) = self.instrument.connect_device(device_sn) # Try to connect by using the method ConnectDevice of the powermeter object
-            if(ID==1):  #If connection was successful
-                self.logger.info(f"Connected to device {device_sn}.")
-                self.connected_device_name = device_sn
-                self.set_connected_state()
-            else: #If connection was not successful
-                self.logger.error(f"Error: {Msg}")
-                self.set_disconnected_state()
-                pass
-        except Exception as e:
-            self.logger.error(f"Error: {e}")
-            self.set_disconnected_state()
+        return self.controller.connect_device(device_full_name)
 
     def disconnect_device(self):
-        self.logger.info(f"Disconnecting from device {self.connected_device_name}...")
-        self.set_disconnecting_state()
-        (Msg,ID) = self.instrument.disconnect_device()
-        if(ID==1): # If disconnection was successful
-            self.logger.info(f"Disconnected from device {self.connected_device_name}.")
-            self.set_disconnected_state()
-        else: #If disconnection was not successful
-            self.logger.error(f"Error: {Msg}")
-            self.set_disconnected_state() #When disconnection is not succeful, it is typically because the device alredy lost connection
-                                          #for some reason. In this case, it is still useful to have the widget reset to disconnected state                                       
+        return self.controller.disconnect_device()
     
     def close(self,**kwargs):
+        self.controller.stop_acquisition()
+        self.ramp.stop_ramp()
+        if self.instrument.connected:
+            self.instrument.persist_settings() # Save any pending change of settings to the device memory
         self.settings['ramp'] = self.ramp.settings
-        super().close(**kwargs) 
+        super().close(**kwargs) # Saves the settings and disconnects the device
+        self.controller.close(save_settings = False)
         
     @property
     def position(self):
@@ -204,7 +262,7 @@ class interface(abstract_instrument_interface.abstract_interface):
     def voltage(self):
         return self.read_voltage()
 
-    @position.setter
+    @voltage.setter
     def voltage(self, value):
         self.set_voltage(value)
 
@@ -215,62 +273,21 @@ class interface(abstract_instrument_interface.abstract_interface):
     @mode.setter
     def mode(self, value):
         self.set_mode(value)
-        
-    def set_connected_state(self):
-        super().set_connected_state()
-        self.logger.info(f"Setting parameters (based on values in config.json file)... ")
-        self.logger.info(f"{self.settings['step_size']}")
-        self.set_step_size('position',self.settings['step_size']['position'])
-        self.set_step_size('voltage',self.settings['step_size']['voltage'])
-        self.get_step_size() #we re-read them again from the device
-        self.set_mode(self.settings['mode'])
-        # NOTE: the call to self_set_mode also calls read_position() and read_voltage() (if the change of mode was succesful)
-
-        self.update(call_super_update = False)
-        #self.read_position()
-        #self.read_voltage()
-        #self.read_stage_info()         
-        
+
     def set_moving_state(self):
-        self.sig_change_moving_status.emit(self.SIG_MOVEMENT_STARTED)
+        self.controller.set_moving_state()
                              
     def set_non_moving_state(self): 
-        self.sig_change_moving_status.emit(self.SIG_MOVEMENT_ENDED)
+        self.controller.set_non_moving_state()
 
     def is_device_moving(self):
-        is_busy = self.instrument.is_busy
-        return is_busy
+        return self.controller.is_device_moving()
 
     def is_device_not_moving(self):
          return not(self.is_device_moving())
     
     def set_refresh_time(self, refresh_time):
-        try: 
-            refresh_time = float(refresh_time)
-            if self.settings['refresh_time'] == refresh_time: #in this case the number in the refresh time edit box is the same as the refresh time currently stored
-                return True
-        except ValueError:
-            self.logger.error(f"The refresh time must be a valid number.")
-            self.sig_refreshtime.emit(self.settings['refresh_time'])
-            return False
-        if refresh_time < 0.1:
-            self.logger.error(f"The refresh time must be positive and >= 0.1s.")
-            self.sig_refreshtime.emit(self.settings['refresh_time'])
-            return False
-        self.logger.info(f"The refresh time is now {refresh_time} s.")
-        self.settings['refresh_time'] = refresh_time
-        self.sig_refreshtime.emit(self.settings['refresh_time'])
-        return True
-
-    # def stop_any_movement(self):
-    #     if self.is_device_not_moving():
-    #         self.logger.error(f"Motors cannot be stopped because they are not moving.")
-    #     else:
-    #         try:
-    #             self.instrument.stop_profiled()
-    #             self.logger.info(f"Movement was stopped by user.")
-    #         except Exception as e:
-    #             self.logger.error(f"Some error occured while trying to stop the motor: {e}")
+        return self.controller.set_refresh_time(refresh_time)
                         
     def on_ramp_state_changed(self,status):
         '''
@@ -283,194 +300,147 @@ class interface(abstract_instrument_interface.abstract_interface):
             self.set_non_moving_state()
 
     def get_step_size(self):
-        step_size = self.instrument.jog_steps
-        #self.settings['step_size'] = step_size
-        for key, value in step_size.items():
-            self.settings['step_size'][key] = float(str(value))
-        for key, value in self.settings['step_size'].items():
-            self.sig_step_size_changed.emit(key,value)
-        return self.settings['step_size']
+        return self.controller.get_step_size()
     
     def set_step_size(self, type:str, step_size:float):
         '''   
         :param type: Identify the property for which the step size is being changed. Possible values = 'position', 'voltage'    
         :param step_size: Numerical Value of step size 
         '''
-        if not ( type in self._possible_quantities_to_control):
-            self.logger.error(f"Possible value of input parameter 'type' are {self._possible_quantities_to_control}.")
-            return False
-        try: 
-            step_size = float(step_size)
-        except ValueError:
-            self.logger.error(f"The step size must be a valid float number.")
-            self.sig_step_size_changed.emit(type,self.settings['step_size'][type])
-            return False
-        try:
-            #self.logger.info(step_size)
-            self.logger.info(f"Changing step size for {type} to {step_size} {self._units[type]}...")
-            self.instrument.set_jog_steps(**{type: step_size})
-            self.logger.info(f"The step size for {type} has been set to {step_size} {self._units[type]}.")
-            #
-            self.settings['step_size'][type] = step_size
-            self.sig_step_size_changed.emit(type,self.settings['step_size'][type])
-            return True
-        except Exception as e:
-            self.logger.error(f"Error: {e}")
-            return False
-    
-    # def home(self):
-    #     if self.is_device_moving():
-    #         self.logger.error(f"Cannot start homing while device is moving.")
-    #         return
-    #     self.logger.info(f"Homing device...")
-    #     self.set_moving_state()
-    #     self.sig_change_homing_status.emit(self.SIG_HOMING_STARTED)
-    #     self.sig_change_moving_status.emit(self.SIG_MOVEMENT_STARTED)
-    #     self.instrument.move_home()
-    #     #Start checking periodically the value of self.instrument.is_in_motion. It it's true, we read current
-    #     #position and update it in the GUI. When it becomes False, call self.end_movement
-    #     self.check_property_until(lambda : self.instrument.is_in_motion,[True,False],
-    #                               [
-    #                                   [self.read_position],
-    #                                   [self.end_movement,
-    #                                    lambda x=None:self.sig_change_homing_status.emit(self.SIG_HOMING_ENDED),
-    #                                    lambda x=None:self.sig_change_moving_status.emit(self.SIG_MOVEMENT_ENDED)
-    #                                   ]
-    #                                ])
+        return self.controller.set_step_size(type, step_size)
 
     def jog(self, direction:int):
-        # The quantity being jogged (voltage, position or percentage) is automatically decided by the device depending on the piezo mode (CloseLoop vs OpenLoop) and other settings
-        #if self.is_device_moving():
-        #    self.logger.error(f"Cannot start moving while device is busy (You might need to zero the device).")
-        #    return
-        if not ( direction in [-1,1]):
-            self.logger.error(f"Possible value of input parameter 'direction' are +1 (Move Forward) and -1 (Move Backward).")
-            return False
-        self.logger.info(f"Jogging...")
-        self.set_moving_state()
-        self.instrument.jog(direction)
-        #Start checking periodically the value of self.instrument.is_in_motion. It it's true, we read current
-        #position. When it becomes False, call self.end_movement
-        self.check_property_until(lambda : self.is_device_moving(),[True,False],[[self.read_position,self.read_voltage],[self.end_movement]])
+        return self.controller.jog(direction)
+
+    def jog_by(self, step:float):
+        return self.controller.jog_by(step)
         
+    def watch_settle(self, target = None):
+        # See controller.controller.watch_settle. The device is polled via QTimer, without blocking the GUI
+        self.controller.watch_settle(target = target)
+
     def end_movement(self,send_signal = True):
-        # When send_signal = False, the method self.set_non_moving_state() is NOT called, which means the signal self.sig_change_moving_status.emit(self.SIG_MOVEMENT_ENDED) is not emitted
-        # This is useful, e.g., when doing a ramp, when at each step of the ramp we want to read the position but we do not want to send the signal that the movement has ended, so that the GUI remains disabled
-        self.read_position()
-        self.read_voltage()
-        self.logger.info(f"Movement ended. New position = {self.output['Position']}. New voltage = {self.output['Voltage']}")
-        if send_signal:
-            self.set_non_moving_state()
+        self.controller.end_movement(send_signal = send_signal)
+
+    def read_state(self):
+        return self.controller.read_state()
 
     def read_position(self):
-        self.output['Position'] = float(str(self.instrument.position))
-        self.sig_update_position.emit(self.output['Position'])
-        return self.output['Position']
+        return self.controller.read_position()
     
     def read_voltage(self):
-        self.output['Voltage'] = float(str(self.instrument.voltage))
-        self.sig_update_voltage.emit(self.output['Voltage'])
-        return self.output['Voltage']
+        return self.controller.read_voltage()
         
     def set_position(self,position):
-        #if self.is_device_moving():
-        #    self.logger.error(f"Cannot start moving while device is busy (You might need to zero the device).")
-        #    return
-        try:
-            position = float(position)
-        except:
-            self.logger.error(f"Position value must be a valid float number.")
-            return
-        self.set_moving_state()
-        self.logger.info(f"Moving to {position}...")
-        try:
-            self.instrument.position = position
-        except Exception as e:
-            self.logger.error(f"Error: {e}")
-            self.end_movement()
-            return
-        #Start checking periodically the value of self.instrument.is_in_motion. It it's true, we read current
-        #position and update it in the GUI. When it becomes False, call self.end_movement
-        self.check_property_until(lambda : self.is_device_moving(),[True,False],[[self.read_position,self.read_voltage],[self.end_movement]])
+        return self.controller.set_position(position)
 
     def set_voltage(self,voltage):
-        #if self.is_device_moving():
-        #    self.logger.error(f"Cannot start moving while device is busy (You might need to zero the device).")
-        #    return
-        try:
-            voltage = float(voltage)
-        except:
-            self.logger.error(f"Voltage value must be a valid float number.")
-            return
-        self.set_moving_state()
-        self.logger.info(f"Changing voltage to {voltage}...")
-        try:
-            self.instrument.voltage = voltage
-        except Exception as e:
-            self.logger.error(f"Error: {e}")
-            self.end_movement()
-            return
-        #Start checking periodically the value of self.instrument.is_in_motion. It it's true, we read current
-        #position and update it in the GUI. When it becomes False, call self.end_movement
-        self.check_property_until(lambda : self.is_device_moving(),[True,False],[[self.read_position,self.read_voltage],[self.end_movement]])
+        return self.controller.set_voltage(voltage)
 
     def get_mode(self):
-        self.settings['mode'] = self.instrument.mode
-        self.sig_mode_changed.emit(self.settings['mode'])
-        return self.settings['mode']
+        return self.controller.get_mode()
     
     def set_mode(self,mode:str):
         # Possible values for variable mode are 'OpenLoop' and 'CloseLoop'
-        self.logger.info(f"Setting mode to {mode}...")
-        try:
-            self.instrument.mode = mode
-            self.logger.info(f"Mode changed correctly to {mode}.")
-            self.settings['mode'] = mode
-            self.sig_mode_changed.emit(self.settings['mode'])
-            self.read_position()
-            self.read_voltage()
-            return mode
-        except:
-            self.logger.error(f"Some error occurred when changing the device mode (see logs).")
-            return None
+        return self.controller.set_mode(mode)
         
     def set_zero(self):
-        self.logger.info(f"Zeroing device...")
-        try:
-            self.instrument.set_zero()
-            self.sig_device_zeroed.emit()
-            self.logger.info(f"Device has been zeroed correctly")
-            self.set_mode('OpenLoop')
-            self.set_mode('CloseLoop')
-            self.read_position()
-            self.read_voltage()
-        except:
-            self.logger.error(f"Some error occurred when chazeroingnging the device.")
-            return None
+        return self.controller.set_zero()
         
     def update(self,call_super_update = True, do_not_repeat = False):
         '''
-        This routine reads  the position and voltage from the piezo and stores its value; if self.continuous_read == 1, it calls itself
-         after a time given by self.refresh_time, unless do_not_repeat == True
-        If the input parameter call_super_update == True, the function super().update() is called, which also fires a trigger (which is 
-        useful when this interface is used with, e.g., Ergastirio)
-
-        1) Reads the position and voltage and stores them in the self.output dictionary
-            Reading position and voltage also fire the self.sig_update_position and self.sig_update_voltage events (which will be intercepted by the GUI)
-        2) If call_super_update == TrueCalls the update methods of the parent class abstract_instrument_interface.abstract_interface
-        3) If  self.continuous_read == 1, and do_no_repeat == False, Call itself after a time given by self.refresh_time
+        This routine reads  the position and voltage from the piezo and stores its value; if self.continuous_read == 1, it starts the background
+        acquisition worker, which keeps reading the device every self.settings['refresh_time'] seconds, unless do_not_repeat == True
+        If the input parameter call_super_update == True, the function super().update() is called (after each reading), which also fires a trigger 
+        (which is useful when this interface is used with, e.g., Ergastirio). See also controller.controller.update
         '''
-        
-        self.read_position()
-        self.read_voltage()
-        if call_super_update == True:
-            super().update()   
-        if (self.continuous_read == True and do_not_repeat==False):
-            QtCore.QTimer.singleShot(int(self.settings['refresh_time']*1e3), lambda: self.update(call_super_update = call_super_update))
-           
-        return
-    
+        self.controller.update(send_trigger = call_super_update, do_not_repeat = do_not_repeat)
+
+    def start_acquisition(self, call_super_update = True):
+        self.controller.start_acquisition(send_trigger = call_super_update)
+
+    def stop_acquisition(self):
+        self.controller.stop_acquisition()
+
+    def set_polling_rate(self, polling_rate):
+        return self.controller.set_polling_rate(polling_rate)
+
+    def set_adaptive_polling(self, adaptive):
+        self.controller.set_adaptive_polling(adaptive)
 
+    @property
+    def polling_stats(self):
+        # Time, CPU load and read latency measured with each polling interval, see controller.controller.polling_stats
+        return self.controller.polling_stats
+
+    def start_recording(self, path, **kwargs):
+        # Record every state read from the device in the file path (.npy, or .h5 if h5py is installed), see controller.controller.start_recording
+        return self.controller.start_recording(path, **kwargs)
+
+    def stop_recording(self):
+        self.controller.stop_recording()
+
+class native_ramp(abstract_instrument_interface.ramp):
+    '''
+    Ramp with the same settings, signals and methods of abstract_instrument_interface.ramp (so that it can be used by abstract_instrument_interface.ramp_gui,
+    and connected to the ramps of other instruments), whose sequence is executed by a ramp.ramp_engine on a separate thread. Each step sends the
+    absolute set point self.func_set_value(value), and waits are scheduled on a monotonic clock (see ramp.py). The trigger functions, and the 
+    functions in self.list_functions_*, are executed in the GUI thread.
+    '''
+    def __init__(self, interface):
+        super().__init__(interface)
+        self.engine = pyThorlabsKCubeKPC101.ramp.ramp_engine(func_set_value = lambda value: self.func_set_value(value),
+                                                              func_read_value = lambda: self.func_read_current_value(),
+                                                              func_wait_step_ended = self.interface.controller.wait_ramp_step_ended,
+                                                              func_trigger = self._trigger,
+                                                              func_trigger_continue_ramp = lambda: (self.func_trigger_continue_ramp is None) or self.func_trigger_continue_ramp(),
+                                                              func_step_ended = lambda: self._run_functions(self.list_functions_step_has_ended),
+                                                              on_started = self._on_started,
+                                                              on_ended = self._on_ended,
+                                                              on_step = self._on_step,
+                                                              logger = self.logger)
+
+    @property
+    def stats(self):
+        # Requested and achieved step rate of the current (or last) ramp, see ramp.ramp_engine.stats
+        return self.engine.stats
+
+    def start_ramp(self, *args, **kwargs):
+        if self.doing_ramp:
+            return
+        self.numb_steps_done = 0
+        self.doing_ramp = True
+        self.engine.start(self.settings)
+        self.numb_steps_total = self.engine.numb_steps_total
+
+    def stop_ramp(self):
+        # The ramp thread is not awaited, since it might be waiting for a function to be executed in the GUI thread
+        self.engine.stop(wait = False)
+
+    def _run_functions(self, functions):
+        for function in functions:
+            self.interface._run_in_gui_thread_and_wait(function, self.engine.stop_event)
+
+    def _trigger(self):
+        if self.func_trigger:
+            self.logger.info(f"Calling the trigger function...")
+            self.interface._run_in_gui_thread_and_wait(self.func_trigger, self.engine.stop_event)
+
+    def _on_started(self):
+        self.sig_ramp.emit(self.SIG_RAMP_STARTED)
+        self._run_functions(self.list_functions_ramp_started)
+        self.send_ramp_status()
+
+    def _on_step(self, index, setpoint):
+        self.numb_steps_done = index + 1
+        self.send_ramp_status()
+
+    def _on_ended(self):
+        self.doing_ramp = False
+        self.sig_ramp.emit(self.SIG_RAMP_ENDED)
+        for function in self.list_functions_ramp_ended:
+            self.interface._run_in_gui_thread(function)
+        self.send_ramp_status()
 
 class gui(abstract_instrument_interface.abstract_gui):
 
@@ -494,6 +464,7 @@ class gui(abstract_instrument_interface.abstract_gui):
         self.interface.sig_list_devices_updated.connect(self.on_list_devices_updated)
         self.interface.sig_connected.connect(self.on_connection_status_change) 
         self.interface.sig_mode_changed.connect(self.on_mode_change)
+        self.interface.sig_update_state.connect(self.on_state_change)
         self.interface.sig_update_position.connect(self.on_position_change)
         self.interface.sig_update_voltage.connect(self.on_voltage_change)
         self.interface.sig_step_size_changed.connect(self.on_step_size_change)
@@ -716,8 +687,11 @@ class gui(abstract_instrument_interface.abstract_gui):
             self.button_ConnectDevice.setText("Disconnect")
             
     def on_list_devices_updated(self,list_devices):
+        current_device = self.combo_Devices.currentText()
         self.combo_Devices.clear()  #First we empty the combobox  
         self.combo_Devices.addItems(list_devices) 
+        if current_device in list_devices: #Keep the current selection, if the device is still available
+            self.combo_Devices.setCurrentText(current_device)
 
     def on_mode_change(self,mode):
         if mode == 'OpenLoop':
@@ -732,12 +706,16 @@ class gui(abstract_instrument_interface.abstract_gui):
             return True
         return False
 
+    def on_state_change(self,state):
+        self.on_position_change(state.position)
+        self.on_voltage_change(state.voltage)
+
     def on_position_change(self,position):
         self.edit_Position.setText((f"%.{self._decimal_digits_gui}f" % position))
 
     def on_voltage_change(self,voltage):
         self.edit_Voltage.setText((f"%.{self._decimal_digits_gui}f" % voltage))
-            
+
     def on_moving_state_change(self,status):
         if status == self.interface.SIG_MOVEMENT_STARTED:
             self.disable_widget(self.widgets_disabled_when_moving)
@@ -776,7 +754,7 @@ class gui(abstract_instrument_interface.abstract_gui):
 ###################################################################################################################################################
 
     def click_button_refresh_list_devices(self):
-        self.interface.refresh_list_devices()
+        self.interface.refresh_list_devices(force = True)
 
     def click_button_connect_disconnect(self):
         if(self.interface.instrument.connected == False): # We attempt connection   
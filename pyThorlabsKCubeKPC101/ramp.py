@@ -0,0 +1,221 @@
+'''
+Native ramp engine. It executes the same ramps defined by the settings of abstract_instrument_interface.ramp ('ramp_step_size', 'ramp_numb_steps',
+'ramp_repeat', 'ramp_reverse', 'ramp_wait_1', 'ramp_wait_2', ...) on a dedicated thread, without depending on Qt.
+
+Differently from abstract_instrument_interface.ramp, which jogs the device by 'ramp_step_size' at each step and chains each action with QTimer calls,
+    - the table of absolute set points is computed before the ramp starts (see ramp_setpoints), and each step sends an absolute set point to the device,
+      so that the errors of each step do not accumulate
+    - the waits keep the same meaning: the trigger of each step is sent 'ramp_wait_1' s after the movement has settled, and the next step starts
+      'ramp_wait_2' s after the trigger. The waits are scheduled as deadlines on time.monotonic(), and the next step is due 'ramp_wait_2' s after the
+      scheduled time of the trigger, so that the time spent in calling the trigger and the oversleeping of each wait do not add up to the waits.
+      If a step is still late by more than 'ramp_wait_1' + 'ramp_wait_2' (e.g. the trigger took that long), it starts right away and it is counted
+      in ramp_engine.numb_resyncs
+    - the achieved step rate is measured and compared with the requested one (see ramp_engine.stats)
+'''
+import time
+import threading
+import logging
+import numpy as np
+
+def ramp_setpoints(initial_value, step_size, numb_steps, repeat = 1, reverse = False):
+    '''
+    Returns (as a numpy array) the absolute set points of a ramp, i.e. the values reached after each step: numb_steps steps of step_size starting
+    from initial_value, followed (if reverse = True) by numb_steps steps back to initial_value, the whole sequence being repeated repeat times.
+    Each set point is computed as initial_value + n*step_size, so that rounding errors do not accumulate
+    '''
+    forward = np.arange(1, numb_steps + 1)
+    if reverse:
+        cycle = np.concatenate([forward, numb_steps - forward])
+        shift = 0
+    else:
+        cycle = forward
+        shift = numb_steps
+    numb_step_sizes = np.concatenate([cycle + j * shift for j in range(repeat)]) if repeat > 0 else np.zeros(0)
+    return initial_value + numb_step_sizes * step_size
+
+class ramp_engine():
+    '''
+    Parameters
+    ----------
+    func_set_value
+        Function, takes the set point as input. Sends an absolute set point to the device
+    func_read_value
+        Function, takes no input parameter. Reads the current value (used as starting point of the ramp, and to reset the device after the ramp)
+    func_wait_step_ended
+        Function, takes the set point and a threading.Event as input. Blocks until the movement towards the set point has settled, or until the event is set (ramp stopped)
+    func_trigger
+        Function, takes no input parameter. Called after each step if 'ramp_send_trigger' is True (and before the ramp if 'ramp_send_initial_trigger' is True)
+    func_trigger_continue_ramp
+        Function, takes no input parameter. If not None, after each trigger the ramp waits until func_trigger_continue_ramp() == True
+    func_step_ended
+        Function, takes no input parameter. Called after each step which is not followed by a trigger (e.g. to read the state of the device)
+    on_started, on_ended
+        Functions, take no input parameter. Called (on the thread of the ramp) when the ramp starts and ends
+    on_step
+        Function, takes the index of the step and the set point as input. Called (on the thread of the ramp) right after each set point is sent
+
+    Attributes
+    ----------
+    setpoints : numpy.ndarray
+        Set points of the current (or last) ramp
+    step_times : numpy.ndarray
+        Times (time.monotonic()) when each set point was sent (nan for the steps not done)
+    numb_steps_done, numb_steps_total : int
+    numb_resyncs : int
+        Number of steps which were started late by more than one period ('ramp_wait_1' + 'ramp_wait_2')
+    max_lateness : float
+        Maximum delay (in s) between the scheduled start of a step and the time when its set point was sent
+    '''
+    def __init__(self, func_set_value, func_read_value, func_wait_step_ended = None, func_trigger = None, func_trigger_continue_ramp = None,
+                 func_step_ended = None, on_started = None, on_ended = None, on_step = None, logger = None):
+        self.func_set_value = func_set_value
+        self.func_read_value = func_read_value
+        self.func_wait_step_ended = func_wait_step_ended
+        self.func_trigger = func_trigger
+        self.func_trigger_continue_ramp = func_trigger_continue_ramp
+        self.func_step_ended = func_step_ended
+        self.on_started = on_started
+        self.on_ended = on_ended
+        self.on_step = on_step
+        self.logger = logger or logging.getLogger(__name__)
+        self.stop_event = threading.Event()
+        self.doing_ramp = False
+        self._thread = None
+        self.setpoints = np.zeros(0)
+        self.step_times = np.zeros(0)
+        self.numb_steps_done = 0
+        self.numb_steps_total = 0
+        self.numb_resyncs = 0
+        self.max_lateness = 0.0
+        self.period = 0.0
+
+    def start(self, settings, blocking = False):
+        '''
+        Start a ramp defined by settings (dictionary with the same keys used by abstract_instrument_interface.ramp). The ramp runs on a separate
+        thread, unless blocking = True. Returns False if a ramp is already running
+        '''
+        if self.doing_ramp:
+            return False
+        settings = dict(settings)
+        reverse = bool(settings['ramp_reverse'])
+        self.numb_steps_total = int(settings['ramp_numb_steps']) * int(settings['ramp_repeat']) * (2 if reverse else 1)
+        self.numb_steps_done = 0
+        self.doing_ramp = True
+        self.stop_event.clear()
+        if blocking:
+            self._run(settings)
+        else:
+            self._thread = threading.Thread(target = self._run, args = (settings,), name = 'ramp', daemon = True)
+            self._thread.start()
+        return True
+
+    def stop(self, wait = True, timeout = 5):
+        '''
+        Stop the ramp. If wait = True, blocks until the thread of the ramp has ended (for at most timeout s)
+        '''
+        self.stop_event.set()
+        if wait and self._thread and not (self._thread is threading.current_thread()):
+            self._thread.join(timeout)
+
+    @property
+    def stats(self):
+        '''
+        Requested and achieved step rate (in steps/s) of the current (or last) ramp, together with the statistics of the schedule. The requested
+        rate is 1/('ramp_wait_1' + 'ramp_wait_2'), the achieved one is lower by the time needed by each movement to settle
+        '''
+        times = self.step_times[:self.numb_steps_done]
+        achieved_rate = float((len(times) - 1) / (times[-1] - times[0])) if (len(times) > 1 and times[-1] > times[0]) else None
+        return {'numb_steps_done': self.numb_steps_done,
+                'numb_steps_total': self.numb_steps_total,
+                'requested_rate': 1 / self.period if self.period > 0 else None,
+                'achieved_rate': achieved_rate,
+                'max_lateness': self.max_lateness,
+                'numb_resyncs': self.numb_resyncs}
+
+    def _wait_until(self, deadline):
+        # Wait until time.monotonic() >= deadline. Returns False if the ramp was stopped in the meanwhile
+        while not self.stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            self.stop_event.wait(remaining)
+        return False
+
+    def _trigger(self):
+        self.func_trigger()
+        if self.func_trigger_continue_ramp:
+            while not (self.stop_event.is_set() or self.func_trigger_continue_ramp()):
+                self.stop_event.wait(0.01)
+
+    def _run(self, settings):
+        wait_1 = float(settings['ramp_wait_1'])
+        wait_2 = float(settings['ramp_wait_2'])
+        send_trigger = bool(settings['ramp_send_trigger']) and (self.func_trigger is not None)
+        self.period = wait_1 + wait_2
+        self.numb_resyncs = 0
+        self.max_lateness = 0.0
+        self.logger.info(f"Starting ramp...")
+        if self.on_started:
+            self.on_started()
+        try:
+            initial_value = self.func_read_value()
+            self.setpoints = ramp_setpoints(initial_value, float(settings['ramp_step_size']), int(settings['ramp_numb_steps']),
+                                            int(settings['ramp_repeat']), bool(settings['ramp_reverse']))
+            self.step_times = np.full(len(self.setpoints), np.nan)
+            if settings['ramp_send_initial_trigger'] and self.func_trigger:
+                self._trigger()
+                self._wait_until(time.monotonic() + wait_2)
+            next_start = time.monotonic()
+            for index, setpoint in enumerate(self.setpoints):
+                if self.stop_event.is_set():
+                    break
+                now = time.monotonic()
+                lateness = now - next_start
+                if (self.period > 0) and (lateness >= self.period):
+                    # The previous step took longer than one period: the schedule restarts from this step, instead of shortening all the following waits
+                    self.numb_resyncs += 1
+                    next_start = now
+                    lateness = 0.0
+                self.max_lateness = max(self.max_lateness, lateness)
+                self.logger.debug(f"Ramp step {index + 1}/{len(self.setpoints)}: moving to {setpoint}...")
+                self.func_set_value(setpoint)
+                self.step_times[index] = time.monotonic()
+                self.numb_steps_done = index + 1
+                if self.on_step:
+                    self.on_step(index, setpoint)
+                if self.func_wait_step_ended:
+                    self.func_wait_step_ended(setpoint, self.stop_event)
+                # 'ramp_wait_1' is counted from the end of the movement, 'ramp_wait_2' from the scheduled time of the trigger
+                trigger_time = time.monotonic() + wait_1
+                if not self._wait_until(trigger_time):
+                    break
+                if send_trigger:
+                    self._trigger()
+                elif self.func_step_ended:
+                    self.func_step_ended()
+                next_start = trigger_time + wait_2
+                if not self._wait_until(next_start):
+                    break
+            else:
+                if settings['ramp_reset']:
+                    self.logger.info(f"Resetting ramp parameter to original value = {initial_value}...")
+                    self.func_set_value(initial_value)
+                    if self.func_wait_step_ended:
+                        self.func_wait_step_ended(initial_value, self.stop_event)
+                    if self.func_step_ended:
+                        self.func_step_ended()
+            if self.stop_event.is_set():
+                self.logger.info(f"Ramp stopped.")
+            else:
+                self.logger.info(f"Sequence terminated.")
+            stats = self.stats
+            if stats['achieved_rate'] is not None:
+                requested_rate = f"{stats['requested_rate']:.3f}" if stats['requested_rate'] else "max"
+                self.logger.info(f"Ramp steps done = {self.numb_steps_done}/{self.numb_steps_total}, step rate = {stats['achieved_rate']:.3f} steps/s "
+                                 f"(requested = {requested_rate} steps/s), max lateness = {1e3*self.max_lateness:.1f} ms, resyncs = {self.numb_resyncs}")
+        except Exception as e:
+            self.logger.error(f"Error during the ramp: {e}")
+        finally:
+            self.doing_ramp = False
+            if self.on_ended:
+                self.on_ended()
@@ -0,0 +1,274 @@
+'''
+Streaming recorders, which store the states read from the device (timestamp, position, voltage, mode, busy) in a file, for logs which can last several days.
+
+Samples are first collected in a small preallocated buffer (chunk). When the chunk is full, or every flush_interval seconds, it is handed over to
+the writer thread of the recorder, which writes it to the file (and waits for the disk). The memory used does not grow with the length of the
+recording, and appending a sample costs only a copy into a numpy array, so append() can be called from the GUI thread. At most max_queued_chunks
+chunks wait for the writer thread: if the disk cannot keep up, further chunks are dropped (and counted in numb_chunks_dropped) instead of filling
+the memory. If writing to the file fails, the error is logged and raised again by the following calls to append(), flush() and close().
+
+npy_recorder
+    Standard .npy file (readable with numpy.load), with the same dtype used by history.history_buffer. The file is extended in blocks, and each chunk
+    is written via a memory map of the current block. The header has a fixed size and it is rewritten (with the number of valid samples) only after
+    the data of each chunk has been flushed to disk: if the program crashes, the file is still a valid .npy file which contains all the samples flushed so far.
+    The file can be read while it is being written, and read_recording() returns a memory map of it, for fast random access to very long recordings.
+hdf5_recorder
+    Resizable dataset in an HDF5 file (requires h5py), opened in SWMR mode so that it can be read while it is being written.
+'''
+import os
+import logging
+import queue
+import threading
+import importlib.util
+import numpy as np
+
+from pyThorlabsKCubeKPC101 import history
+
+HAS_H5PY = importlib.util.find_spec('h5py') is not None
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+NPY_HEADER_SIZE = 256   # Total size (in bytes) of the header of the .npy files written by npy_recorder. Fixed, so that it can be rewritten in place
+
+def _npy_header(dtype, length):
+    header = "{'descr': %s, 'fortran_order': False, 'shape': (%d,), }" % (repr(np.lib.format.dtype_to_descr(dtype)), length)
+    header_length = NPY_HEADER_SIZE - len(NPY_MAGIC) - 2
+    if len(header) + 1 > header_length:
+        raise ValueError("The dtype is too complex for the fixed-size header.")
+    header = header.ljust(header_length - 1) + '\n'
+    return NPY_MAGIC + header_length.to_bytes(2, 'little') + header.encode('latin1')
+
+class _base_recorder():
+    '''
+    Attributes
+    ----------
+    path : str
+    chunk_size : int
+        Number of samples collected in memory before they are written to the file
+    flush_interval : float
+        Maximum time (in s) that a sample waits in memory before being written to the file
+    numb_samples : int
+        Total number of samples recorded (including those which have not been written to the file yet)
+    numb_samples_written : int
+        Number of samples written to the file by the writer thread
+    last_exception
+        Last exception raised while writing to the file (None if no error occurred). It is raised again by append(), flush() and close()
+    max_queued_chunks : int
+        Maximum number of chunks waiting to be written by the writer thread
+    numb_chunks_dropped, numb_samples_dropped : int
+        Number of chunks (and of samples) dropped because max_queued_chunks chunks were already waiting to be written
+    logger
+        logging.Logger object (default = logging.getLogger('pyThorlabsKCubeKPC101'))
+    '''
+    def __init__(self, path, chunk_size = 4096, flush_interval = 1.0, dtype = history.sample_dtype, max_queued_chunks = 64, logger = None):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = int(chunk_size)
+        self.flush_interval = flush_interval
+        self.numb_samples = 0
+        self.numb_samples_written = 0
+        self.last_exception = None
+        self.max_queued_chunks = int(max_queued_chunks)
+        self.numb_chunks_dropped = 0
+        self.numb_samples_dropped = 0
+        self.logger = logger if logger else logging.getLogger(__package__)
+        self._chunk = np.zeros(self.chunk_size, dtype = self.dtype)
+        self._chunk_length = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize = self.max_queued_chunks + 1)  # Chunks waiting to be written by the writer thread (None = stop the thread).
+                                                                         # One more slot, so that None can always be queued
+        self._writer = None
+        self.closed = False
+
+    def _start_writer(self):
+        # Called by the subclasses, once the file has been opened
+        self._writer = threading.Thread(target = self._run_writer, name = 'recorder', daemon = True)
+        self._writer.start()
+
+    def _run_writer(self):
+        while True:
+            try:
+                samples = self._queue.get(timeout = self.flush_interval)
+            except queue.Empty:
+                # No full chunk within flush_interval: the samples collected so far are queued anyway (while holding the lock, so that
+                # the chunks are always queued, and hence written, in the order in which they were collected)
+                with self._lock:
+                    self._queue_chunk()
+                continue
+            if samples is None:
+                self._queue.task_done()
+                return
+            try:
+                self._write(samples)
+                self.numb_samples_written += len(samples)
+            except Exception as e:
+                if self.last_exception is None:
+                    self.logger.error(f"Error while writing to {self.path}: {e}")
+                self.last_exception = e
+            self._queue.task_done()
+
+    def _take_chunk(self):
+        # Returns the samples collected so far (None if there are none), and starts a new chunk. Must be called while holding self._lock
+        if self._chunk_length == 0:
+            return None
+        samples = self._chunk[:self._chunk_length]
+        self._chunk = np.zeros(self.chunk_size, dtype = self.dtype)
+        self._chunk_length = 0
+        return samples
+
+    def _queue_chunk(self):
+        # Hand over the samples collected so far to the writer thread. The chunk is dropped if too many chunks are already waiting.
+        # Must be called while holding self._lock
+        samples = self._take_chunk()
+        if samples is None:
+            return
+        if self._queue.qsize() >= self.max_queued_chunks:
+            self.numb_chunks_dropped += 1
+            self.numb_samples_dropped += len(samples)
+            self.logger.warning(f"The samples recorded in {self.path} are not written fast enough, {len(samples)} samples dropped "
+                                f"({self.numb_samples_dropped} in total).")
+            return
+        self._queue.put(samples)
+
+    def _raise_write_error(self):
+        if self.last_exception is not None:
+            raise self.last_exception
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, timestamp, position, voltage, mode = None, busy = False):
+        with self._lock:
+            if self.closed:
+                return
+            self._raise_write_error()
+            self._chunk[self._chunk_length] = (timestamp, position, voltage, history.MODE_CODES.get(mode, 0), busy)
+            self._chunk_length += 1
+            self.numb_samples += 1
+            if self._chunk_length == self.chunk_size:
+                self._queue_chunk()
+
+    def append_snapshot(self, state):
+        # state is a driver.state_snapshot object
+        self.append(state.timestamp, state.position, state.voltage, state.mode, state.busy)
+
+    def flush(self):
+        # Hand over the samples collected so far to the writer thread, and block until all of them have been written to the file
+        with self._lock:
+            if self.closed:
+                return
+            self._queue_chunk()
+        self._queue.join()
+        self._raise_write_error()
+
+    def close(self):
+        # The remaining samples are written, then the writer thread is stopped and the file is closed (also if a write failed)
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._queue_chunk()
+            self._queue.put(None)
+        if self._writer:
+            self._writer.join()
+        self._close()
+        self._raise_write_error()
+
+class npy_recorder(_base_recorder):
+    '''
+    Records samples in a .npy file, see module docstring.
+
+    block_size : int
+        The file is extended by block_size samples at a time (only the current block is memory-mapped)
+    '''
+    def __init__(self, path, chunk_size = 4096, flush_interval = 1.0, block_size = 2**20, dtype = history.sample_dtype, max_queued_chunks = 64, logger = None):
+        super().__init__(path, chunk_size = chunk_size, flush_interval = flush_interval, dtype = dtype, max_queued_chunks = max_queued_chunks, logger = logger)
+        self.block_size = int(block_size)
+        self._file = open(path, 'w+b')
+        self._file.write(_npy_header(self.dtype, 0))
+        self._file.flush()
+        self._block = None
+        self._block_start = 0
+        self._start_writer()
+
+    def _map_block(self, start):
+        # Extend the file so that it contains the block starting at sample start, and memory-map it
+        self._block = None
+        self._file.truncate(NPY_HEADER_SIZE + (start + self.block_size) * self.dtype.itemsize)
+        self._block = np.memmap(self._file, dtype = self.dtype, mode = 'r+', offset = NPY_HEADER_SIZE + start * self.dtype.itemsize, shape = (self.block_size,))
+        self._block_start = start
+
+    def _write(self, samples):
+        index = 0
+        while index < len(samples):
+            position = self.numb_samples_written + index
+            if (self._block is None) or (position >= self._block_start + self.block_size):
+                if self._block is not None:
+                    self._block.flush()
+                self._map_block(position)
+            offset = position - self._block_start
+            count = min(len(samples) - index, self.block_size - offset)
+            self._block[offset:offset + count] = samples[index:index + count]
+            index += count
+        # The data is flushed to disk before the header is updated, so the header never counts samples which are not in the file
+        self._block.flush()
+        self._file.seek(0)
+        self._file.write(_npy_header(self.dtype, self.numb_samples_written + len(samples)))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _close(self):
+        if self._block is not None:
+            self._block.flush()
+            self._block = None
+        # Remove the unused part of the last block
+        self._file.truncate(NPY_HEADER_SIZE + self.numb_samples_written * self.dtype.itemsize)
+        self._file.close()
+
+class hdf5_recorder(_base_recorder):
+    '''
+    Records samples in a resizable dataset of an HDF5 file (requires h5py), see module docstring.
+
+    dataset : str
+        Name of the dataset
+    '''
+    def __init__(self, path, dataset = 'samples', chunk_size = 4096, flush_interval = 1.0, dtype = history.sample_dtype, max_queued_chunks = 64, logger = None):
+        if not HAS_H5PY:
+            raise ImportError("The package h5py is needed to record in HDF5 files.")
+        import h5py
+        super().__init__(path, chunk_size = chunk_size, flush_interval = flush_interval, dtype = dtype, max_queued_chunks = max_queued_chunks, logger = logger)
+        self._file = h5py.File(path, 'w', libver = 'latest')
+        self._dataset = self._file.create_dataset(dataset, shape = (0,), maxshape = (None,), dtype = self.dtype, chunks = (self.chunk_size,))
+        self._dataset.attrs['mode_codes'] = str(history.MODE_CODES)
+        self._file.swmr_mode = True
+        self._start_writer()
+
+    def _write(self, samples):
+        start = self._dataset.shape[0]
+        self._dataset.resize((start + len(samples),))
+        self._dataset[start:] = samples
+        self._dataset.flush()
+
+    def _close(self):
+        self._file.close()
+
+def open_recorder(path, **kwargs):
+    '''
+    Returns an hdf5_recorder if the extension of path is .h5 or .hdf5, and an npy_recorder otherwise. The keyword arguments are passed to the recorder
+    '''
+    if os.path.splitext(path)[1].lower() in ['.h5', '.hdf5']:
+        return hdf5_recorder(path, **kwargs)
+    return npy_recorder(path, **kwargs)
+
+def read_recording(path, dataset = 'samples'):
+    '''
+    Returns the samples stored by a recorder, as a numpy structured array with fields 'timestamp', 'position', 'voltage', 'mode', 'busy'.
+    .npy files are memory-mapped (samples are read from disk only when accessed), HDF5 datasets are read completely
+    '''
+    if os.path.splitext(path)[1].lower() in ['.h5', '.hdf5']:
+        import h5py
+        with h5py.File(path, 'r', libver = 'latest', swmr = True) as f:
+            return f[dataset][:]
+    return np.load(path, mmap_mode = 'r')
@@ -0,0 +1,577 @@
+'''
+Out-of-process access to a KPC101.
+
+Only one process can own a Kinesis device. The server defined here owns a driver.pyThorlabsKCubeKPC101 object and serves it over a local
+TCP or Unix socket, so that several processes (e.g. Ergastirio, a Jupyter notebook and a monitoring script) can use the same device at the same time.
+The class client is a drop-in replacement of the driver: it exposes the float-based API of the driver (position_f, set_position_f, mode, snapshot(), jog_by(), ...),
+so it can also be passed as instrument to controller.controller.
+
+Protocol
+--------
+Each message is a frame made of a 4-byte big-endian length, followed by a payload. The first byte of the payload identifies the codec (b'm' = msgpack,
+b'j' = JSON), the rest is the encoded message. msgpack is used if it is installed, JSON otherwise. The server always replies with the codec of the request.
+
+    request         {'id': n, 'method': name, 'args': [...], 'kwargs': {...}}
+    batch           {'id': n, 'batch': [[name, args, kwargs], ...]}             executed in order, while holding the lock of the driver (except blocking methods)
+    response        {'id': n, 'result': value}  or  {'id': n, 'error': [exception type, message]}
+    batch response  {'id': n, 'results': [{'result': value} or {'error': [...]}, ...]}
+    stream sample   {'stream': subscription id, 'sample': [timestamp, position, voltage, mode, busy]}
+
+Besides the methods listed in SERVER_METHODS, the special methods are 'get' (args = [attribute]), 'set' (args = [attribute, value]),
+'subscribe' (args = [rate], returns the subscription id) and 'unsubscribe' (args = [subscription id]).
+Requests can be pipelined: the client can send several requests without waiting for the responses, which are matched to the requests via their id.
+'''
+import os
+import sys
+import json
+import struct
+import socket
+import decimal
+import builtins
+import argparse
+import threading
+import contextlib
+import socketserver
+import importlib.util
+import concurrent.futures
+import numpy as np
+
+from pyThorlabsKCubeKPC101 import driver
+from pyThorlabsKCubeKPC101 import driver_virtual
+from pyThorlabsKCubeKPC101 import acquisition
+from pyThorlabsKCubeKPC101 import enumeration
+
+DEFAULT_ADDRESS = ('127.0.0.1', 50101)
+HAS_UNIX_SOCKETS = hasattr(socketserver, 'ThreadingUnixStreamServer') and hasattr(socket, 'AF_UNIX')   # False e.g. on Windows
+
+def _check_unix_sockets(address):
+    # Addresses given as strings are paths of Unix sockets
+    if isinstance(address, str) and not HAS_UNIX_SOCKETS:
+        raise RuntimeError(f"Unix sockets are not supported on this platform, use a TCP address (host, port) instead of '{address}'.")
+
+# Methods and attributes of the driver which can be accessed by clients
+SERVER_METHODS = ['list_devices', 'connect_device', 'disconnect_device', 'snapshot', 'set_position_f', 'set_voltage_f', 'jog', 'jog_by',
+                  'set_jog_steps', 'wait_until_settled', 'set_zero', 'refresh', 'invalidate_cache', 'persist_settings', 'run_trajectory',
+                  'enable_instrumentation', 'disable_instrumentation', 'instrumentation_report', 'set_polling_rate', 'polling_report',
+                  'measure_polling_overhead']
+SERVER_GET_ATTRIBUTES = ['connected', 'position_f', 'voltage_f', 'mode', 'is_busy', 'jog_steps_f', 'position_limits_f', 'voltage_limits_f',
+                         'connection_timings', 'last_settle_time', 'device_sn', 'device_info', 'settings_pending', 'use_cache', 'persist_delay',
+                         'units_position', 'units_voltage', 'polling_rate']
+SERVER_SET_ATTRIBUTES = ['mode', 'use_cache', 'persist_delay']
+# Methods which can take a long time. Inside a batch they are executed without holding the lock of the driver, otherwise all other clients
+# (and the subscriptions) would be blocked until they end
+BLOCKING_METHODS = ['wait_until_settled', 'run_trajectory', 'measure_polling_overhead']
+
+## Encoding of messages
+HAS_MSGPACK = importlib.util.find_spec('msgpack') is not None
+if HAS_MSGPACK:
+    import msgpack
+CODEC_MSGPACK = b'm'
+CODEC_JSON = b'j'
+DEFAULT_CODEC = CODEC_MSGPACK if HAS_MSGPACK else CODEC_JSON
+
+def encode_frame(message, codec = DEFAULT_CODEC):
+    if codec == CODEC_MSGPACK:
+        data = msgpack.packb(message, use_bin_type = True)
+    else:
+        data = json.dumps(message, separators = (',', ':')).encode()
+    return struct.pack('>I', len(data) + 1) + codec + data
+
+def decode_payload(payload):
+    # Returns (message, codec)
+    codec = payload[:1]
+    if codec == CODEC_MSGPACK:
+        return (msgpack.unpackb(payload[1:], raw = False), codec)
+    return (json.loads(payload[1:].decode()), codec)
+
+def _receive_exactly(sock, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError("The connection was closed.")
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+def receive_frame(sock):
+    (size,) = struct.unpack('>I', _receive_exactly(sock, 4))
+    return decode_payload(_receive_exactly(sock, size))
+
+def to_wire(value, to_float = float):
+    # Convert the values returned by the driver into types which can be encoded (Decimals become floats, numpy arrays become lists, ...)
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, driver.state_snapshot):
+        return list(value)
+    if isinstance(value, dict):
+        return {str(key): to_wire(item, to_float) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_wire(item, to_float) for item in value]
+    if isinstance(value, np.ndarray):
+        return to_wire(value.tolist(), to_float)
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    try:
+        return to_float(value)  # e.g. System.Decimal
+    except Exception:
+        return str(value)
+
+class remote_error(RuntimeError):
+    # Raised by the client when the server reports an exception which is not a built-in exception
+    pass
+
+def _exception_from_wire(error):
+    (name, message) = error
+    exception_type = getattr(builtins, name, None)
+    if isinstance(exception_type, type) and issubclass(exception_type, Exception):
+        return exception_type(message)
+    return remote_error(f"{name}: {message}")
+
+class _tcp_server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class _unix_server(socketserver.ThreadingUnixStreamServer if HAS_UNIX_SOCKETS else object):
+    daemon_threads = True
+
+class server():
+    '''
+    Parameters
+    ----------
+    instrument
+        Driver object served to the clients. If None, a driver.pyThorlabsKCubeKPC101 (or a driver_virtual.pyThorlabsKCubeKPC101, if virtual = True) is created with the given backend
+    address
+        Either a tuple (host, port) for a TCP socket (default = DEFAULT_ADDRESS), or a string with the path of a Unix socket
+    keep_connected : bool
+        If True (default), the device stays connected when a client calls disconnect_device (the call only succeeds), since other clients might still be using it.
+        Similarly, connect_device succeeds without reconnecting if the server is already connected to the requested device
+    '''
+    def __init__(self, instrument = None, backend = None, virtual = False, address = DEFAULT_ADDRESS, keep_connected = True):
+        if instrument:
+            self.instrument = instrument
+        elif virtual:
+            self.instrument = driver_virtual.pyThorlabsKCubeKPC101(backend = backend)
+        else:
+            self.instrument = driver.pyThorlabsKCubeKPC101(backend = backend)
+        self.keep_connected = keep_connected
+        _check_unix_sockets(address)
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+            self._server = _unix_server(address, _request_handler)
+        else:
+            self._server = _tcp_server(address, _request_handler)
+        self._server.device_server = self
+        self.address = self._server.server_address
+        self._thread = None
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        # Serve clients on a background thread
+        self._thread = threading.Thread(target = self._server.serve_forever, name = 'kpc101_server', daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def execute(self, method, args = (), kwargs = {}):
+        # Execute a single command of a client, and return the result (converted by to_wire)
+        instrument = self.instrument
+        if method == 'get':
+            if not (args[0] in SERVER_GET_ATTRIBUTES):
+                raise AttributeError(f"Attribute {args[0]} cannot be read remotely.")
+            result = getattr(instrument, args[0], None)
+        elif method == 'set':
+            if not (args[0] in SERVER_SET_ATTRIBUTES):
+                raise AttributeError(f"Attribute {args[0]} cannot be set remotely.")
+            setattr(instrument, args[0], args[1])
+            result = None
+        elif method == 'connect_device' and self.keep_connected and instrument.connected and (str(args[0]) == str(instrument.device_sn)):
+            result = (instrument.device_sn + ' (' + instrument.device_info + ')', 1)
+        elif method == 'disconnect_device' and self.keep_connected:
+            result = (f"Device {getattr(instrument, 'device_sn', '')} is kept connected by the server.", 1)
+        elif method in SERVER_METHODS:
+            result = getattr(instrument, method)(*args, **kwargs)
+        else:
+            raise AttributeError(f"Method {method} cannot be called remotely.")
+        return to_wire(result, getattr(instrument.backend, 'to_float', float))
+
+class _request_handler(socketserver.BaseRequestHandler):
+    # One object (and one thread) for each client connection. Requests of a connection are executed in order
+    def setup(self):
+        self.device_server = self.server.device_server
+        self.write_lock = threading.Lock()
+        self.subscriptions = dict()
+        self.next_subscription_id = 1
+
+    def send(self, message, codec):
+        frame = encode_frame(message, codec)
+        with self.write_lock:
+            self.request.sendall(frame)
+
+    def handle(self):
+        while True:
+            try:
+                (message, codec) = receive_frame(self.request)
+            except (ConnectionError, OSError):
+                return
+            try:
+                self.send(self.process(message, codec), codec)
+            except (ConnectionError, OSError):
+                return
+
+    def finish(self):
+        for worker in self.subscriptions.values():
+            worker.stop()
+
+    def process(self, message, codec):
+        if 'batch' in message:
+            # Consecutive commands are executed while holding the lock of the driver, blocking methods are executed without it
+            commands = [(list(command) + [[], {}])[:3] for command in message['batch']]
+            results = []
+            index = 0
+            while index < len(commands):
+                if commands[index][0] in BLOCKING_METHODS:
+                    results.append(self._execute(*commands[index], codec))
+                    index += 1
+                    continue
+                with self.device_server.instrument.lock:
+                    while (index < len(commands)) and not (commands[index][0] in BLOCKING_METHODS):
+                        results.append(self._execute(*commands[index], codec))
+                        index += 1
+            return {'id': message['id'], 'results': results}
+        response = self._execute(message['method'], message.get('args', []), message.get('kwargs', {}), codec)
+        response['id'] = message['id']
+        return response
+
+    def _execute(self, method, args, kwargs, codec):
+        try:
+            if method == 'subscribe':
+                return {'result': self.subscribe(args[0], codec)}
+            if method == 'unsubscribe':
+                worker = self.subscriptions.pop(args[0], None)
+                if worker:
+                    worker.stop()
+                return {'result': worker is not None}
+            return {'result': self.device_server.execute(method, args, kwargs)}
+        except Exception as e:
+            return {'error': [type(e).__name__, str(e)]}
+
+    def subscribe(self, rate, codec):
+        # Start sending samples of the state of the device, rate times per second
+        subscription_id = self.next_subscription_id
+        self.next_subscription_id += 1
+        instrument = self.device_server.instrument
+        def send_sample(state):
+            try:
+                self.send({'stream': subscription_id, 'sample': list(state)}, codec)
+            except OSError:
+                worker.stop()
+        worker = acquisition.acquisition_worker(func_acquire = instrument.snapshot, period = 1 / float(rate), lock = instrument.lock, callback = send_sample)
+        self.subscriptions[subscription_id] = worker
+        worker.start()
+        return subscription_id
+
+class client():
+    '''
+    Client of a server. It exposes the float-based API of driver.pyThorlabsKCubeKPC101 (position_f, set_position_f, voltage_f, set_voltage_f,
+    mode, is_busy, snapshot(), jog(), jog_by(), set_jog_steps(), wait_until_settled(), ...), so it can be used in place of the driver.
+
+    Parameters
+    ----------
+    address
+        Either a tuple (host, port) (default = DEFAULT_ADDRESS), or a string with the path of a Unix socket
+    timeout : float
+        Maximum time (in s) to wait for the response of a request
+    '''
+    def __init__(self, address = DEFAULT_ADDRESS, timeout = 30, codec = DEFAULT_CODEC):
+        self.address = address
+        self.timeout = timeout
+        self.codec = codec
+        _check_unix_sockets(address)
+        if isinstance(address, str):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._socket.connect(address)
+        self._write_lock = threading.Lock()
+        self._pending = dict()
+        self._pending_lock = threading.Lock()
+        self._next_id = 0
+        self._stream_callbacks = dict()
+        self.connected = False      # True if this client has connected to the device (see connect_device)
+        self.lock = threading.RLock()   # Same role as driver.pyThorlabsKCubeKPC101.lock, for code which uses the client in place of the driver
+        self.device_list_cache = enumeration.device_list_cache(lambda: self.list_devices(max_age = 0))
+        self.units_position = 'um'
+        self.units_voltage = 'V'
+        self._reader = threading.Thread(target = self._read_responses, name = 'kpc101_client', daemon = True)
+        self._reader.start()
+
+    def close(self):
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    ## Requests
+    def _send(self, message):
+        with self._pending_lock:
+            self._next_id += 1
+            message['id'] = self._next_id
+            future = concurrent.futures.Future()
+            self._pending[message['id']] = future
+        frame = encode_frame(message, self.codec)
+        with self._write_lock:
+            self._socket.sendall(frame)
+        return future
+
+    def _read_responses(self):
+        while True:
+            try:
+                (message, codec) = receive_frame(self._socket)
+            except (ConnectionError, OSError) as e:
+                with self._pending_lock:
+                    for future in self._pending.values():
+                        future.set_exception(ConnectionError(f"Connection to the server lost: {e}"))
+                    self._pending = dict()
+                return
+            if 'stream' in message:
+                callback = self._stream_callbacks.get(message['stream'])
+                if callback:
+                    callback(driver.state_snapshot(*message['sample']))
+                continue
+            with self._pending_lock:
+                future = self._pending.pop(message['id'], None)
+            if future:
+                future.set_result(message)
+
+    @staticmethod
+    def _result(response):
+        if 'error' in response:
+            raise _exception_from_wire(response['error'])
+        return response['result']
+
+    def call_async(self, method, *args, **kwargs):
+        '''
+        Send a request without waiting for the response (pipelining). Returns a concurrent.futures.Future, whose result is the result of the call
+        '''
+        response_future = self._send({'method': method, 'args': list(args), 'kwargs': kwargs})
+        future = concurrent.futures.Future()
+        def set_result(f):
+            try:
+                future.set_result(self._result(f.result()))
+            except Exception as e:
+                future.set_exception(e)
+        response_future.add_done_callback(set_result)
+        return future
+
+    def call(self, method, *args, **kwargs):
+        return self.call_async(method, *args, **kwargs).result(self.timeout)
+
+    def batch(self, commands, raise_errors = True):
+        '''
+        Execute several commands with a single request. The server executes them in order, while holding the lock of the driver (so no other client
+        can access the device in the meanwhile). The blocking methods (see BLOCKING_METHODS) are executed without holding the lock, so the commands
+        before and after each of them are two separate atomic groups. Each command is a tuple (method, args, kwargs), where args and kwargs are optional, e.g.
+            client.batch([('set_position_f', [3.0]), ('wait_until_settled',), ('get', ['position_f'])])
+        Returns the list of results. If raise_errors = False, failed commands are returned as exception objects instead of raising the first exception
+        '''
+        commands = [[command[0], list(command[1]) if len(command) > 1 else [], command[2] if len(command) > 2 else {}] for command in commands]
+        response = self._send({'batch': commands}).result(self.timeout)
+        results = []
+        for item in response['results']:
+            if 'error' in item:
+                exception = _exception_from_wire(item['error'])
+                if raise_errors:
+                    raise exception
+                results.append(exception)
+            else:
+                results.append(item['result'])
+        return results
+
+    def subscribe(self, rate, callback):
+        '''
+        Receive rate samples per second of the state of the device. callback is called (on the thread of the client which reads the responses)
+        with a driver.state_snapshot object. Returns the subscription id, to be passed to unsubscribe()
+        '''
+        subscription_id = self.call('subscribe', rate)
+        self._stream_callbacks[subscription_id] = callback
+        return subscription_id
+
+    def unsubscribe(self, subscription_id):
+        self._stream_callbacks.pop(subscription_id, None)
+        return self.call('unsubscribe', subscription_id)
+
+    def get(self, attribute):
+        return self.call('get', attribute)
+
+    def set(self, attribute, value):
+        return self.call('set', attribute, value)
+
+    ## API of the driver
+    def list_devices(self, max_age = None):
+        self.list_valid_devices = self.call('list_devices', max_age = max_age)
+        return self.list_valid_devices
+
+    def connect_device(self, device_sn, **kwargs):
+        (Msg, ID) = self.call('connect_device', device_sn, **kwargs)
+        if ID == 1:
+            self.connected = True
+            self.device_sn = str(device_sn)
+            self.connection_timings = self.get('connection_timings')
+        return (Msg, ID)
+
+    def disconnect_device(self):
+        (Msg, ID) = self.call('disconnect_device')
+        if ID == 1:
+            self.connected = False
+        return (Msg, ID)
+
+    def snapshot(self):
+        return driver.state_snapshot(*self.call('snapshot'))
+
+    @property
+    def position_f(self):
+        return self.get('position_f')
+
+    def set_position_f(self, pos:float):
+        return self.call('set_position_f', float(pos))
+
+    @property
+    def voltage_f(self):
+        return self.get('voltage_f')
+
+    def set_voltage_f(self, volt:float):
+        return self.call('set_voltage_f', float(volt))
+
+    @property
+    def mode(self):
+        return self.get('mode')
+
+    @mode.setter
+    def mode(self, new_mode):
+        self.set('mode', new_mode)
+
+    @property
+    def is_busy(self):
+        return self.get('is_busy')
+
+    @property
+    def position_limits_f(self):
+        return tuple(self.get('position_limits_f'))
+
+    @property
+    def voltage_limits_f(self):
+        return tuple(self.get('voltage_limits_f'))
+
+    @property
+    def jog_steps_f(self):
+        return self.get('jog_steps_f')
+
+    def set_jog_steps(self, percentage = None, position = None, voltage = None):
+        return self.call('set_jog_steps', percentage = percentage, position = position, voltage = voltage)
+
+    def jog(self, direction):
+        return self.call('jog', direction)
+
+    def jog_by(self, step_size:float):
+        return self.call('jog_by', float(step_size))
+
+    def wait_until_settled(self, target = None, tolerance = None, numb_samples = 3, timeout = None, **kwargs):
+        return self.call('wait_until_settled', target = target, tolerance = tolerance, numb_samples = numb_samples, timeout = timeout, **kwargs)
+
+    def set_zero(self):
+        return self.call('set_zero')
+
+    def refresh(self):
+        return self.call('refresh')
+
+    def invalidate_cache(self):
+        return self.call('invalidate_cache')
+
+    def persist_settings(self):
+        return self.call('persist_settings')
+
+    @contextlib.contextmanager
+    def settings_transaction(self):
+        # The server already defers the writes to the device memory (see driver.pyThorlabsKCubeKPC101.persist_settings), here the pending
+        # changes are only saved at the end of the block
+        try:
+            yield self
+        finally:
+            self.persist_settings()
+
+    def run_trajectory(self, points, dwell_s, on_point = None, t0 = None):
+        '''
+        See driver.pyThorlabsKCubeKPC101.run_trajectory. dwell_s can be a single value or an array. t0 is a value of time.perf_counter() (the server
+        runs on the same machine, and uses the same system-wide clock). on_point is not supported, since the trajectory is executed by the server
+        '''
+        if on_point is not None:
+            raise TypeError("on_point is not supported by the remote client: the trajectory is executed by the server.")
+        rows = self.call('run_trajectory', to_wire(np.asarray(points, dtype = float)), to_wire(np.asarray(dwell_s, dtype = float)),
+                         t0 = None if t0 is None else float(t0))
+        return np.array([tuple(row) for row in rows], dtype = driver.trajectory_dtype)
+
+    def instrumentation_report(self, as_json = False):
+        return self.call('instrumentation_report', as_json = as_json)
+
+    @property
+    def polling_rate(self):
+        return self.get('polling_rate')
+
+    def set_polling_rate(self, polling_rate):
+        return self.call('set_polling_rate', int(polling_rate))
+
+    def polling_report(self):
+        # JSON turns the keys (polling intervals) into strings
+        return {int(polling_rate): stats for polling_rate, stats in self.call('polling_report').items()}
+
+    def measure_polling_overhead(self, polling_rates = (250, 100, 50, 20, 10), duration = 2.0, read_period = 0.01):
+        future = self.call_async('measure_polling_overhead', list(polling_rates), duration, read_period)
+        report = future.result(self.timeout + len(polling_rates) * duration)
+        return {int(polling_rate): stats for polling_rate, stats in report.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description = "Serve a KPC101 to other processes over a local socket.", epilog = "")
+    parser.add_argument('--host', help = f"Host address of the TCP socket (default = {DEFAULT_ADDRESS[0]})", default = DEFAULT_ADDRESS[0])
+    parser.add_argument('--port', help = f"Port of the TCP socket (default = {DEFAULT_ADDRESS[1]})", type = int, default = DEFAULT_ADDRESS[1])
+    parser.add_argument('--unix', help = "Path of a Unix socket, used instead of the TCP socket")
+    parser.add_argument('--device', help = "Serial number of the device to connect at start-up")
+    parser.add_argument('-virtual', help = f"Serve a virtual device", action = "store_true")
+    args = parser.parse_args()
+
+    device_server = server(virtual = args.virtual, address = args.unix if args.unix else (args.host, args.port))
+    if args.device:
+        device_server.instrument.list_devices()
+        (Msg, ID) = device_server.instrument.connect_device(args.device)
+        print(Msg)
+        if ID != 1:
+            sys.exit(1)
+    print(f"Serving on {device_server.address}...")
+    try:
+        device_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if device_server.instrument.connected:
+            device_server.instrument.disconnect_device()
+        device_server.stop()
+
+if __name__ == '__main__':
+    main()
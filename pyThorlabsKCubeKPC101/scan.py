@@ -0,0 +1,302 @@
+'''
+Raster scan engine for one or more KPC101 axes (e.g. the X, Y and Z cubes of a KPC101Group).
+
+The scan visits all the points of a grid (one 1D array of set points for each axis) in one of the following orders (see scan_order())
+    - 'raster': the last axis is the fastest one, and it always moves in the same direction (each line ends with a flyback move)
+    - 'serpentine': as 'raster', but the direction of each axis is reversed every time a slower axis moves, so that consecutive points are always neighbours
+    - 'spiral': the last two axes are scanned along a square spiral from the border towards the centre (the direction alternates between planes for 3D grids)
+
+At each point the set points of the axes which change are sent together, and the engine waits until all of them have settled. Then func_trigger is
+called, which starts the acquisition and returns as soon as the acquisition has latched (e.g. the camera has been triggered). The data is then
+transferred by func_read on a separate thread, while the stage is already moving to the next point (pipelining). If func_read is None, the value
+returned by func_trigger is used as data.
+
+The data is stored in self.data, a numpy array indexed by grid coordinates (data[i, j] = value measured at grid[0][i], grid[1][j]), with the
+shape of the value as additional dimensions. If checkpoint_path is given, self.data and the points already done are saved to this .npz file
+every checkpoint_interval s, so that an interrupted scan can be resumed (start(resume = True)) from the first point not done.
+
+    engine = scan.scan_engine([device_x, device_y], [np.linspace(0, 20, 101), np.linspace(0, 20, 101)], func_trigger = camera.trigger,
+                              func_read = camera.read, order = 'serpentine', checkpoint_path = 'scan.npz', settle_kwargs = {'tolerance': 0.01})
+    engine.start(blocking = True)
+    engine.data
+'''
+import os
+import time
+import threading
+import logging
+import concurrent.futures
+import numpy as np
+
+ORDERS = ['raster', 'serpentine', 'spiral']
+
+def _spiral_2d(numb_rows, numb_cols):
+    # (row, col) of the points of a numb_rows x numb_cols grid, along a square spiral from the corner (0, 0) towards the centre
+    points = []
+    (top, bottom, left, right) = (0, numb_rows - 1, 0, numb_cols - 1)
+    while top <= bottom and left <= right:
+        points.extend((top, col) for col in range(left, right + 1))
+        points.extend((row, right) for row in range(top + 1, bottom + 1))
+        if top < bottom:
+            points.extend((bottom, col) for col in range(right - 1, left - 1, -1))
+        if left < right:
+            points.extend((row, left) for row in range(bottom - 1, top, -1))
+        (top, bottom, left, right) = (top + 1, bottom - 1, left + 1, right - 1)
+    return np.array(points, dtype = int).reshape(-1, 2)
+
+def scan_order(shape, order = 'serpentine'):
+    '''
+    Returns an array with shape (numb_points, len(shape)), containing the grid indices of the points in the order in which they are visited
+    '''
+    shape = tuple(int(n) for n in shape)
+    if order not in ORDERS:
+        raise ValueError(f"order must be one of {ORDERS}.")
+    if order == 'spiral' and len(shape) >= 2:
+        spiral = _spiral_2d(shape[-2], shape[-1])
+        outer = scan_order(shape[:-2], 'serpentine') if len(shape) > 2 else np.zeros((1, 0), dtype = int)
+        # The spiral of every other plane is run backwards (from the centre towards the border), so that there is no flyback between planes
+        planes = [np.hstack([np.repeat(index[None, :], len(spiral), axis = 0), spiral[::-1] if (count % 2) else spiral]) for count, index in enumerate(outer)]
+        return np.concatenate(planes)
+    indices = np.indices(shape).reshape(len(shape), -1).T
+    if order == 'serpentine':
+        linear = np.arange(len(indices))
+        for axis in range(1, len(shape)):
+            # The direction of an axis is reversed every time the slower axes move by one point
+            reversed_direction = (linear // int(np.prod(shape[axis:]))) % 2 == 1
+            indices[reversed_direction, axis] = shape[axis] - 1 - indices[reversed_direction, axis]
+    return indices
+
+class scan_engine():
+    '''
+    Parameters
+    ----------
+    devices
+        List of driver.pyThorlabsKCubeKPC101 objects (connected), one for each dimension of the grid, or a group.KPC101Group (its axes are used in order)
+    grid : list
+        One 1D array of set points for each device: positions for devices in close loop, voltages for devices in open loop
+    func_trigger
+        Function, takes the grid index (tuple) and the set points (numpy array) of the current point as input. Called once all axes have settled, it
+        must return as soon as the acquisition has latched. Its return value is passed to func_read (or used as data, if func_read is None)
+    func_read
+        Function, takes the grid index, the set points and the value returned by func_trigger as input, and returns the data of the point (a float or
+        an array). Executed on a separate thread, while the stage moves to the next point
+    order : str
+        'raster', 'serpentine' or 'spiral' (see module docstring)
+    max_pending_reads : int
+        Maximum number of points whose data is still being transferred. The engine waits before triggering a new point if this number is reached
+    settle_kwargs : dict
+        Keyword arguments passed to driver.pyThorlabsKCubeKPC101.wait_until_settled (e.g. tolerance, timeout). If tolerance is specified, the set point
+        of each axis is used as target
+    checkpoint_path : str
+        .npz file where the progress of the scan is saved (None = no checkpoints)
+    checkpoint_interval : float
+        Minimum time (in s) between two checkpoints
+    on_point
+        Function, takes the grid index, the set points and the data as input. Called (on the read thread) when the data of a point is available
+    on_ended
+        Function, takes no input parameter. Called (on the thread of the scan) when the scan ends
+
+    Attributes
+    ----------
+    data : numpy.ndarray
+        Data of each point, indexed by grid coordinates (nan for the points not done). None until the first point is done
+    done : numpy.ndarray
+        Boolean array with the shape of the grid, True for the points whose data is in self.data
+    order_indices : numpy.ndarray
+        Grid indices of the points, in the order in which they are visited (see scan_order())
+    '''
+    def __init__(self, devices, grid, func_trigger, func_read = None, order = 'serpentine', max_pending_reads = 1, settle_kwargs = None,
+                 checkpoint_path = None, checkpoint_interval = 10.0, on_point = None, on_ended = None, logger = None):
+        if hasattr(devices, 'devices') and hasattr(devices, 'axes'):
+            devices = [devices.devices[axis] for axis in devices.axes]
+        self.devices = list(devices)
+        self.grid = [np.atleast_1d(np.asarray(values, dtype = float)) for values in grid]
+        if len(self.grid) != len(self.devices):
+            raise ValueError("The grid must contain one array of set points for each device.")
+        self.shape = tuple(len(values) for values in self.grid)
+        self.func_trigger = func_trigger
+        self.func_read = func_read
+        self.order = order
+        self.order_indices = scan_order(self.shape, order)
+        self.max_pending_reads = max(int(max_pending_reads), 1)
+        self.settle_kwargs = dict(settle_kwargs) if settle_kwargs else dict()
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.on_point = on_point
+        self.on_ended = on_ended
+        self.logger = logger or logging.getLogger(__name__)
+        self.stop_event = threading.Event()
+        self.doing_scan = False
+        self.last_exception = None
+        self._thread = None
+        self._data_lock = threading.Lock()
+        self.data = None
+        self.done = np.zeros(self.shape, dtype = bool)
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.numb_points_scanned = 0
+        self.time_moving = 0.0
+        self.time_triggering = 0.0
+        self.time_waiting_reads = 0.0
+        self._start_time = None
+        self._end_time = None
+
+    @property
+    def numb_points_done(self):
+        return int(self.done.sum())
+
+    @property
+    def numb_points_total(self):
+        return len(self.order_indices)
+
+    @property
+    def stats(self):
+        '''
+        Progress and timing of the current (or last) scan. Times are in s, rates in points/s
+        '''
+        elapsed = ((self._end_time or time.perf_counter()) - self._start_time) if self._start_time else 0.0
+        n = self.numb_points_scanned
+        return {'numb_points_done': self.numb_points_done,
+                'numb_points_total': self.numb_points_total,
+                'elapsed': elapsed,
+                'rate': n / elapsed if elapsed > 0 else None,
+                'mean_move_time': self.time_moving / n if n else None,
+                'mean_trigger_time': self.time_triggering / n if n else None,
+                'time_waiting_reads': self.time_waiting_reads}
+
+    def start(self, resume = False, blocking = False):
+        '''
+        Start the scan on a separate thread (or on the current one, if blocking = True). If resume = True and the checkpoint file exists, the data and
+        the points done are loaded from it, and only the remaining points are scanned. Returns False if a scan is already running
+        '''
+        if self.doing_scan:
+            return False
+        if resume and self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            self.load_checkpoint()
+        else:
+            self.data = None
+            self.done = np.zeros(self.shape, dtype = bool)
+        self.doing_scan = True
+        self.stop_event.clear()
+        if blocking:
+            self._run()
+        else:
+            self._thread = threading.Thread(target = self._run, name = 'scan', daemon = True)
+            self._thread.start()
+        return True
+
+    def stop(self, wait = True, timeout = 10):
+        self.stop_event.set()
+        if wait and self._thread and not (self._thread is threading.current_thread()):
+            self._thread.join(timeout)
+
+    def save_checkpoint(self):
+        # The file is first written with a temporary name and then renamed, so that an interruption never leaves a corrupted checkpoint
+        with self._data_lock:
+            arrays = {'done': self.done.copy(), 'order': np.array(self.order)}
+            if self.data is not None:
+                arrays['data'] = self.data.copy()
+        arrays.update({f'grid_{axis}': values for axis, values in enumerate(self.grid)})
+        temporary_path = self.checkpoint_path + '.tmp.npz'
+        np.savez(temporary_path, **arrays)
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def load_checkpoint(self):
+        with np.load(self.checkpoint_path) as checkpoint:
+            for axis, values in enumerate(self.grid):
+                saved = checkpoint[f'grid_{axis}'] if f'grid_{axis}' in checkpoint else None
+                if saved is None or saved.shape != values.shape or not np.allclose(saved, values):
+                    raise ValueError(f"The grid of the checkpoint {self.checkpoint_path} is different from the grid of this scan.")
+            self.done = checkpoint['done'].copy()
+            self.data = checkpoint['data'].copy() if 'data' in checkpoint else None
+        self.logger.info(f"Resuming scan from {self.checkpoint_path}: {self.numb_points_done}/{self.numb_points_total} points already done.")
+
+    def _store(self, index, setpoints, value):
+        value = np.asarray(value)
+        with self._data_lock:
+            if self.data is None:
+                dtype = value.dtype if np.issubdtype(value.dtype, np.inexact) else float
+                self.data = np.full(self.shape + value.shape, np.nan, dtype = dtype)
+            self.data[index] = value
+            self.done[index] = True
+        if self.on_point:
+            self.on_point(index, setpoints, value)
+
+    def _read(self, index, setpoints, token):
+        self._store(index, setpoints, self.func_read(index, setpoints, token))
+
+    def _move_to(self, setpoints, previous_setpoints):
+        # The set points of the axes which change are sent to all of them first, and the axes are then awaited: the movements are simultaneous
+        moved = [axis for axis in range(len(self.devices)) if (previous_setpoints is None) or (setpoints[axis] != previous_setpoints[axis])]
+        for axis in moved:
+            device = self.devices[axis]
+            if device.mode == 'CloseLoop':
+                device.set_position_f(setpoints[axis])
+            else:
+                device.set_voltage_f(setpoints[axis])
+        for axis in moved:
+            kwargs = dict(self.settle_kwargs)
+            if kwargs.get('tolerance'):
+                kwargs['target'] = setpoints[axis]
+            self.devices[axis].wait_until_settled(**kwargs)
+
+    def _run(self):
+        self._reset_stats()
+        self.last_exception = None
+        self._start_time = time.perf_counter()
+        last_checkpoint = time.monotonic()
+        pending = []
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'scan_read') if self.func_read else None
+        self.logger.info(f"Starting {self.order} scan of {self.numb_points_total - self.numb_points_done} points (grid shape = {self.shape})...")
+        try:
+            previous_setpoints = None
+            for grid_index in self.order_indices:
+                if self.stop_event.is_set():
+                    break
+                index = tuple(int(i) for i in grid_index)
+                if self.done[index]:
+                    continue
+                setpoints = np.array([values[i] for values, i in zip(self.grid, index)])
+                t_start = time.perf_counter()
+                self._move_to(setpoints, previous_setpoints)
+                previous_setpoints = setpoints
+                t_moved = time.perf_counter()
+                # Wait until a read slot is free, before latching a new acquisition
+                while len(pending) >= self.max_pending_reads:
+                    pending.pop(0).result()
+                t_trigger = time.perf_counter()
+                token = self.func_trigger(index, setpoints)
+                t_end = time.perf_counter()
+                if executor:
+                    pending.append(executor.submit(self._read, index, setpoints, token))
+                else:
+                    self._store(index, setpoints, token)
+                self.numb_points_scanned += 1
+                self.time_moving += t_moved - t_start
+                self.time_waiting_reads += t_trigger - t_moved
+                self.time_triggering += t_end - t_trigger
+                if self.checkpoint_path and (time.monotonic() - last_checkpoint > self.checkpoint_interval):
+                    self.save_checkpoint()
+                    last_checkpoint = time.monotonic()
+            for future in pending:
+                future.result()
+            if self.stop_event.is_set():
+                self.logger.info(f"Scan stopped.")
+            else:
+                self.logger.info(f"Scan terminated.")
+        except Exception as e:
+            self.last_exception = e
+            self.logger.error(f"Error during the scan: {e}")
+        finally:
+            if executor:
+                executor.shutdown(wait = True)
+            self._end_time = time.perf_counter()
+            if self.checkpoint_path:
+                self.save_checkpoint()
+            stats = self.stats
+            if stats['rate'] is not None:
+                self.logger.info(f"Scan points done = {stats['numb_points_done']}/{stats['numb_points_total']}, rate = {stats['rate']:.2f} points/s, "
+                                 f"mean move time = {1e3*stats['mean_move_time']:.1f} ms, mean trigger time = {1e3*stats['mean_trigger_time']:.1f} ms")
+            self.doing_scan = False
+            if self.on_ended:
+                self.on_ended()
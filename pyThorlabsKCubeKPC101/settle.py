@@ -0,0 +1,124 @@
+'''
+Settle detection, i.e. deciding when a movement of the piezo has ended.
+
+The detector is polled adaptively: right after a command is sent the device is polled every initial_interval seconds, and the interval is then
+multiplied by 'backoff' after each poll, up to max_interval. Short moves are therefore detected quickly, while long moves do not flood the device with requests.
+
+Two criteria are available
+- busy flag (default): the movement has ended when func_is_busy() returns False
+- tolerance: if both target and tolerance are specified, the movement has ended when |func_read_value() - target| < tolerance for numb_samples
+    consecutive polls. This is typically faster than waiting for the busy flag of the device. Once the value is within tolerance, the confirmation
+    samples are taken every initial_interval seconds.
+
+The detector does not depend on Qt. It can be used in a blocking way (wait()), or it can be polled by an external scheduler (e.g. a QTimer) via poll().
+In the latter case, the time to wait before the next poll is given by the attribute next_interval.
+'''
+import time
+
+class settle_detector():
+    '''
+    Parameters
+    ----------
+    func_is_busy
+        Function with no input parameter, returns True while the device is moving
+    func_read_value
+        Function with no input parameter, returns the current value (e.g. position) as a float. Only needed for the tolerance criterion
+    target : float
+    tolerance : float
+    numb_samples : int
+    initial_interval, max_interval, backoff : float
+        Parameters of the adaptive polling (see module docstring)
+    timeout : float
+        Maximum time (in s) to wait for the movement to end. None = no timeout
+    clock
+        Function returning the current time in s (default = time.monotonic)
+
+    Attributes updated by poll()
+    ----------
+    settled : bool
+    timed_out : bool
+    time_to_settle : float
+        Time (in s) between start() and the poll which detected the end of the movement
+    numb_polls : int
+    next_interval : float
+        Time (in s) to wait before the next call to poll()
+    '''
+    def __init__(self, func_is_busy, func_read_value = None, target = None, tolerance = None, numb_samples = 3,
+                 initial_interval = 0.005, max_interval = 0.1, backoff = 1.5, timeout = None, clock = time.monotonic):
+        self.func_is_busy = func_is_busy
+        self.func_read_value = func_read_value
+        self.target = target
+        self.tolerance = tolerance
+        self.numb_samples = max(int(numb_samples), 1)
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self.clock = clock
+        self.start()
+
+    @property
+    def uses_tolerance(self):
+        return (self.target is not None) and bool(self.tolerance) and (self.func_read_value is not None)
+
+    def start(self):
+        # Call this right after the command which starts the movement has been sent
+        self.start_time = self.clock()
+        self.settled = False
+        self.timed_out = False
+        self.time_to_settle = None
+        self.numb_polls = 0
+        self.next_interval = self.initial_interval
+        self._interval = self.initial_interval
+        self._numb_samples_within_tolerance = 0
+
+    def poll(self):
+        '''
+        Check (once) whether the movement has ended.
+
+        Returns
+        -------
+        bool
+            True if the movement has ended (or if the timeout has expired, in this case self.timed_out is also True)
+        '''
+        if self.settled:
+            return True
+        self.numb_polls += 1
+        if self.uses_tolerance:
+            if abs(self.func_read_value() - self.target) < self.tolerance:
+                self._numb_samples_within_tolerance += 1
+            else:
+                self._numb_samples_within_tolerance = 0
+            settled = self._numb_samples_within_tolerance >= self.numb_samples
+        else:
+            settled = not (self.func_is_busy())
+        elapsed = self.clock() - self.start_time
+        if settled:
+            self.settled = True
+            self.time_to_settle = elapsed
+            return True
+        if (self.timeout is not None) and (elapsed > self.timeout):
+            self.settled = True
+            self.timed_out = True
+            self.time_to_settle = elapsed
+            return True
+        if self._numb_samples_within_tolerance > 0:
+            # The value is already within tolerance, the remaining confirmation samples are taken at the fastest rate
+            self.next_interval = self.initial_interval
+            return False
+        self.next_interval = self._interval
+        self._interval = min(self._interval * self.backoff, self.max_interval)
+        return False
+
+    def wait(self, sleep = time.sleep):
+        '''
+        Block until the movement has ended. The current interval (i.e. the time until the next poll) is passed to the function sleep.
+
+        Returns
+        -------
+        float
+            Time to settle, in s
+        '''
+        while not self.poll():
+            sleep(self.next_interval)
+        return self.time_to_settle
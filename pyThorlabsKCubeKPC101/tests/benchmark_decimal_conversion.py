@@ -0,0 +1,32 @@
+'''
+Micro-benchmark of the Decimal <-> float conversions used in the driver hot loop. It compares the original string round trip
+(float(str(value)) and Decimal(value)) with the conversions provided by the backend (backend.to_float and backend.from_float),
+which are used by the driver methods position_f, voltage_f, set_position_f, set_voltage_f...
+
+It uses the Kinesis .NET assemblies (i.e. System.Decimal) when they can be loaded, otherwise it falls back to the simulated backend (decimal.Decimal).
+'''
+import timeit
+from pyThorlabsKCubeKPC101 import backends
+
+N = 100000
+
+try:
+    backend = backends.kinesis_backend()
+    backend.load()
+except Exception:
+    print("Kinesis assemblies could not be loaded, using the simulated backend (python decimal.Decimal).")
+    backend = backends.simulated_backend()
+
+Decimal = backend.Decimal
+value_float = 12.3456789
+value_decimal = backend.from_float(value_float)
+
+tests = [   ('Decimal -> float, float(str(value))', lambda: float(str(value_decimal))),
+            ('Decimal -> float, backend.to_float(value)', lambda: backend.to_float(value_decimal)),
+            ('float -> Decimal, type check + Decimal(value)', lambda: value_float if type(value_float) == Decimal else Decimal(value_float)),
+            ('float -> Decimal, backend.from_float(value)', lambda: backend.from_float(value_float)),
+        ]
+
+for name, func in tests:
+    t = min(timeit.repeat(func, number = N, repeat = 5)) / N
+    print(f"{name:<50}: {t*1e9:8.1f} ns per call")
@@ -0,0 +1,33 @@
+'''
+Fixtures shared by the automated tests. All tests use backends.simulated_backend, so they do not need Kinesis nor a real device.
+'''
+import pytest
+
+from pyThorlabsKCubeKPC101 import backends
+from pyThorlabsKCubeKPC101 import driver
+from pyThorlabsKCubeKPC101 import controller
+
+SERIAL_NUMBER = '29000001'
+
+@pytest.fixture
+def backend():
+    return backends.simulated_backend(serial_numbers = [SERIAL_NUMBER], settle_time = 0.05)
+
+@pytest.fixture
+def device(backend):
+    instrument = driver.pyThorlabsKCubeKPC101(backend = backend)
+    (Msg, ID) = instrument.connect_device(SERIAL_NUMBER)
+    assert ID == 1, Msg
+    instrument.persist_delay = None
+    yield instrument
+    if instrument.connected:
+        instrument.disconnect_device()
+
+@pytest.fixture
+def device_controller(backend):
+    ctl = controller.controller(backend = backend, config_file = None)
+    ctl.refresh_list_devices()
+    ctl.connect_device(ctl.list_devices[0])
+    assert ctl.instrument.connected
+    yield ctl
+    ctl.close(save_settings = False)
@@ -0,0 +1,34 @@
+import time
+import numpy as np
+
+from pyThorlabsKCubeKPC101 import acquisition
+from pyThorlabsKCubeKPC101 import history
+
+def test_acquisition_worker_fills_history(device):
+    buffer = history.history_buffer(capacity = 1000)
+    worker = acquisition.acquisition_worker(func_acquire = device.snapshot, period = 0.01, lock = device.lock, callback = buffer.append_snapshot)
+    device.set_position_f(2.0)
+    worker.start()
+    time.sleep(0.3)
+    worker.stop()
+    stats = worker.stats
+    assert worker.is_running == False
+    assert stats['numb_errors'] == 0
+    assert 15 <= stats['numb_samples'] <= 35
+    assert len(buffer) == stats['numb_samples']
+    samples = buffer.last()
+    assert (np.diff(samples['timestamp']) > 0).all()
+    assert samples['position'][-1] == 2.0
+
+def test_acquisition_worker_counts_errors():
+    errors = []
+    def acquire():
+        raise RuntimeError("No device is currently connected.")
+    worker = acquisition.acquisition_worker(func_acquire = acquire, period = 0.01, on_error = errors.append)
+    worker.start()
+    time.sleep(0.1)
+    worker.stop()
+    assert not worker.is_running
+    assert worker.stats['numb_samples'] == 0
+    assert worker.stats['numb_errors'] == len(errors) > 0
+    assert isinstance(errors[0], RuntimeError)
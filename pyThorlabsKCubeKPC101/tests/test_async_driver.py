@@ -0,0 +1,37 @@
+import asyncio
+import pytest
+
+from pyThorlabsKCubeKPC101 import async_driver
+from conftest import SERIAL_NUMBER
+
+def test_move_and_stream(backend):
+    async def main():
+        async with async_driver.AsyncKPC101(backend = backend, tolerance = 0.01, timeout = 1) as piezo:
+            await piezo.connect()
+            assert piezo.connected
+            await piezo.set_mode('CloseLoop')
+            # The states are streamed while the movement is in progress, the event loop is not blocked
+            (settle_time, states) = await asyncio.gather(piezo.move_to(5.0), collect(piezo.stream(rate = 100, max_samples = 10)))
+            assert settle_time < 0.2
+            assert len(states) == 10
+            assert states[0].busy and not states[-1].busy
+            assert await piezo.position() == pytest.approx(5.0)
+        assert not piezo.connected
+    async def collect(generator):
+        return [state async for state in generator]
+    asyncio.run(main())
+
+def test_errors(backend):
+    async def main():
+        piezo = async_driver.AsyncKPC101(backend = backend)
+        with pytest.raises(ValueError):
+            await piezo.connect('12345678')
+        await piezo.connect(SERIAL_NUMBER)
+        await piezo.set_mode('OpenLoop')
+        with pytest.raises(RuntimeError):
+            await piezo.move_to(5.0)
+        await piezo.set_voltage(30.0, wait = False)
+        with pytest.raises(TimeoutError):
+            await piezo.wait_until_settled(timeout = 0.01)
+        await piezo.close()
+    asyncio.run(main())
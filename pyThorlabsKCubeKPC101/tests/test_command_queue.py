@@ -0,0 +1,40 @@
+import time
+import pytest
+
+def test_command_queue_coalescing(device_controller):
+    for position in [1, 2, 3, 4, 5]:
+        device_controller.set_position(position)
+    stats = device_controller.command_queue_stats
+    # The first command is executed, the following absolute set points replace each other in the queue
+    assert stats['in_flight']
+    assert stats['depth'] == 1
+    assert stats['numb_dropped'] == 3
+    for _ in range(4):
+        device_controller.jog_by(0.5)
+    assert device_controller.command_queue_stats['depth'] == 1
+    assert device_controller.wait_for_movement(5)
+    stats = device_controller.command_queue_stats
+    assert stats['depth'] == 0
+    assert not stats['in_flight']
+    assert stats['numb_executed'] == 2
+    assert device_controller.output['Position'] == pytest.approx(7.0)
+
+def test_clear_command_queue(device_controller):
+    device_controller.set_position(1.0)
+    device_controller.set_position(2.0)
+    assert device_controller.clear_command_queue() == 1
+    assert device_controller.wait_for_movement(5)
+    assert device_controller.output['Position'] == pytest.approx(1.0)
+
+def test_disconnect_during_movement(device_controller):
+    # The movement in progress must not keep the command queue busy after the device has been disconnected and reconnected
+    assert device_controller.set_position(3.0)
+    device_controller.disconnect_device()
+    time.sleep(0.2)
+    device_controller.connect_device(device_controller.list_devices[0])
+    assert device_controller.set_position(5.0)
+    assert device_controller.wait_for_movement(5)
+    assert device_controller.output['Position'] == pytest.approx(5.0)
+    stats = device_controller.command_queue_stats
+    assert not stats['in_flight']
+    assert stats['depth'] == 0
@@ -0,0 +1,36 @@
+import os
+import sys
+import subprocess
+import pytest
+
+from pyThorlabsKCubeKPC101 import controller
+
+def test_set_position(device_controller):
+    assert device_controller.set_position(4.0)
+    assert device_controller.wait_for_movement(5)
+    assert device_controller.output['Position'] == pytest.approx(4.0)
+
+def test_events(backend):
+    events = []
+    ctl = controller.controller(backend = backend, config_file = None, config_dict = {'mode': 'CloseLoop'})
+    for event in ['connected', 'mode_changed', 'moving_status', 'update_state']:
+        ctl.subscribe(event, lambda *args, event = event: events.append((event,) + args))
+    ctl.refresh_list_devices()
+    ctl.connect_device(ctl.list_devices[0])
+    assert ('connected', ctl.SIG_CONNECTING) in events
+    assert ('connected', ctl.SIG_CONNECTED) in events
+    ctl.set_mode('OpenLoop')
+    assert ('mode_changed', 'OpenLoop') in events
+    del events[:]
+    assert ctl.set_voltage(15.0)
+    assert ctl.wait_for_movement(5)
+    assert ctl.output['Voltage'] == pytest.approx(15.0)
+    assert [args for (event, *args) in events if event == 'moving_status'] == [[ctl.SIG_MOVEMENT_STARTED], [ctl.SIG_MOVEMENT_ENDED]]
+    assert any(event == 'update_state' for (event, *args) in events)
+    ctl.close(save_settings = False)
+    assert events[-1] == ('connected', ctl.SIG_DISCONNECTED)
+
+def test_controller_does_not_load_qt():
+    code = "import sys; import pyThorlabsKCubeKPC101.controller; print(any(m.startswith(('PyQt', 'PySide', 'qtpy')) for m in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, cwd = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    assert result.stdout.strip() == 'False', result.stderr
@@ -0,0 +1,142 @@
+import sys
+import time
+import pytest
+
+from pyThorlabsKCubeKPC101 import backends
+from pyThorlabsKCubeKPC101 import driver
+from conftest import SERIAL_NUMBER
+
+def test_kinesis_is_loaded_lazily():
+    instrument = driver.pyThorlabsKCubeKPC101()
+    assert isinstance(instrument.backend, backends.kinesis_backend)
+    assert not instrument.backend.loaded
+    assert not ('clr' in sys.modules)
+
+def test_connect_disconnect(backend):
+    instrument = driver.pyThorlabsKCubeKPC101(backend = backend)
+    assert instrument.list_devices() == [SERIAL_NUMBER]
+    (Msg, ID) = instrument.connect_device(SERIAL_NUMBER)
+    assert ID == 1
+    assert instrument.connected
+    assert instrument.position_limits_f == (0.0, 20.0)
+    assert instrument.voltage_limits_f == (0.0, 75.0)
+    (Msg, ID) = instrument.disconnect_device()
+    assert ID == 1
+    assert not instrument.connected
+    with pytest.raises(Exception):
+        instrument.position_f
+
+def test_connect_unknown_device(backend):
+    instrument = driver.pyThorlabsKCubeKPC101(backend = backend)
+    with pytest.raises(ValueError):
+        instrument.connect_device('12345678')
+    assert not instrument.connected
+
+def test_close_loop_move(device):
+    device.mode = 'CloseLoop'
+    device.set_position_f(7.5)
+    assert device.is_busy
+    device.wait_until_settled(timeout = 1)
+    assert not device.is_busy
+    assert device.position_f == pytest.approx(7.5)
+    with pytest.raises(RuntimeError):
+        device.set_voltage_f(10.0)
+    with pytest.raises(ValueError):
+        device.set_position_f(25.0)
+
+def test_open_loop_move(device):
+    device.mode = 'OpenLoop'
+    assert device.mode == 'OpenLoop'
+    device.set_voltage_f(37.5)
+    device.wait_until_settled(timeout = 1)
+    assert device.voltage_f == pytest.approx(37.5)
+    assert device.position_f == pytest.approx(10.0)
+    with pytest.raises(RuntimeError):
+        device.set_position_f(5.0)
+    with pytest.raises(ValueError):
+        device.set_voltage_f(-1.0)
+
+def test_settings_cache(device):
+    device.mode = 'CloseLoop'
+    device.enable_instrumentation()
+    for position in [1.0, 2.0, 3.0]:
+        device.set_position_f(position)
+    calls = device.instrumentation_report()
+    # Limits and mode are read from the cache, so each set point needs a single call to the device
+    assert calls['SetPosition']['count'] == 3
+    assert 'GetMaxTravel' not in calls
+    assert 'GetPositionControlMode' not in calls
+    device.use_cache = False
+    device.set_position_f(4.0)
+    assert device.instrumentation_report()['GetPositionControlMode']['count'] >= 1
+    device.use_cache = True
+    device.invalidate_cache()
+    numb_reads = device.instrumentation_report()['GetMaxTravel']['count']
+    device.position_limits_f
+    device.position_limits_f
+    assert device.instrumentation_report()['GetMaxTravel']['count'] == numb_reads + 1
+
+class slow_device(backends.simulated_device):
+    # Simulated device whose settings are initialized init_time s after the connection
+    init_time = 0.03
+
+    def Connect(self, device_sn):
+        super().Connect(device_sn)
+        self._connected_at = time.perf_counter()
+
+    def IsSettingsInitialized(self):
+        return self._connected and (time.perf_counter() - self._connected_at >= self.init_time)
+
+def test_connection_waits_for_the_device(backend):
+    backend.device_class = slow_device
+    instrument = driver.pyThorlabsKCubeKPC101(backend = backend)
+    (Msg, ID) = instrument.connect_device(SERIAL_NUMBER)
+    assert ID == 1, Msg
+    timings = instrument.connection_timings
+    assert set(timings.keys()) == {'create_device', 'connect', 'enable', 'settings_initialized', 'read_settings', 'total'}
+    # The connection is ready shortly after the settings are initialized, instead of after a fixed sleep
+    assert slow_device.init_time <= timings['settings_initialized'] < slow_device.init_time + 0.06
+    assert timings['total'] < 0.2
+    instrument.disconnect_device()
+
+def test_connection_timeout(backend):
+    backend.device_class = slow_device
+    instrument = driver.pyThorlabsKCubeKPC101(backend = backend)
+    (Msg, ID) = instrument.connect_device(SERIAL_NUMBER, timeout = 0.01)
+    assert ID == 0
+    assert isinstance(Msg, RuntimeError)
+    assert not instrument.connected
+
+def test_set_jog_steps(device):
+    device.enable_instrumentation()
+    steps = device.set_jog_steps(position = 0.5, voltage = 2)
+    assert device.jog_steps_f == {'percentage': 0.1, 'position': 0.5, 'voltage': 2.0}
+    assert steps['position'] == device.backend.Decimal('0.5')
+    # Writing the same values again does not access the device memory
+    device.set_jog_steps(position = 0.5)
+    assert device.instrumentation_report()['SetJogSteps']['count'] == 1
+    # An invalid value does not change any of the steps, neither on the device nor in the settings cache
+    with pytest.raises(TypeError):
+        device.set_jog_steps(position = 2.0, voltage = 'abc')
+    assert device.jog_steps_f['position'] == 0.5
+    device.invalidate_cache()
+    assert device.jog_steps_f['position'] == 0.5
+
+def test_deferred_persistence(device):
+    device.persist_delay = 0.05
+    with device.settings_transaction():
+        device.set_jog_steps(position = 0.2)
+        device.set_jog_steps(voltage = 1.0)
+        device.mode = 'OpenLoop'
+        assert device.numb_persists == 0
+    # The changes made inside a transaction are saved once, at its end
+    assert device.numb_persists == 1
+    assert not device.settings_pending
+    device.set_jog_steps(position = 0.3)
+    device.set_jog_steps(position = 0.4)
+    assert device.settings_pending
+    time.sleep(0.15)
+    assert device.numb_persists == 2
+    device.set_jog_steps(position = 0.5)
+    device.disconnect_device()
+    assert device.numb_persists == 3
@@ -0,0 +1,66 @@
+import math
+import pytest
+
+from pyThorlabsKCubeKPC101 import driver_virtual
+
+SERIAL_NUMBER = '29999999'
+
+def connect(**kwargs):
+    instrument = driver_virtual.pyThorlabsKCubeKPC101(serial_numbers = [SERIAL_NUMBER], **kwargs)
+    (Msg, ID) = instrument.connect_device(SERIAL_NUMBER)
+    assert ID == 1, Msg
+    instrument.persist_delay = None
+    return instrument
+
+def test_close_loop_first_order_response():
+    clock = driver_virtual.simulated_clock()
+    instrument = connect(clock = clock, noise = 0)
+    instrument.mode = 'CloseLoop'
+    instrument.set_position_f(10.0)
+    clock.advance(0.02)
+    assert instrument.position_f == pytest.approx(10.0 * (1 - math.exp(-1)), abs = 1e-3)
+    assert instrument.is_busy
+    clock.advance(1.0)
+    assert not instrument.is_busy
+    assert instrument.position_f == pytest.approx(10.0, abs = 0.005)
+    instrument.disconnect_device()
+
+def test_open_loop_hysteresis():
+    clock = driver_virtual.simulated_clock()
+    instrument = connect(clock = clock, noise = 0, creep = 0)
+    instrument.mode = 'OpenLoop'
+    positions = {}
+    for (branch, voltages) in [('up', [75.0, 37.5]), ('down', [0.0, 37.5])]:
+        for voltage in voltages:
+            instrument.set_voltage_f(voltage)
+            clock.advance(0.1)
+        positions[branch] = instrument.position_f
+    # The position at the same voltage depends on the direction of the last movement
+    assert positions['up'] > positions['down'] + 0.5
+    instrument.disconnect_device()
+
+def test_hysteresis_does_not_depend_on_the_read_rate():
+    final_positions = []
+    for numb_reads in [1, 100]:
+        clock = driver_virtual.simulated_clock()
+        instrument = connect(clock = clock, noise = 0, creep = 0)
+        instrument.mode = 'OpenLoop'
+        for voltage in [60.0, 20.0, 45.0]:
+            instrument.set_voltage_f(voltage)
+            for _ in range(numb_reads):
+                clock.advance(0.1 / numb_reads)
+                instrument.position_f
+        final_positions.append(instrument.position_f)
+        instrument.disconnect_device()
+    assert final_positions[0] == pytest.approx(final_positions[1], abs = 1e-3)
+
+def test_noise_is_reproducible_with_a_seed():
+    readings = []
+    for _ in range(2):
+        clock = driver_virtual.simulated_clock()
+        instrument = connect(clock = clock, seed = 1234)
+        instrument.mode = 'CloseLoop'
+        readings.append([instrument.position_f for _ in range(5)])
+        instrument.disconnect_device()
+    assert readings[0] == readings[1]
+    assert len(set(readings[0])) > 1
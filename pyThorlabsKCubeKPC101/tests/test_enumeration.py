@@ -0,0 +1,52 @@
+import gc
+import weakref
+
+from pyThorlabsKCubeKPC101 import enumeration
+from pyThorlabsKCubeKPC101 import backends
+
+def test_ttl_and_refresh():
+    serial_numbers = ['29000001']
+    cache = enumeration.device_list_cache(lambda: serial_numbers, ttl = 10)
+    assert cache.get() == ['29000001']
+    serial_numbers = ['29000002']
+    assert cache.get() == ['29000001']      # Still valid
+    assert cache.numb_enumerations == 1
+    assert cache.get(max_age = 0) == ['29000002']
+    serial_numbers = ['29000002', '29000003']
+    assert cache.refresh() == (['29000002', '29000003'], ['29000003'], [])
+    cache.invalidate()
+    serial_numbers = ['29000003']
+    assert cache.get() == ['29000003']
+    assert cache.numb_enumerations == 4
+
+def test_cache_per_backend():
+    backend_1 = backends.simulated_backend(['29000001'])
+    backend_2 = backends.simulated_backend(['29000002'])
+    cache = enumeration.get_cache(backend_1)
+    assert enumeration.get_cache(backend_1) is cache
+    assert not (enumeration.get_cache(backend_2) is cache)
+    assert cache.get() == ['29000001']
+    # The cache does not keep its backend alive
+    ref = weakref.ref(backend_1)
+    del backend_1
+    gc.collect()
+    assert ref() is None
+
+class shared_backend(backends.simulated_backend):
+    enumeration_key = ('test_shared',)
+
+def test_shared_cache():
+    backend_1 = shared_backend(['29000001'])
+    backend_2 = shared_backend(['29000001'])
+    cache = enumeration.get_cache(backend_1)
+    assert enumeration.get_cache(backend_2) is cache
+    # The shared cache still works after the backend which created it is deleted
+    ref = weakref.ref(backend_1)
+    del backend_1
+    gc.collect()
+    assert ref() is None
+    assert enumeration.get_cache(backend_2).get(max_age = 0) == ['29000001']
+    # and it is discarded when no backend uses it anymore
+    del backend_2, cache
+    gc.collect()
+    assert not (('test_shared',) in enumeration._shared_caches)
@@ -0,0 +1,65 @@
+import time
+import pytest
+
+from pyThorlabsKCubeKPC101 import driver_virtual
+
+@pytest.fixture
+def virtual_device():
+    instrument = driver_virtual.pyThorlabsKCubeKPC101(noise = 0, creep = 0)
+    (Msg, ID) = instrument.connect_device('29999999')
+    assert ID == 1, Msg
+    instrument.persist_delay = None
+    yield instrument
+    instrument.stop_feedback()
+    if instrument.connected:
+        instrument.disconnect_device()
+
+def test_feedback_reaches_the_setpoint(virtual_device):
+    loop = virtual_device.start_feedback(rate = 500, kp = 1.0, ki = 200.0, setpoint = 8.0)
+    assert virtual_device.mode == 'OpenLoop'
+    time.sleep(0.5)
+    assert virtual_device.position_f == pytest.approx(8.0, abs = 0.05)
+    loop.set_setpoint(12.0)
+    time.sleep(0.5)
+    assert virtual_device.position_f == pytest.approx(12.0, abs = 0.05)
+    virtual_device.stop_feedback()
+    stats = loop.stats
+    assert not loop.is_running
+    assert loop.last_exception is None
+    assert stats['numb_iterations'] > 200
+
+def test_anti_windup_with_negative_gains(virtual_device):
+    # Inverted external error signal, compensated by negative gains
+    target = [25.0]     # Out of the travel range: the output saturates at the maximum voltage
+    loop = virtual_device.start_feedback(rate = 500, kp = -1.0, ki = -200.0, func_error = lambda: virtual_device.position_f - target[0])
+    time.sleep(0.3)
+    assert loop.numb_saturated > 0
+    assert virtual_device.voltage_f == pytest.approx(75.0)
+    # Without anti-windup the integral would have grown during the saturation, and the output would stay saturated for a long time
+    target[0] = 10.0
+    time.sleep(0.3)
+    assert virtual_device.position_f == pytest.approx(10.0, abs = 0.05)
+
+def test_external_error_is_read_without_the_device_lock(virtual_device):
+    lock_held = []
+    def func_error():
+        # A slow external error signal: the device must remain accessible from other threads in the meanwhile
+        lock_held.append(virtual_device.lock._is_owned())
+        time.sleep(0.01)
+        return 0.0
+    virtual_device.start_feedback(rate = 50, func_error = func_error)
+    time.sleep(0.1)
+    virtual_device.stop_feedback()
+    assert lock_held and not any(lock_held)
+
+def test_polling_rate_follows_the_loop(virtual_device):
+    assert virtual_device.polling_rate == 250
+    loop = virtual_device.start_feedback(rate = 200, ki = 100.0, setpoint = 5.0)
+    # The device is polled at least once per iteration while the loop runs, and the original interval is restored when it stops
+    assert virtual_device.polling_rate == 5
+    virtual_device.stop_feedback()
+    assert virtual_device.polling_rate == 250
+    assert loop.last_exception is None
+    # With an external error the position is not used, so the polling interval is not changed
+    virtual_device.start_feedback(rate = 200, func_error = lambda: 0.0)
+    assert virtual_device.polling_rate == 250
@@ -0,0 +1,41 @@
+import pytest
+
+from pyThorlabsKCubeKPC101 import backends
+from pyThorlabsKCubeKPC101 import group
+
+@pytest.fixture
+def device_group():
+    axes_group = group.KPC101Group(['1', '2'], axes = ['x', 'y'], backend = backends.simulated_backend(serial_numbers = ['1', '2']))
+    axes_group.connect()
+    axes_group.set_mode('CloseLoop')
+    yield axes_group
+    axes_group.close()
+
+def test_move_to(device_group):
+    timings = device_group.move_to({'x': 3.0, 'y': 4.0}, timeout = 1)
+    assert set(timings.keys()) == {'x', 'y'}
+    assert device_group['x'].position_f == pytest.approx(3.0)
+    assert device_group['y'].position_f == pytest.approx(4.0)
+
+def test_move_to_invalid_target_does_not_move_any_axis(device_group):
+    device_group.move_to([3.0, 4.0], timeout = 1)
+    with pytest.raises(ValueError):
+        device_group.move_to({'x': 5.0, 'y': 50.0})
+    assert device_group['x'].position_f == pytest.approx(3.0)
+    assert device_group['y'].position_f == pytest.approx(4.0)
+
+def test_connect_and_snapshot(device_group):
+    assert device_group.connected
+    assert {axis: device_group[axis].device_sn for axis in device_group.axes} == {'x': '1', 'y': '2'}
+    device_group.move_to({'y': 2.5}, timeout = 1)
+    states = device_group.snapshot()
+    assert states['x'].position == pytest.approx(0.0)
+    assert states['y'].position == pytest.approx(2.5)
+    assert all(state.mode == 'CloseLoop' for state in states.values())
+
+def test_move_axes_in_parallel(device_group):
+    # The simulated devices settle 50 ms after each command: axes moved together settle in about 50 ms, not 100 ms
+    timings = device_group.move_to([1.0, 2.0], timeout = 1)
+    assert max(axis_timings['total'] for axis_timings in timings.values()) < 0.095
+    with pytest.raises(ValueError):
+        device_group.move_to({'z': 1.0})
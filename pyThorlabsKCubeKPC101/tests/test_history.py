@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from pyThorlabsKCubeKPC101 import history
+
+def test_history_ring_buffer():
+    buffer = history.history_buffer(capacity = 5)
+    for i in range(8):
+        buffer.append(float(i), 0.1 * i, 1.0 * i, 'CloseLoop', False)
+    assert len(buffer) == 5
+    assert list(buffer.last()['timestamp']) == [3.0, 4.0, 5.0, 6.0, 7.0]
+    assert list(buffer.last(2)['timestamp']) == [6.0, 7.0]
+    assert list(buffer.last_seconds(1.5)['timestamp']) == [6.0, 7.0]
+    assert (buffer.last()['mode'] == history.MODE_CODES['CloseLoop']).all()
+    stats = buffer.stats()
+    assert stats['numb_samples'] == 5
+    assert stats['voltage_mean'] == np.mean([3.0, 4.0, 5.0, 6.0, 7.0])
+    assert stats['position_drift'] == pytest.approx(0.1)
+    assert stats['duration'] == 4.0
+    buffer.clear()
+    assert len(buffer) == 0
+    assert buffer.stats()['numb_samples'] == 0
+
+def test_history_last_is_a_view():
+    buffer = history.history_buffer(capacity = 3)
+    for i in range(4):
+        buffer.append(float(i), 0.0, 0.0)
+    samples = buffer.last()
+    assert np.shares_memory(samples, buffer._data)
+
+def test_history_invalid_capacity():
+    with pytest.raises(ValueError):
+        history.history_buffer(capacity = 0)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from pyThorlabsKCubeKPC101 import hysteresis
+from pyThorlabsKCubeKPC101 import driver_virtual
+
+def test_fit_model_inverts_the_branches():
+    voltages = np.linspace(0, 75, 51)
+    # Synthetic loop: the descending branch is above the ascending one
+    positions_up = 20 * (voltages / 75)**1.2
+    positions_down = 20 * (voltages / 75)**0.8
+    model = hysteresis.fit_model(voltages, positions_up, voltages[::-1], positions_down[::-1], table_size = 1024)
+    assert (np.diff(model.table, axis = 1) >= 0).all()
+    model.reset()
+    # Going up, the voltage needed for 10 um is larger than going down
+    voltage_up = model.lookup(model.ASCENDING, np.array([10.0]))[0]
+    voltage_down = model.lookup(model.DESCENDING, np.array([10.0]))[0]
+    assert voltage_up == pytest.approx(75 * 0.5**(1 / 1.2), abs = 0.2)
+    assert voltage_down == pytest.approx(75 * 0.5**(1 / 0.8), abs = 0.2)
+
+def test_model_tracks_direction_and_reversals():
+    positions = np.linspace(0, 20, 101)
+    model = hysteresis.hysteresis_model(positions, np.array([positions * 3 + 10, positions * 3]).clip(0, 75))
+    voltages = model.voltages_for([5.0, 10.0, 9.999, 8.0])
+    assert model.direction == -1
+    assert model.turning_position == 10.0
+    assert model.turning_voltage == pytest.approx(voltages[1])
+    # The voltage is continuous at the reversal point, and it then follows the (scaled) descending branch
+    assert voltages[2] == pytest.approx(voltages[1], abs = 0.01)
+    assert voltages[3] < voltages[2]
+    assert model.last_position == 8.0
+    model.reset()
+    assert model.last_position is None
+    assert model.voltage_for(8.0) == pytest.approx(24.0)
+
+def test_open_loop_compensation_on_the_virtual_piezo():
+    clock = driver_virtual.simulated_clock()
+    instrument = driver_virtual.pyThorlabsKCubeKPC101(clock = clock, noise = 0, creep = 0)
+    instrument.connect_device('29999999')
+    instrument.persist_delay = None
+    model = instrument.calibrate_open_loop(numb_points = 51, dwell = 0.02, sleep = clock.sleep)
+    assert model.rms_error < 0.1
+    instrument.mode = 'OpenLoop'
+    errors = []
+    for target in [15.0, 5.0, 12.0, 8.0, 10.0]:
+        instrument.set_position_open_loop(target)
+        clock.advance(0.1)
+        errors.append(instrument.position_f - target)
+    # Without compensation the hysteresis gives errors of a few um
+    assert max(abs(error) for error in errors) < 0.3
+    instrument.disconnect_device()
@@ -0,0 +1,32 @@
+import json
+import pytest
+
+from pyThorlabsKCubeKPC101 import instrumentation
+
+def test_method_statistics():
+    stats = instrumentation.method_statistics()
+    assert stats.percentile(50) != stats.percentile(50)   # nan without samples
+    for duration in [1e-4] * 99 + [1.0]:
+        stats.record(duration)
+    result = stats.to_dict()
+    assert result['count'] == 100
+    assert result['min'] == 1e-4
+    assert result['max'] == 1.0
+    assert result['mean'] == pytest.approx((99 * 1e-4 + 1.0) / 100)
+    assert 1e-4 <= result['p50'] < 2e-4
+    assert sum(row[2] for row in result['histogram']) == 100
+
+def test_instrumentation_of_the_driver(device):
+    assert device.instrumentation_report() == dict()
+    device.enable_instrumentation()
+    device.snapshot()
+    device.snapshot()
+    report = device.instrumentation_report()
+    assert report['GetPosition']['count'] == 2
+    assert report['GetOutputVoltage']['count'] == 2
+    assert json.loads(device.instrumentation_report(as_json = True))['GetPosition']['count'] == 2
+    device.disable_instrumentation()
+    assert not isinstance(device.device, instrumentation.instrumented_device)
+    device.snapshot()
+    # The statistics collected while instrumentation was enabled are still available
+    assert device.instrumentation_report()['GetPosition']['count'] == 2
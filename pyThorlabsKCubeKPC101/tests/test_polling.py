@@ -0,0 +1,38 @@
+import pytest
+
+from pyThorlabsKCubeKPC101 import controller
+
+def test_set_polling_rate(device):
+    assert device.polling_rate == device.default_polling_rate
+    assert device.set_polling_rate(50)
+    assert not device.set_polling_rate(50)
+    assert device.device._polling_rate == 50
+    with pytest.raises(ValueError):
+        device.set_polling_rate(0)
+    device.snapshot()
+    report = device.polling_report()
+    assert set(report.keys()) == {device.default_polling_rate, 50}
+    assert report[50]['numb_reads'] == 1
+    assert report[50]['numb_periods'] == 1
+    assert report[device.default_polling_rate]['time'] > 0
+
+def test_adaptive_polling(backend):
+    # Delayed calls are collected and executed by hand, so that the switch back to the idle polling rate can be checked step by step
+    delayed_calls = []
+    ctl = controller.controller(backend = backend, config_file = None, call_later = lambda delay, function: delayed_calls.append(function),
+                                config_dict = {'polling_rate': 200, 'adaptive_polling': True, 'polling_rate_moving': 10})
+    ctl.refresh_list_devices()
+    ctl.connect_device(ctl.list_devices[0])
+    assert ctl.instrument.polling_rate == 200
+    ctl.set_moving_state()
+    assert ctl.instrument.polling_rate == 10
+    ctl.set_non_moving_state()
+    assert ctl.instrument.polling_rate == 10
+    # A new movement starting before the idle delay has expired cancels the pending switch
+    ctl.set_moving_state()
+    delayed_calls.pop(0)()
+    assert ctl.instrument.polling_rate == 10
+    ctl.set_non_moving_state()
+    delayed_calls.pop(0)()
+    assert ctl.instrument.polling_rate == 200
+    ctl.close(save_settings = False)
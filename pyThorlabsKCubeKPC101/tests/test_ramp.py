@@ -0,0 +1,49 @@
+import time
+import numpy as np
+import pytest
+
+from pyThorlabsKCubeKPC101 import ramp
+
+SETTINGS = {'ramp_step_size': 0.5, 'ramp_numb_steps': 4, 'ramp_repeat': 1, 'ramp_reverse': False, 'ramp_wait_1': 0.02, 'ramp_wait_2': 0.01,
+            'ramp_send_trigger': True, 'ramp_send_initial_trigger': False, 'ramp_reset': True}
+
+def test_ramp_setpoints():
+    assert np.allclose(ramp.ramp_setpoints(1.0, 0.5, 3), [1.5, 2.0, 2.5])
+    assert np.allclose(ramp.ramp_setpoints(1.0, 0.5, 2, repeat = 2), [1.5, 2.0, 2.5, 3.0])
+    assert np.allclose(ramp.ramp_setpoints(1.0, 0.5, 2, repeat = 2, reverse = True), [1.5, 2.0, 1.5, 1.0, 1.5, 2.0, 1.5, 1.0])
+    # Each set point is computed from the initial value, rounding errors do not accumulate
+    assert ramp.ramp_setpoints(0.0, 0.1, 1000)[-1] == 100.0
+
+def test_ramp_waits_are_counted_from_the_end_of_each_movement():
+    settle_time = 0.03
+    events = []
+    values = [1.0]
+    def set_value(value):
+        values.append(value)
+        events.append(('set', time.monotonic(), value))
+    def wait_step_ended(value, stop_event):
+        time.sleep(settle_time)
+        events.append(('settled', time.monotonic(), value))
+    engine = ramp.ramp_engine(func_set_value = set_value, func_read_value = lambda: values[-1], func_wait_step_ended = wait_step_ended,
+                              func_trigger = lambda: events.append(('trigger', time.monotonic(), values[-1])))
+    engine.start(SETTINGS, blocking = True)
+    assert engine.numb_steps_done == 4
+    assert values[1:] == [1.5, 2.0, 2.5, 3.0, 1.0]   # The last set point resets the initial value
+    times = {kind: np.array([t for (k, t, value) in events if k == kind]) for kind in ['set', 'settled', 'trigger']}
+    # The trigger is sent ramp_wait_1 s after the movement has settled, and the next step starts ramp_wait_2 s after the trigger
+    # (the sleeps can only last longer than requested, so the upper bounds are loose. ramp_wait_2 is counted from the time at which the
+    # trigger was scheduled, so it is checked together with ramp_wait_1)
+    wait_1 = times['trigger'] - times['settled'][:4]
+    wait_12 = times['set'][1:4] - times['settled'][:3]
+    assert (wait_1 >= SETTINGS['ramp_wait_1'] - 0.001).all() and (wait_1 < SETTINGS['ramp_wait_1'] + 0.02).all()
+    assert (wait_12 >= SETTINGS['ramp_wait_1'] + SETTINGS['ramp_wait_2'] - 0.001).all()
+    assert (wait_12 < SETTINGS['ramp_wait_1'] + SETTINGS['ramp_wait_2'] + 0.02).all()
+    assert engine.numb_resyncs == 0
+
+def test_stop_ramp():
+    engine = ramp.ramp_engine(func_set_value = lambda value: None, func_read_value = lambda: 0.0)
+    engine.start(dict(SETTINGS, ramp_numb_steps = 1000, ramp_wait_1 = 0.01, ramp_wait_2 = 0.0))
+    time.sleep(0.05)
+    engine.stop()
+    assert not engine.doing_ramp
+    assert 0 < engine.numb_steps_done < 1000
@@ -0,0 +1,88 @@
+import threading
+import numpy as np
+import pytest
+
+from pyThorlabsKCubeKPC101 import recorder
+
+def record(rec, numb_samples):
+    for i in range(numb_samples):
+        rec.append(float(i), 0.1 * i, 0.2 * i, 'OpenLoop', i % 2)
+
+def test_npy_readback(tmp_path):
+    path = str(tmp_path / 'log.npy')
+    with recorder.npy_recorder(path, chunk_size = 7, block_size = 16) as rec:
+        record(rec, 50)
+    samples = recorder.read_recording(path)
+    assert len(samples) == 50
+    assert np.allclose(samples['timestamp'], np.arange(50))
+    assert np.allclose(samples['voltage'], 0.2 * np.arange(50))
+    assert (samples['busy'] == np.arange(50) % 2).all()
+
+def test_npy_is_valid_while_recording(tmp_path):
+    # Without close() (e.g. if the program crashes), the file contains all the samples flushed so far
+    path = str(tmp_path / 'log.npy')
+    rec = recorder.npy_recorder(path, chunk_size = 8, block_size = 16)
+    record(rec, 20)
+    rec.flush()
+    samples = np.load(path)
+    assert len(samples) == 20
+    assert np.allclose(samples['position'], 0.1 * np.arange(20))
+    rec.close()
+
+class failing_recorder(recorder.npy_recorder):
+    def _write(self, samples):
+        raise OSError('disk full')
+
+def test_write_errors_are_raised(tmp_path, caplog):
+    rec = failing_recorder(str(tmp_path / 'log.npy'), chunk_size = 4)
+    record(rec, 4)
+    with pytest.raises(OSError):
+        rec.flush()
+    with pytest.raises(OSError):
+        rec.append(0.0, 0.0, 0.0)
+    with pytest.raises(OSError):
+        rec.close()
+    assert rec.numb_samples_written == 0
+    assert sum('disk full' in r.getMessage() for r in caplog.records) == 1   # Logged only once
+
+class slow_recorder(recorder.npy_recorder):
+    def __init__(self, *args, **kwargs):
+        self.writing = threading.Event()
+        self.can_write = threading.Event()
+        super().__init__(*args, **kwargs)
+
+    def _write(self, samples):
+        self.writing.set()
+        self.can_write.wait()
+        super()._write(samples)
+
+def test_chunks_are_dropped_when_the_writer_is_late(tmp_path):
+    path = str(tmp_path / 'log.npy')
+    rec = slow_recorder(path, chunk_size = 4, flush_interval = 10, max_queued_chunks = 2)
+    record(rec, 4)
+    assert rec.writing.wait(timeout = 5)
+    record(rec, 36)
+    # One chunk is being written, two are waiting and the others are dropped
+    assert rec.numb_chunks_dropped == 7
+    assert rec.numb_samples_dropped == 28
+    rec.can_write.set()
+    rec.close()
+    assert len(recorder.read_recording(path)) == 12
+
+@pytest.mark.skipif(not recorder.HAS_H5PY, reason = 'h5py is not installed')
+def test_hdf5_readback(tmp_path):
+    path = str(tmp_path / 'log.h5')
+    with recorder.open_recorder(path, chunk_size = 16) as rec:
+        assert isinstance(rec, recorder.hdf5_recorder)
+        record(rec, 50)
+    samples = recorder.read_recording(path)
+    assert len(samples) == 50
+    assert np.allclose(samples['position'], 0.1 * np.arange(50))
+
+def test_controller_stops_a_failing_recording(device_controller, tmp_path, monkeypatch):
+    monkeypatch.setattr(recorder, 'npy_recorder', failing_recorder)
+    device_controller.start_recording(str(tmp_path / 'log.npy'), chunk_size = 1)
+    device_controller.read_state()
+    device_controller.recorder._queue.join()    # Wait for the write to fail
+    device_controller.read_state()
+    assert not device_controller.is_recording
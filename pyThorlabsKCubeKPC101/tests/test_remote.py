@@ -0,0 +1,70 @@
+import time
+import concurrent.futures
+import numpy as np
+import pytest
+
+from pyThorlabsKCubeKPC101 import remote
+from conftest import SERIAL_NUMBER
+
+@pytest.fixture
+def device_server(backend):
+    server = remote.server(backend = backend, address = ('127.0.0.1', 0)).start()
+    yield server
+    server.stop()
+    if server.instrument.connected:
+        server.instrument.disconnect_device()
+
+def test_remote_round_trip(device_server):
+    with remote.client(device_server.address, timeout = 10) as client:
+        assert client.list_devices() == [SERIAL_NUMBER]
+        (Msg, ID) = client.connect_device(SERIAL_NUMBER)
+        assert ID == 1
+        assert device_server.instrument.connected
+        client.mode = 'CloseLoop'
+        assert client.mode == 'CloseLoop'
+        client.set_position_f(6.0)
+        client.wait_until_settled(timeout = 1)
+        assert client.position_f == pytest.approx(6.0)
+        state = client.snapshot()
+        assert state.position == pytest.approx(6.0)
+        assert state.mode == 'CloseLoop'
+        assert client.batch([('set_position_f', [3.0]), ('wait_until_settled',), ('get', ['position_f'])])[-1] == pytest.approx(3.0)
+        results = client.run_trajectory([1.0, 2.0, 3.0], 0.01)
+        assert np.allclose(results['position'], [1.0, 2.0, 3.0])
+
+def test_remote_errors_are_raised_on_the_client(device_server):
+    with remote.client(device_server.address, timeout = 10) as client:
+        client.connect_device(SERIAL_NUMBER)
+        client.mode = 'CloseLoop'
+        with pytest.raises(RuntimeError):
+            client.set_voltage_f(3.0)
+        with pytest.raises(ValueError):
+            client.set_position_f(100.0)
+
+def test_blocking_methods_in_a_batch_do_not_block_other_clients(device_server):
+    with remote.client(device_server.address, timeout = 10) as client, remote.client(device_server.address, timeout = 10) as other_client:
+        client.connect_device(SERIAL_NUMBER)
+        client.mode = 'CloseLoop'
+        # The trajectory lasts 0.5 s, the other client can read the device in the meanwhile
+        future = concurrent.futures.ThreadPoolExecutor(max_workers = 1).submit(client.batch, [('set_position_f', [2.0]),
+                                                                                                ('run_trajectory', [[2.0] * 50, 0.01]),
+                                                                                                ('get', ['position_f'])])
+        time.sleep(0.1)
+        start = time.perf_counter()
+        other_client.position_f
+        assert time.perf_counter() - start < 0.1
+        assert not future.done()
+        assert future.result(5)[-1] == pytest.approx(2.0)
+
+def test_remote_run_trajectory(device_server):
+    with remote.client(device_server.address, timeout = 10) as client:
+        client.connect_device(SERIAL_NUMBER)
+        client.mode = 'CloseLoop'
+        t0 = time.perf_counter() + 0.05
+        results = client.run_trajectory([1.0, 2.0, 3.0], [0.01, 0.02, 0.01], t0 = t0)
+        assert np.allclose(results['position'], [1.0, 2.0, 3.0])
+        # The times refer to t0, which is shared by client and server (same machine)
+        assert results['t_command'][0] == pytest.approx(0.0, abs = 0.01)
+        assert results['t_measured'][-1] == pytest.approx(0.04, abs = 0.02)
+        with pytest.raises(TypeError):
+            client.run_trajectory([1.0, 2.0], 0.01, on_point = lambda index, record: True)
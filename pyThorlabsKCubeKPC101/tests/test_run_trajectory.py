@@ -0,0 +1,50 @@
+import time
+import threading
+import numpy as np
+import pytest
+
+from pyThorlabsKCubeKPC101 import driver
+
+def test_run_trajectory_timing(device):
+    device.mode = 'CloseLoop'
+    points = np.linspace(1, 5, 20)
+    dwell = 0.01
+    results = device.run_trajectory(points, dwell)
+    assert results.dtype == driver.trajectory_dtype
+    assert np.allclose(results['commanded'], points)
+    assert np.allclose(results['position'], points)
+    # Set points are sent on a fixed schedule: a late step does not delay the following ones
+    lateness = results['t_command'] - np.arange(len(points)) * dwell
+    assert (lateness >= 0).all()
+    assert np.median(lateness) < 0.002
+    assert results['t_measured'][-1] == pytest.approx(len(points) * dwell, abs = 0.02)
+    with pytest.raises(ValueError):
+        device.run_trajectory([1, 2, 30], dwell)
+
+def test_run_trajectory_does_not_hold_the_lock(device):
+    device.mode = 'CloseLoop'
+    thread = threading.Thread(target = device.run_trajectory, args = (np.linspace(1, 5, 30), 0.01))
+    thread.start()
+    time.sleep(0.05)
+    start = time.perf_counter()
+    device.position_f
+    waited = time.perf_counter() - start
+    thread.join()
+    assert waited < 0.05
+
+def test_run_trajectory_array_dwell_and_interruption(device):
+    device.mode = 'OpenLoop'
+    dwell = [0.005, 0.01, 0.02, 0.005]
+    results = device.run_trajectory([10.0, 20.0, 30.0, 40.0], dwell)
+    assert np.allclose(results['voltage'], [10.0, 20.0, 30.0, 40.0])
+    assert results['t_measured'][-1] == pytest.approx(sum(dwell), abs = 0.02)
+    indices = []
+    def on_point(index, record):
+        indices.append(index)
+        return index < 1
+    results = device.run_trajectory([10.0, 20.0, 30.0, 40.0], 0.005, on_point = on_point)
+    # The trajectory is interrupted when on_point returns False
+    assert indices == [0, 1]
+    assert len(results) == 2
+    with pytest.raises(ValueError):
+        device.run_trajectory([10.0, 20.0], -0.01)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from pyThorlabsKCubeKPC101 import backends
+from pyThorlabsKCubeKPC101 import group
+from pyThorlabsKCubeKPC101 import scan
+
+@pytest.mark.parametrize('order', scan.ORDERS)
+def test_scan_order_visits_every_point_once(order):
+    indices = scan.scan_order((3, 4, 5), order)
+    assert len(indices) == 60
+    assert len({tuple(index) for index in indices}) == 60
+
+@pytest.mark.parametrize('order', ['serpentine', 'spiral'])
+def test_consecutive_points_are_neighbours(order):
+    indices = scan.scan_order((4, 5, 6), order)
+    assert (np.abs(np.diff(indices, axis = 0)).sum(axis = 1) == 1).all()
+
+def test_raster_order():
+    assert scan.scan_order((2, 3), 'raster').tolist() == [[0, 0], [0, 1], [0, 2], [1, 0], [1, 1], [1, 2]]
+    with pytest.raises(ValueError):
+        scan.scan_order((2, 3), 'random')
+
+@pytest.fixture
+def device_group():
+    axes_group = group.KPC101Group(['1', '2'], axes = ['x', 'y'], backend = backends.simulated_backend(serial_numbers = ['1', '2'], settle_time = 0.002))
+    axes_group.connect()
+    axes_group.set_mode('CloseLoop')
+    yield axes_group
+    axes_group.close()
+
+def test_scan_and_resume(device_group, tmp_path):
+    grid = [np.linspace(1, 4, 4), np.linspace(2, 10, 5)]
+    def trigger(index, setpoints):
+        # The values are latched when the trigger is called, and transferred later by read
+        return np.array([device_group['x'].position_f, device_group['y'].position_f])
+    def read(index, setpoints, latched):
+        return latched
+    checkpoint_path = str(tmp_path / 'scan.npz')
+    def stop_after_some_points(index, setpoints, data):
+        if engine.numb_points_done >= 7:
+            engine.stop_event.set()
+    engine = scan.scan_engine(device_group, grid, func_trigger = trigger, func_read = read, checkpoint_path = checkpoint_path, on_point = stop_after_some_points)
+    engine.start(blocking = True)
+    assert engine.last_exception is None
+    assert 7 <= engine.numb_points_done < 20
+    points_done = engine.done.copy()
+    # A new engine resumes the scan from the checkpoint, and only scans the remaining points
+    scanned = []
+    engine = scan.scan_engine(device_group, grid, func_trigger = trigger, func_read = read, checkpoint_path = checkpoint_path,
+                              on_point = lambda index, setpoints, data: scanned.append(index))
+    engine.start(resume = True, blocking = True)
+    assert engine.done.all()
+    assert len(scanned) == 20 - points_done.sum()
+    assert not any(points_done[index] for index in scanned)
+    (x, y) = np.meshgrid(grid[0], grid[1], indexing = 'ij')
+    assert np.allclose(engine.data[..., 0], x)
+    assert np.allclose(engine.data[..., 1], y)
+    # A checkpoint cannot be used with a different grid
+    engine = scan.scan_engine(device_group, [grid[0], grid[1] + 1], func_trigger = trigger, checkpoint_path = checkpoint_path)
+    with pytest.raises(ValueError):
+        engine.start(resume = True, blocking = True)
@@ -0,0 +1,53 @@
+import pytest
+
+from pyThorlabsKCubeKPC101 import settle
+
+class fake_clock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+def test_busy_flag_with_backoff():
+    clock = fake_clock()
+    detector = settle.settle_detector(func_is_busy = lambda: clock.now < 0.1, initial_interval = 0.01, max_interval = 0.04, backoff = 2, clock = clock)
+    intervals = []
+    while not detector.poll():
+        intervals.append(detector.next_interval)
+        clock.sleep(detector.next_interval)
+    assert intervals[:4] == pytest.approx([0.01, 0.02, 0.04, 0.04])
+    assert detector.settled and not detector.timed_out
+    assert detector.time_to_settle == pytest.approx(0.11)
+
+def test_tolerance_needs_consecutive_samples():
+    clock = fake_clock()
+    values = iter([5.0, 9.995, 10.5, 10.001, 9.999, 10.002])
+    detector = settle.settle_detector(func_is_busy = lambda: True, func_read_value = lambda: next(values), target = 10.0, tolerance = 0.01,
+                                      numb_samples = 3, clock = clock)
+    assert detector.uses_tolerance
+    assert detector.wait(sleep = clock.sleep) is not None
+    assert detector.numb_polls == 6
+    assert not detector.timed_out
+
+def test_timeout():
+    clock = fake_clock()
+    detector = settle.settle_detector(func_is_busy = lambda: True, timeout = 0.5, clock = clock)
+    detector.wait(sleep = clock.sleep)
+    assert detector.timed_out
+    assert detector.time_to_settle > 0.5
+
+def test_settle_detection(device):
+    device.mode = 'CloseLoop'
+    device.set_position_f(3.0)
+    settle_time = device.wait_until_settled(timeout = 1)
+    # The simulated device reaches the set point 50 ms after the command
+    assert 0.04 <= settle_time < 0.2
+    assert device.last_settle_time == settle_time
+    # With a tolerance, the movement ends as soon as the position is within tolerance (the simulated position jumps to the set point)
+    device.set_position_f(4.0)
+    settle_time = device.wait_until_settled(target = 4.0, tolerance = 0.01, numb_samples = 2, timeout = 1)
+    assert settle_time < 0.04
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from pyThorlabsKCubeKPC101 import trajectory
+from pyThorlabsKCubeKPC101 import driver_virtual
+
+LIMITS = {'max_velocity': 500.0, 'max_acceleration': 2e4, 'max_jerk': 2e6}
+
+@pytest.mark.parametrize('distance', [0.01, 0.5, 5.0, 50.0])
+def test_profile_respects_the_limits(distance):
+    duration = float(trajectory.move_duration(distance, **LIMITS))
+    times = np.linspace(0, duration, 20001)
+    (positions, velocities, accelerations) = trajectory.sample_move(2.0, 2.0 + distance, times, **LIMITS)
+    assert positions[0] == pytest.approx(2.0)
+    assert positions[-1] == pytest.approx(2.0 + distance)
+    assert velocities[-1] == pytest.approx(0.0, abs = 1e-6 * LIMITS['max_velocity'])
+    assert (np.abs(velocities) <= LIMITS['max_velocity'] * (1 + 1e-9)).all()
+    assert (np.abs(accelerations) <= LIMITS['max_acceleration'] * (1 + 1e-9)).all()
+    assert (np.diff(positions) >= -1e-12).all()
+    # The velocity is continuous, i.e. the acceleration is the derivative of the velocity
+    assert np.allclose(np.gradient(positions, times), velocities, atol = 1e-3 * LIMITS['max_velocity'] + np.abs(accelerations).max() * (times[1] - times[0]))
+
+def test_plan():
+    profile = trajectory.plan(0.0, [5.0, 2.0], rate = 1000, dwell = 0.01, **LIMITS)
+    assert len(profile) == len(profile.times)
+    assert np.allclose(profile.waypoints, [5.0, 2.0])
+    assert profile.move_start_times[1] == pytest.approx(profile.move_end_times[0] + 0.01)
+    assert profile.positions[-1] == 2.0
+    assert profile.positions.max() <= 5.0 + 1e-9
+    with pytest.raises(ValueError):
+        trajectory.plan(0.0, [5.0], max_velocity = 0)
+
+def test_interrupted_open_loop_trajectory_updates_the_model_only_with_the_points_sent():
+    clock = driver_virtual.simulated_clock()
+    instrument = driver_virtual.pyThorlabsKCubeKPC101(clock = clock, noise = 0, creep = 0)
+    instrument.connect_device('29999999')
+    instrument.persist_delay = None
+    model = instrument.calibrate_open_loop(numb_points = 51, dwell = 0.02, sleep = clock.sleep)
+    instrument.mode = 'OpenLoop'
+    instrument.set_position_open_loop(2.0)
+    profile = instrument.plan_trajectory([12.0, 4.0], rate = 1000, **LIMITS)
+    report = instrument.execute_trajectory(profile, on_point = lambda index, record: index < 9)
+    assert len(report['samples']) == 10
+    assert model.last_position == pytest.approx(profile.positions[9])
+    assert model.last_voltage == pytest.approx(report['samples']['commanded'][-1])
+    instrument.disconnect_device()
@@ -0,0 +1,224 @@
+'''
+Jerk-limited trajectory planner.
+
+A large jump of the set point excites the resonances of the stage, which then takes a long time to settle, while many small jogs waste one
+round trip to the device for each step. plan() instead turns a target (or a list of waypoints) into a sequence of set points sampled at a fixed
+rate, which follows a jerk-limited (S-curve) velocity profile within the limits max_velocity (um/s), max_acceleration (um/s^2) and max_jerk (um/s^3).
+
+Each move between two waypoints starts and ends at rest, and it is made of (up to) seven phases with constant jerk: +jerk, 0, -jerk (acceleration),
+constant velocity, -jerk, 0, +jerk (deceleration). For short moves the maximum velocity and/or the maximum acceleration are not reached, and the
+corresponding phases have zero length. The durations of the phases are computed in closed form, and all set points are evaluated in a single
+vectorized operation for each move. move_duration() gives the (predicted) duration of moves of any length, e.g. to estimate the total time of a scan.
+
+execute() sends the set points to the device on a fixed schedule (see driver.pyThorlabsKCubeKPC101.run_trajectory) and compares, for each move,
+the predicted settle time (the end of the profile) with the measured one (the first time after which the position stays within tolerance from the waypoint).
+
+    profile = device.plan_trajectory([5, 15, 10], rate = 1000, max_velocity = 500)
+    report = device.execute_trajectory(profile, tolerance = 0.01)
+    report['predicted_settle_time'], report['measured_settle_time']
+'''
+import copy
+import time
+import warnings
+import numpy as np
+
+from pyThorlabsKCubeKPC101 import settle
+
+# Jerk of each of the seven phases of a move, in units of max_jerk (for a move towards larger positions)
+PHASE_JERKS = np.array([1, 0, -1, 0, -1, 0, 1])
+
+def _phase_times(distances, max_velocity, max_acceleration, max_jerk):
+    # Returns (t_jerk, t_acceleration, t_velocity, peak_velocity) for each distance: duration of each phase with non-zero jerk, of the whole
+    # acceleration phase, and of the constant velocity phase, and the maximum velocity reached
+    distances = np.abs(np.asarray(distances, dtype = float))
+    (v, a, j) = (float(max_velocity), float(max_acceleration), float(max_jerk))
+    if min(v, a, j) <= 0:
+        raise ValueError("max_velocity, max_acceleration and max_jerk must be positive.")
+    # Distance covered to accelerate to max_velocity and to decelerate back to rest
+    t_acceleration_full = (v / a + a / j) if v * j >= a * a else 2 * np.sqrt(v / j)
+    reaches_velocity = distances >= v * t_acceleration_full
+    # Peak velocity of the moves which do not reach max_velocity: either max_acceleration is reached (distance = vp*(vp/a + a/j)), or not (distance = 2*vp^1.5/sqrt(j))
+    peak_with_acceleration = a * (np.sqrt((a / j)**2 + 4 * distances / a) - a / j) / 2
+    peak_without_acceleration = (distances * np.sqrt(j) / 2)**(2 / 3)
+    peak_velocity = np.where(reaches_velocity, v, np.where(peak_with_acceleration >= a * a / j, peak_with_acceleration, peak_without_acceleration))
+    reaches_acceleration = peak_velocity >= a * a / j
+    t_jerk = np.where(reaches_acceleration, a / j, np.sqrt(peak_velocity / j))
+    t_acceleration = np.where(reaches_acceleration, peak_velocity / a + a / j, 2 * t_jerk)
+    t_velocity = np.where(reaches_velocity, (distances - v * t_acceleration_full) / v, 0.0)
+    return (t_jerk, t_acceleration, t_velocity, peak_velocity)
+
+def move_duration(distances, max_velocity, max_acceleration, max_jerk):
+    '''
+    Duration (in s) of rest-to-rest moves of the given distances (scalar or array, in um) with a jerk-limited profile
+    '''
+    (t_jerk, t_acceleration, t_velocity, _) = _phase_times(distances, max_velocity, max_acceleration, max_jerk)
+    return 2 * t_acceleration + t_velocity
+
+def sample_move(start, target, times, max_velocity, max_acceleration, max_jerk):
+    '''
+    Position, velocity and acceleration at the times (array, in s from the start of the move) of a jerk-limited move from start to target.
+    Times after the end of the move give the target position, with zero velocity and acceleration
+    '''
+    times = np.asarray(times, dtype = float)
+    distance = target - start
+    (t_jerk, t_acceleration, t_velocity, _) = (float(x) for x in _phase_times(distance, max_velocity, max_acceleration, max_jerk))
+    durations = np.array([t_jerk, t_acceleration - 2 * t_jerk, t_jerk, t_velocity, t_jerk, t_acceleration - 2 * t_jerk, t_jerk])
+    jerks = np.sign(distance) * max_jerk * PHASE_JERKS
+    boundaries = np.concatenate([[0.0], np.cumsum(durations)])
+    # State at the beginning of each phase
+    (p, v, a) = (np.zeros(8), np.zeros(8), np.zeros(8))
+    p[0] = start
+    for k, (dt, jerk) in enumerate(zip(durations, jerks)):
+        p[k + 1] = p[k] + v[k] * dt + a[k] * dt**2 / 2 + jerk * dt**3 / 6
+        v[k + 1] = v[k] + a[k] * dt + jerk * dt**2 / 2
+        a[k + 1] = a[k] + jerk * dt
+    phase = np.clip(np.searchsorted(boundaries, times, side = 'right') - 1, 0, 6)
+    dt = times - boundaries[phase]
+    positions = p[phase] + v[phase] * dt + a[phase] * dt**2 / 2 + jerks[phase] * dt**3 / 6
+    velocities = v[phase] + a[phase] * dt + jerks[phase] * dt**2 / 2
+    accelerations = a[phase] + jerks[phase] * dt
+    ended = times >= boundaries[-1]
+    positions[ended] = target
+    velocities[ended] = 0.0
+    accelerations[ended] = 0.0
+    return (positions, velocities, accelerations)
+
+class motion_profile():
+    '''
+    Set points of a planned trajectory, sampled every 1/rate s (see plan())
+
+    Attributes
+    ----------
+    rate : float
+        Number of set points per second
+    times, positions, velocities, accelerations : numpy.ndarray
+        Time (in s from the start of the trajectory), position (um), velocity (um/s) and acceleration (um/s^2) of each set point
+    waypoints : numpy.ndarray
+        Target of each move
+    move_start_times, move_end_times : numpy.ndarray
+        Start and end time (in s) of the profile of each move. The end time is the predicted settle time of the move
+    duration : float
+        Total duration of the trajectory (including the dwell time after the last move)
+    '''
+    def __init__(self, rate, times, positions, velocities, accelerations, waypoints, move_start_times, move_end_times, duration):
+        self.rate = rate
+        self.times = times
+        self.positions = positions
+        self.velocities = velocities
+        self.accelerations = accelerations
+        self.waypoints = waypoints
+        self.move_start_times = move_start_times
+        self.move_end_times = move_end_times
+        self.duration = duration
+
+    def __len__(self):
+        return len(self.times)
+
+def plan(start, waypoints, rate = 1000, max_velocity = 1000, max_acceleration = 1e5, max_jerk = 1e7, dwell = 0.0):
+    '''
+    Plan a trajectory from the position start through the waypoints (a single target or a list of targets, in um). Each move starts and ends at rest.
+
+    rate : float
+        Number of set points per second
+    max_velocity, max_acceleration, max_jerk : float
+        Limits of the profile, in um/s, um/s^2 and um/s^3
+    dwell : float or array-like
+        Time (in s) spent at each waypoint after the end of the move (a single value, or one value for each waypoint)
+
+    Returns
+    -------
+    motion_profile
+    '''
+    waypoints = np.atleast_1d(np.asarray(waypoints, dtype = float))
+    dwell = np.broadcast_to(np.asarray(dwell, dtype = float), waypoints.shape)
+    if (dwell < 0).any():
+        raise ValueError("Dwell times must be non-negative.")
+    starts = np.concatenate([[start], waypoints[:-1]])
+    durations = move_duration(waypoints - starts, max_velocity, max_acceleration, max_jerk)
+    move_start_times = np.concatenate([[0.0], np.cumsum(durations + dwell)[:-1]])
+    move_end_times = move_start_times + durations
+    total_duration = float(move_end_times[-1] + dwell[-1]) if len(waypoints) else 0.0
+    # The last set point is at (or right after) the end of the trajectory, so that the last waypoint is always sent
+    times = np.arange(int(np.ceil(total_duration * rate - 1e-9)) + 1) / rate
+    positions = np.full(len(times), float(start))
+    velocities = np.zeros(len(times))
+    accelerations = np.zeros(len(times))
+    move_index = np.searchsorted(move_start_times, times, side = 'right') - 1
+    for index in range(len(waypoints)):
+        selected = move_index == index
+        (positions[selected], velocities[selected], accelerations[selected]) = sample_move(starts[index], waypoints[index], times[selected] - move_start_times[index],
+                                                                                        max_velocity, max_acceleration, max_jerk)
+    return motion_profile(rate, times, positions, velocities, accelerations, waypoints, move_start_times, move_end_times, total_duration)
+
+def execute(instrument, profile, tolerance = 0.01, numb_samples = 3, timeout = 1.0, on_point = None):
+    '''
+    Send the set points of profile (a motion_profile) to instrument (a connected driver.pyThorlabsKCubeKPC101 object), and measure the settle time of each move.
+    In close loop the positions are sent as set points. In open loop they are converted to voltages with the hysteresis model of the driver (see hysteresis.py).
+    The voltages are planned on a copy of the model, and the state of the model of the driver is updated only with the set points actually sent.
+
+    tolerance : float
+        A move has settled when the position stays within tolerance (in um) from its waypoint
+    numb_samples, timeout
+        If the last move has not settled by the end of the trajectory, the position is then polled (see settle.settle_detector) until it stays within
+        tolerance for numb_samples consecutive polls, or for at most timeout s
+    on_point
+        See driver.pyThorlabsKCubeKPC101.run_trajectory
+
+    Returns
+    -------
+    dict
+        'samples': the array returned by run_trajectory (commanded value, and position and voltage measured after each set point),
+        'waypoints', 'predicted_settle_time', 'measured_settle_time': arrays with one element for each move. Times are in s from the start of the
+        trajectory, the measured settle time is nan if the move did not settle
+    '''
+    instrument.check_valid_connection()
+    model = None
+    if instrument.mode == 'CloseLoop':
+        set_points = profile.positions
+    elif instrument.mode == 'OpenLoop':
+        model = instrument.hysteresis_model
+        if model is None:
+            raise RuntimeError("The hysteresis model is not available, call calibrate_open_loop() first (or use the device in close loop).")
+        if model.last_position is None:
+            model.reset(position = instrument.position_f, voltage = instrument.voltage_f)
+        (min_voltage, max_voltage) = instrument.voltage_limits_f
+        set_points = np.clip(copy.copy(model).voltages_for(profile.positions), min_voltage, max_voltage)
+    else:
+        raise RuntimeError("The device must be either in CloseLoop or OpenLoop mode.")
+    # The same origin is used for the times measured by run_trajectory and for the settle time measured below
+    t_start = time.perf_counter()
+    try:
+        samples = instrument.run_trajectory(set_points, 1 / profile.rate, on_point = on_point, t0 = t_start)
+    except Exception:
+        if model is not None:
+            model.reset()   # The number of set points sent is not known, so neither is the state of the piezo
+        raise
+    if (model is not None) and len(samples):
+        # The model follows the set points which were actually sent (the trajectory might have been interrupted by on_point)
+        model.voltages_for(profile.positions[:len(samples)])
+    # run_trajectory measures the position at the end of the dwell time of each set point. A move has settled at the first sample after which
+    # the position stays within tolerance until the next move starts
+    measured = np.full(len(profile.waypoints), np.nan)
+    next_move_start = np.concatenate([profile.move_start_times[1:], [np.inf]])
+    for index, waypoint in enumerate(profile.waypoints):
+        selected = (samples['t_measured'] >= profile.move_start_times[index]) & (samples['t_measured'] < next_move_start[index])
+        if not selected.any():
+            continue
+        (t_measured, positions) = (samples['t_measured'][selected], samples['position'][selected])
+        outside = np.flatnonzero(np.abs(positions - waypoint) >= tolerance)
+        if len(outside) == 0:
+            measured[index] = t_measured[0]
+        elif outside[-1] < len(positions) - 1:
+            measured[index] = t_measured[outside[-1] + 1]
+    if len(samples) == len(profile) and len(profile.waypoints) and np.isnan(measured[-1]):
+        detector = settle.settle_detector(func_is_busy = lambda: True, func_read_value = lambda: instrument.position_f, target = profile.waypoints[-1],
+                                          tolerance = tolerance, numb_samples = numb_samples, timeout = timeout, clock = time.perf_counter)
+        detector.wait()
+        if detector.timed_out:
+            warnings.warn(f"The last move did not settle within {timeout} s.", UserWarning)
+        else:
+            measured[-1] = detector.start_time + detector.time_to_settle - t_start
+    return {'samples': samples,
+            'waypoints': profile.waypoints,
+            'predicted_settle_time': profile.move_end_times,
+            'measured_settle_time': measured}
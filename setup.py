@@ -18,7 +18,8 @@ setuptools.setup(name='pyThorlabsKCubeKPC101',
       author_email='michele.cotrufo@gmail.com',
       license='MIT',
       entry_points = {
-        'console_scripts': ["pyThorlabsKCubeKPC101 = pyThorlabsKCubeKPC101.main:main"],
+        'console_scripts': ["pyThorlabsKCubeKPC101 = pyThorlabsKCubeKPC101.main:main",
+                            "pyThorlabsKCubeKPC101-server = pyThorlabsKCubeKPC101.remote:main"],
       },
       packages=['pyThorlabsKCubeKPC101'],
       include_package_data = True,